@@ -3,6 +3,11 @@
 
 SHOW_GIT_IGNORE = 0
 
+# List this many of the biggest objects in each repo (0 for none), and with
+# LARGEST_OBJECT_PATHS, the path each blob or tree is at
+LARGEST_OBJECTS = 0
+LARGEST_OBJECT_PATHS = 0
+
 def main():
     import argparse
 
@@ -10,255 +15,488 @@ def main():
 
     parser.add_argument("path", nargs="?", default=None, help="path to scan for Git repos")
     parser.add_argument('--verbose', '-v', action='store_true', help='verbose output')
+    parser.add_argument('--format', choices=['ini', 'jsonl'], default='ini',
+                        help='print [repo-N] blocks, or one JSON object per repo as each one is done (jsonl)')
     parser.add_argument('--dirty-only', action= 'store_true', help='only show dirty repos')
     parser.add_argument('--check-upstream', action='store_true', help='check upstream repo status (slow)')
+    parser.add_argument('--upstream-jobs', type=int, default=8, help='number of remotes to query at once')
+    parser.add_argument('--upstream-timeout', type=float, default=30, help='seconds to wait for a remote')
+    parser.add_argument('--large-worktrees', action='store_true',
+                        help='speed up status in big worktrees (untracked cache, parallel index checks, file watcher)')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='number of repos to analyze in parallel')
+    parser.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                        help='skip directories matching GLOB (name or path relative to the scan path); may be repeated')
+    parser.add_argument('--max-depth', type=int, default=None, help='how many directory levels to search below path')
+    parser.add_argument('--follow-symlinks', action='store_true', help='follow symlinked directories when searching')
+    parser.add_argument('--cache', default=None, help='path of the scan cache (default ~/.cache/git-tools/scan-cache.json)')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the scan cache')
+    parser.add_argument('--refresh', action='store_true',
+                        help='re-analyze every repo and re-list every directory, then update the scan cache and index')
+    parser.add_argument('--use-index', action='store_true',
+                        help='remember directory listings between scans (can help on slow, e.g. network, filesystems)')
+    parser.add_argument('--index', default=None,
+                        help='path of the discovery index, implies --use-index (default ~/.cache/git-tools/discovery-index.json)')
+    parser.add_argument('--no-index', action='store_true', help='do not read or write the discovery index')
+    parser.add_argument('--largest', type=int, default=0, metavar='N',
+                        help='list the N biggest objects in each repo (size:type:oid)')
+    parser.add_argument('--largest-paths', action='store_true',
+                        help='also show where those objects are in history (walks all of it, so slower)')
+    parser.add_argument('--profile', action='store_true',
+                        help='time every git command and print a summary by subcommand and method at the end')
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help='also save the git commands as Chrome trace events in FILE (implies --profile)')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, re-analyzing repos as they change, and serve their status (Linux only)')
+    parser.add_argument('--status', action='store_true', help='print the status kept by a running --watch')
+    parser.add_argument('--maintain', action='store_true',
+                        help='gc, repack, and write multi-pack-indexes and commit-graphs where repos need them')
+    parser.add_argument('--dry-run', action='store_true', help='with --maintain, only show what would be done')
+    parser.add_argument('--io-budget', type=float, default=1024, metavar='MB',
+                        help='with --maintain, how much the repos being worked on may write at once (0 for no limit)')
+    parser.add_argument('--socket', default=None,
+                        help='socket for --watch and --status (default ~/.cache/git-tools/statusd.sock)')
+    parser.add_argument('--snapshot', default=None,
+                        help='file --watch keeps the status in (default ~/.cache/git-tools/status.txt)')
 
     args = parser.parse_args()
 
+    if args.status:
+        import sys
+
+        import statusd
+        text = statusd.read_status(args.socket)
+        if text is None:
+            print("No status daemon is running (start one with --watch)", file=sys.stderr)
+            sys.exit(1)
+        print(text, end="")
+        return
+
+    global LARGEST_OBJECTS, LARGEST_OBJECT_PATHS
+    LARGEST_OBJECTS = args.largest
+    LARGEST_OBJECT_PATHS = 1 if args.largest_paths else 0
+
+    import gitlib
+    gitlib.LS_REMOTE_JOBS = args.upstream_jobs
+    gitlib.LS_REMOTE_TIMEOUT = args.upstream_timeout
+    gitlib.LARGE_WORKTREE = 1 if args.large_worktrees else 0
+    if args.format == 'jsonl':
+        # git errors go into each repo's JSON instead
+        gitlib.PRINT_ERRORS = 0
+    if args.profile or args.trace is not None:
+        gitlib.PROFILE = gitlib.Profile()
+
     start_path = "."
     if args.path is not None:
         start_path = args.path
-    scan(start_path, args.verbose, args.dirty_only, args.check_upstream)
 
-def scan(base_path, verbose, dirty_only, check_upstream):
-    import os
+    cache = None
+    if not args.no_cache:
+        import scancache
+        cache = scancache.ScanCache(args.cache, refresh=args.refresh)
+
+    # The index saves a scandir per directory but still stats each one, so it only
+    # pays off where stat is much cheaper than listing; it's opt-in
+    index = None
+    if (args.use_index or args.index is not None) and not args.no_index:
+        import discovery
+        index = discovery.DiscoveryIndex(args.index, refresh=args.refresh)
+
+    # --maintain and --watch return early (and --watch only stops when interrupted), so
+    # the profile is written on the way out whichever way we go
+    try:
+        if args.maintain:
+            import maintenance
+            # errors go into each repo's report
+            gitlib.PRINT_ERRORS = 0
+            io_budget = int(args.io_budget * 1024 * 1024) if args.io_budget > 0 else None
+            maintenance.maintain(start_path, args.jobs, io_budget, args.dry_run,
+                                 args.exclude, args.max_depth, args.follow_symlinks, index)
+            return
+
+        if args.watch:
+            import fsmonitor
+            import statusd
+            if not fsmonitor.available():
+                raise RuntimeError("--watch needs inotify (Linux)")
+            # errors go into each repo's report
+            gitlib.PRINT_ERRORS = 0
+            daemon = statusd.StatusDaemon(start_path, args.verbose, args.dirty_only, args.jobs, args.exclude,
+                                          args.max_depth, args.follow_symlinks, index, args.socket, args.snapshot)
+            daemon.run()
+            return
+
+        scan(start_path, args.verbose, args.dirty_only, args.check_upstream, args.jobs, cache,
+             args.exclude, args.max_depth, args.follow_symlinks, index, args.format)
+    finally:
+        if gitlib.PROFILE is not None:
+            import sys
+            print("\n".join(gitlib.PROFILE.summary()), file=sys.stderr, flush=True)
+            if args.trace is not None:
+                gitlib.PROFILE.write_trace(args.trace)
+
+def scan(base_path, verbose, dirty_only, check_upstream, jobs=1, cache=None,
+         exclude=(), max_depth=None, follow_symlinks=False, index=None, output_format="ini"):
+    import collections
+    import concurrent.futures
     import os.path
     import sys
     import time
 
-    import gitlib
+    import discovery
 
     status_time = time.time()
 
-    HOOKS = 1
-    INFO = 2
-    OBJECTS = 4
-    REFS = 8
-    CONFIG = 16
-    HEAD = 32
-    BAREDIR = 63
-
-    for root, dirs, files in os.walk(base_path):
-        # print(f"examining {root}", file=sys.stderr)
-        has_gitdir = False
-        has_baredir = 0
-
-        for d in dirs:
-            if d == ".git":
-                has_gitdir = True
-            elif d == "hooks":
-                has_baredir |= HOOKS
-            elif d == "info":
-                has_baredir |= INFO
-            elif d == "objects":
-                has_baredir |= OBJECTS
-            elif d == "refs":
-                has_baredir |= REFS
-
-        for f in files:
-            if f == "HEAD":
-                has_baredir |= HEAD
-            elif f == "config":
-                has_baredir |= CONFIG
-
-        if has_gitdir is True or has_baredir == BAREDIR:
-            start_time = time.time()
-            root_path = os.path.abspath(root).replace("\\", "/")
-            # print(f"Checking potential Git repo at {root_path}")
-            repo = gitlib.Git(root_path)
-
-            did_work = analyze(repo, verbose, dirty_only, check_upstream)
-            if did_work:
-                delta_time = time.time() - start_time
-                print(f"elapsed = {delta_time:.3f}")
-
-                print(flush=True)
-
-            # Don't iterate inside git directory
-            dirs.clear()
+    # With jobs > 1, repos are analyzed on a thread pool while we keep walking. Reports
+    # are printed from this thread in discovery order, so the output (and repo_count
+    # numbering) is the same as a serial scan. JSON lines stand alone, so they are
+    # printed as soon as each repo is done.
+    in_order = output_format != "jsonl"
+    print_result = print_report if in_order else print_json
+    pool = None
+    if jobs > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    pending = collections.deque()
+
+    repos = discovery.find_repos(base_path, exclude, max_depth, follow_symlinks=follow_symlinks, jobs=jobs, index=index)
+    for root, kind in repos:
+        root_path = os.path.abspath(root).replace("\\", "/")
+        # print(f"Checking potential Git repo at {root_path}")
+        if pool is None:
+            print_result(analyze_repo(root_path, verbose, dirty_only, check_upstream, cache))
+        else:
+            pending.append(pool.submit(analyze_repo, root_path, verbose, dirty_only, check_upstream, cache))
+
+        if in_order:
+            while len(pending) > 0 and pending[0].done():
+                print_result(pending.popleft().result())
+        else:
+            for future in [future for future in pending if future.done()]:
+                pending.remove(future)
+                print_result(future.result())
 
         if time.time() >= status_time:
             print(".", end="", file=sys.stderr, flush=True)
             status_time = time.time() + 0.1
 
+    if in_order:
+        while len(pending) > 0:
+            print_result(pending.popleft().result())
+    else:
+        for future in concurrent.futures.as_completed(pending):
+            print_result(future.result())
+    if pool is not None:
+        pool.shutdown()
+
     print(file=sys.stderr, flush=True)
 
+    if index is not None:
+        index.save()
+        print(f"index: {index.hits} directories unchanged, {index.misses} listed", file=sys.stderr, flush=True)
+
+    if cache is not None:
+        cache.save()
+        print(f"cache: {cache.hits} reused, {cache.misses} analyzed", file=sys.stderr, flush=True)
+
+def analyze_repo(root_path, verbose, dirty_only, check_upstream, cache=None):
+    """Analyze the repo at root_path; returns (repo, report), or None if there is
+    nothing to show. The report is analyze_report()'s, plus "elapsed". Safe to call
+    from worker threads (the report is returned, not printed).
+
+    If cache is given, a previous report is reused when the repo hasn't changed. Upstream
+    checks depend on other repos, so those results are never cached."""
+    import time
+
+    import gitlib
+    import scancache
+
+    start_time = time.time()
+    repo = gitlib.Git(root_path)
+
+    # get the (slow) remote queries going while we look at the rest of the repo
+    if check_upstream and repo.is_worktree:
+        repo.prefetch_ls_remote()
+
+    with repo.query_batch():
+        if cache is None or check_upstream or not (repo.is_worktree or repo.is_bare_repo):
+            report = analyze_report(repo, verbose, dirty_only, check_upstream)
+        else:
+            key = scancache.cache_key(repo, "analyze", verbose, dirty_only, LARGEST_OBJECTS, LARGEST_OBJECT_PATHS)
+            fingerprint = scancache.repo_fingerprint(repo)
+            found, report = cache.lookup(key, fingerprint)
+            if not found:
+                report = analyze_report(repo, verbose, dirty_only, check_upstream)
+                # git status may have refreshed the index, so fingerprint it again
+                cache.store(key, scancache.repo_fingerprint(repo), report)
+
+    if report is None:
+        return None
+
+    # a copy, so the cached report is left alone
+    delta_time = time.time() - start_time
+    return repo, dict(report, elapsed=delta_time)
+
+def print_report(result):
+    """Print one repo's report as a single [repo-N] block"""
+    import sys
+
+    if result is None:
+        return
+    repo, report = result
+
+    if repo.is_bare_repo:
+        print(f"\rFound bare repo at {repo.gitdir}", file=sys.stderr, flush=True)
+    else:
+        print(f"\rFound repo at {repo.gitdir}", file=sys.stderr, flush=True)
+
+    global repo_count
+    repo_count += 1
+    lines = [f"[repo-{repo_count}]", *report_lines(report), ""]
+    print("\n".join(lines), flush=True)
+
 repo_count = 0
 
+def print_json(result):
+    """Print one repo's report as a line of JSON"""
+    import json
+
+    if result is None:
+        return
+    repo, report = result
+    print(json.dumps({"repo": repo.gitdir, **report}), flush=True)
+
 def analyze(repo, verbose, dirty_only, check_upstream):
+    with repo.query_batch():
+        report = analyze_report(repo, verbose, dirty_only, check_upstream)
+    if report is None:
+        return
+    print_report((repo, report))
+    return True
+
+def analyze_report(repo, verbose, dirty_only, check_upstream):
+    """Return the report for repo, or None if the repo should not be shown.
+
+    The report is a dict with "fields" (name -> value, in the order they're printed;
+    fields that would print as empty are left out), "timings" (seconds spent on each
+    query) and "errors" (git errors and failed queries, as strings)."""
     import sys
     import time
 
     if not (repo.is_bare_repo or repo.is_worktree):
-        print(f"Something wrong, not a repo at {repo.gitdir}")
+        print(f"Something wrong, not a repo at {repo.gitdir}", file=sys.stderr)
         return
 
-    # Do all the work up front to see if this is a dirty repo, so that
-    # we can skip non-dirty repos if we have dirty_only set. Note that this
-    # isn't looking for stashes at the moment (probably should?)
+    timings = dict()
+
+    def timed(name, query, default=None):
+        """Run one query, timing it; a query that fails gets an error and the default
+        (as does one that returns None because the git command behind it failed)"""
+        start_time = time.time()
+        try:
+            result = query()
+            return default if result is None else result
+        except RuntimeError as e:
+            repo.report_error(f"{name} failed for {repo.gitdir}: {e}")
+            return default
+        finally:
+            timings[name] = time.time() - start_time
+
+    # We need the main branch before we can count unmerged commits
+    branches = timed("branches", repo.branches, [])
+    repo.main_branch = pick_main_branch(branches)
+
+    # If we only want dirty repos, run the cheap probes first and stop at the first
+    # sign of work; clean repos are skipped without running the full set of queries
+    if dirty_only and timed("dirty_reason", lambda: repo.dirty_reason(check_upstream)) is None:
+        return
 
     # show uncommitted files (TBD to show ignores as well)
     # We can only do this on worktrees (TBD to do it on all worktrees)
     uncommitted = []
     if repo.is_worktree:
-        uncommitted = repo.uncommitted()
+        uncommitted = timed("uncommitted", repo.uncommitted, [])
 
-    # show refs not merged to main
+    # count refs not merged to main
     # (very little point on doing this for bare repos)
-    unmerged = []
+    num_unmerged = 0
     if repo.main_branch is not None and not repo.is_bare_repo:
-        unmerged = repo.unmerged()
+        num_unmerged = timed("unmerged", repo.count_unmerged, 0)
 
-    # Show local commits not pushed to tracking branches
+    # Count local commits not pushed to tracking branches
     # (no point on doing this for bare repositories)
-    unpushed = []
+    num_unpushed_branches, num_unpushed = 0, 0
     if not repo.is_bare_repo:
-        unpushed = repo.unpushed()
+        num_unpushed_branches, num_unpushed = timed("unpushed", repo.count_unpushed, (0, 0))
 
     # Show upstream refs not in sync with local remote refs
     # (a proxy for unfetched commits)
     unfetched = []
     if repo.is_worktree and check_upstream:
-        unfetched = repo.unfetched()
+        unfetched = timed("unfetched", repo.unfetched, [])
 
-    # If we only want dirty repos, bail out now if this is not dirty
-    if dirty_only:
-        if len(uncommitted) == 0 and len(unmerged) == 0 and len(unpushed) == 0 and len(unfetched) == 0:
-            return
-
-    if repo.is_bare_repo:
-        print(f"\rFound bare repo at {repo.gitdir}", file=sys.stderr, flush=True)
-    elif repo.is_worktree:
-        print(f"\rFound repo at {repo.gitdir}", file=sys.stderr, flush=True)
-    else:
-        print(f"Something wrong, not a repo at {repo.gitdir}")
-        return
-
-    global repo_count
-    repo_count += 1
-    print(f"[repo-{repo_count}]")
+    fields = dict()
 
     # Calculate repo signature (TBD: will use this to know if a repo has changed
     # since the last time we looked at it).
-    start_time = time.time()
-    if verbose:
-        signature = repo.signature()
-    delta_time = time.time() - start_time
     if verbose:
-        print(f"signature = {signature} ({delta_time:.3f})")
+        fields["signature"] = timed("signature", repo.signature)
 
-    print(f"repo = {repo.gitdir}")
+    fields["repo"] = repo.gitdir
     if repo.is_bare_repo:
-        print(f"bare = true")
+        fields["bare"] = True
 
-    num_commits = repo.num_commits()
-    print(f"commits = {num_commits}")
+    num_commits = timed("commits", repo.num_commits, 0)
+    fields["commits"] = num_commits
 
     # we can't get the last commit date if there are no commits
     if num_commits > 0:
-        last_commit_date = repo.last_commit_date()
-        print(f"last_commit = {last_commit_date}")
-
-    if verbose:
-        object_stats = repo.count_objects()
-        num_loose = object_stats.get('count', 0)
-        if num_loose > 0:
-            print(f"loose = {num_loose} ({object_stats.get('size', 0)} KB)")
-        num_garbage = object_stats.get('garbage', 0)
-        if num_garbage > 0:
-            print(f"garbage = {num_garbage} ({object_stats.get('size-garbage', 0)} KB)")
-        num_packs = object_stats.get('packs', 0)
-        if num_packs > 0:
-            print(f"packs = {num_packs}/{object_stats.get('in-pack', 0)} ({object_stats.get('size-pack', 0)} KB)")
-
-    branches = repo.branches()
-    print(f"branches = \"{', '.join(branches)}\"")
-
-    # Figure out what we want to call the main branch
-    # - if we have "main", use it
-    # - if we have "master", use it as main
-    # - otherwise, use the first branch
-    repo.main_branch = None
-    if len(branches) > 0:
-        if 'main' in branches:
-            repo.main_branch = 'main'
-        elif 'master' in branches:
-            repo.main_branch = 'master'
-        else:
-            repo.main_branch = branches[0]
-
-    tags = repo.tags()
+        fields["last_commit"] = timed("last_commit", repo.last_commit_date)
+
+    # object stats are read from the repository files when we can, which is cheap
+    # enough to do for every repo
+    object_stats = timed("objects", repo.count_objects, dict())
+    num_loose = object_stats.get('count', 0)
+    if num_loose > 0:
+        fields["loose"] = {"count": num_loose, "size": object_stats.get('size', 0)}
+    num_garbage = object_stats.get('garbage', 0)
+    if num_garbage > 0:
+        fields["garbage"] = {"count": num_garbage, "size": object_stats.get('size-garbage', 0)}
+    num_packs = object_stats.get('packs', 0)
+    if num_packs > 0:
+        fields["packs"] = {"count": num_packs, "objects": object_stats.get('in-pack', 0),
+                           "size": object_stats.get('size-pack', 0)}
+        if "pack-details" in object_stats:
+            fields["packs"]["details"] = object_stats["pack-details"]
+
+    # the biggest objects, to spot repos bloated by huge files
+    if LARGEST_OBJECTS > 0:
+        largest = timed("largest", lambda: repo.largest_objects(k=LARGEST_OBJECTS, paths=bool(LARGEST_OBJECT_PATHS)), [])
+        if len(largest) > 0:
+            fields["largest"] = [{"size": size, "disk_size": disk_size, "type": kind, "oid": oid, "path": path}
+                                 for size, disk_size, kind, oid, path in largest]
+
+    fields["branches"] = branches
+
+    tags = timed("tags", repo.tags, [])
     if len(tags) > 0:
-        print(f"tags = \"{', '.join(tags)}\"")
+        fields["tags"] = tags
 
-    remotes = repo.remotes()
+    remotes = timed("remotes", repo.remotes, [])
     if len(remotes) > 0:
-        print(f"remotes = \"{', '.join(remotes)}\"")
+        fields["remotes"] = remotes
 
     # bare repositories don't have worktrees
     if repo.is_worktree:
-        worktrees = repo.worktrees()
+        worktrees = timed("worktrees", repo.worktrees, [])
         if len(worktrees) > 0:
-            print(f"worktrees = \"{', '.join(worktrees)}\"")
+            fields["worktrees"] = worktrees
 
     # Apparently we can only issue "git submodule" calls in working trees. Even though
     # bare git trees can have submodules, they can't really be used, because most of the
     # point of a submodule is to fetch files into the worktree
     if repo.is_worktree:
-        submodules = repo.submodules()
+        submodules = timed("submodules", repo.submodules)
         if submodules is not None and len(submodules) > 0:
-            print(f"submodules = \"{', '.join(submodules)}\"")
+            fields["submodules"] = submodules
 
     if verbose:
-        roots = repo.roots()
-        print(f"roots = \"{', '.join(roots)}\"")
+        fields["roots"] = timed("roots", repo.roots, [])
 
-    hooks = repo.hooks()
+    hooks = timed("hooks", repo.hooks, [])
     if len(hooks) > 0:
-        print(f"hooks = \"{', '.join(hooks)}\"")
+        fields["hooks"] = hooks
 
     # show unfetched refs (cases where local remotes are out of date with upstream)
     # note: if we have unpushed, then we need to do extra work to figure out if
     # we have unfetched as well, because that's a merge scenario, and we probably
     # can't do that work without fetching.
-    if len(unfetched) > 0 and len(unpushed) == 0:
-        print(f"unfetched = \"{', '.join(unfetched)}\"")
+    if len(unfetched) > 0 and num_unpushed_branches == 0:
+        fields["unfetched"] = unfetched
+
+    # how status was sped up in a big worktree
+    if verbose and repo.status_info is not None and len(repo.status_info["accelerations"]) > 0:
+        fields["status"] = {"seconds": repo.status_info["seconds"], "accelerations": repo.status_info["accelerations"]}
 
     # show uncommitted files (TBD to show ignores as well)
-    # We can only do this on worktrees (TBD to do it on all worktrees)
-    if repo.is_worktree:
-        uncommitted = repo.uncommitted()
-        if len(uncommitted) > 0:
-            print(f"uncommitted = \"{', '.join(uncommitted)}\"")
+    if len(uncommitted) > 0:
+        fields["uncommitted"] = uncommitted
 
     # show refs not merged to main
-    # (very little point on doing this for bare repos)
-    if repo.main_branch is not None and not repo.is_bare_repo:
-        unmerged = repo.unmerged()
-        if len(unmerged) > 0:
-            print(f"unmerged = {len(unmerged)} commits")
+    if num_unmerged > 0:
+        fields["unmerged"] = num_unmerged
 
     # Show local commits not pushed to tracking branches
-    # (no point on doing this for bare repositories)
-    if not repo.is_bare_repo:
-        unpushed = repo.unpushed()
-        if len(unpushed) > 0:
-            print(f"unpushed = {len(unpushed[0])} branches with {len(unpushed[1])} commits")
+    if num_unpushed_branches > 0:
+        fields["unpushed"] = {"branches": num_unpushed_branches, "commits": num_unpushed}
+
+    # Show branches that have diverged from their upstream
+    if verbose and not repo.is_bare_repo:
+        tracking = []
+        for branch, upstream, ahead, behind in timed("tracking", repo.ahead_behind, []):
+            if ahead is None:
+                tracking.append(f"{branch}:{upstream} gone")
+            elif ahead > 0 or behind > 0:
+                tracking.append(f"{branch}:{upstream} +{ahead}/-{behind}")
+        if len(tracking) > 0:
+            fields["tracking"] = tracking
 
     # Show stashed commits (bare repos could have stashes, but won't, in reality)
-    stashes = repo.stashes()
+    stashes = timed("stashes", repo.stashes, [])
     if len(stashes) > 0:
-        flat_stashes = '\\n'.join(stashes)
-        print(f"stashes = \"{flat_stashes}\"")
+        fields["stashes"] = stashes
 
     # See if we have a .gitignore at the root of the repo
     if SHOW_GIT_IGNORE:
-        gitignore_data = repo.read_gitignore()
+        gitignore_data = timed("gitignore", repo.read_gitignore)
         if gitignore_data is not None:
-            flat_gitignore = '\\n'.join(gitignore_data)
-            print(f"gitignore = \"{flat_gitignore}\"")
-
-    return True
+            fields["gitignore"] = gitignore_data
+
+    return {"fields": fields, "timings": timings, "errors": list(repo.errors)}
+
+def report_lines(report):
+    """The report as "name = value" lines (without the [repo-N] header)"""
+    lines = []
+    for name, value in report["fields"].items():
+        if name == "signature":
+            lines.append(f"signature = {value} ({report['timings']['signature']:.3f})")
+        elif name == "bare":
+            lines.append(f"bare = true")
+        elif name in ("loose", "garbage"):
+            lines.append(f"{name} = {value['count']} ({value['size']} KB)")
+        elif name == "packs":
+            lines.append(f"packs = {value['count']}/{value['objects']} ({value['size']} KB)")
+        elif name == "largest":
+            flat_value = ', '.join(f"{item['size']}:{item['type']}:{item['oid']}" +
+                                   (f":{item['path']}" if item['path'] is not None else "") for item in value)
+            lines.append(f"largest = \"{flat_value}\"")
+        elif name == "status":
+            lines.append(f"status = {value['seconds']:.3f} ({', '.join(value['accelerations'])})")
+        elif name == "unmerged":
+            lines.append(f"unmerged = {value} commits")
+        elif name == "unpushed":
+            lines.append(f"unpushed = {value['branches']} branches with {value['commits']} commits")
+        elif name in ("stashes", "gitignore"):
+            flat_value = '\\n'.join(value)
+            lines.append(f"{name} = \"{flat_value}\"")
+        elif isinstance(value, list):
+            lines.append(f"{name} = \"{', '.join(value)}\"")
+        else:
+            lines.append(f"{name} = {value}")
+    if "elapsed" in report:
+        lines.append(f"elapsed = {report['elapsed']:.3f}")
+    return lines
+
+def pick_main_branch(branches):
+    """Figure out what we want to call the main branch
+    - if we have "main", use it
+    - if we have "master", use it as main
+    - otherwise, use the first branch"""
+    if len(branches) == 0:
+        return None
+    if 'main' in branches:
+        return 'main'
+    if 'master' in branches:
+        return 'master'
+    return branches[0]
 
 if __name__ == "__main__":
     main()
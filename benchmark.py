@@ -0,0 +1,888 @@
+# benchmark.py
+# - time the tools against a generated fleet of repositories
+#
+#   benchmark.py [--fixtures DIR] [--scale N] [--repeat N] [--output FILE] [--compare FILE] [NAME...]
+#   benchmark.py --check [--fixtures DIR] [--scale N]
+#
+# The fixtures are built with git fast-import from fixed contents, names and dates, so
+# a given scale always produces the same repositories (down to the commit ids). They
+# are kept in the fixtures directory and only rebuilt when their spec changes.
+#
+# Results (every run of every benchmark, plus the git and python versions and the
+# commit being measured) are saved as JSON; --compare shows the change in median
+# time against an earlier results file.
+#
+# --check times nothing: it compares what gitlib reads straight from the repository
+# files (refs, reftables, pack indexes, commit-graphs) with what git says, on the same
+# fixtures, and exits with 1 if anything differs.
+
+# Fixture sizes at --scale 1
+SMALL_REPOS = 100       # small worktrees in the fleet
+NUM_REFS = 100000       # branches + tags in the many-refs repo
+NUM_ROOTS = 200         # unrelated histories merged into one repo, like merge-repos.py output
+DEPTH = 50000           # commits in the deep-history repo
+DIRTY_FILES = 20000     # files in the big dirty worktree
+MERGE_SOURCES = 5       # repos merged by the merge-repos benchmark
+
+RESULTS_VERSION = 1
+
+# Git methods timed on each fixture repo; the ones that need a worktree are skipped
+# on bare repos
+GIT_METHODS = [
+    "branches", "tags", "refs", "remotes", "remote_urls", "stashes", "head_commit", "num_commits",
+    "last_commit_date", "roots", "count_objects", "largest_objects", "uncommitted", "unmerged",
+    "count_unmerged", "count_unpushed", "unpushed", "ahead_behind", "worktrees", "submodules", "hooks",
+    "signature", "dirty_reason", "ls_remote", "unfetched",
+]
+WORKTREE_METHODS = {"uncommitted", "worktrees", "submodules", "dirty_reason", "ls_remote", "unfetched"}
+
+IDENT = "Bench <bench@example.com>"
+EPOCH = 1700000000  # commit dates count up from here, a minute per commit
+
+def main():
+    import argparse
+    import os.path
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help="only run benchmarks whose name starts with one of these")
+    parser.add_argument("--fixtures", default=None, help="where to build the fixtures (default ./bench-fixtures)")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the fixture sizes by this")
+    parser.add_argument("--repeat", type=int, default=3, help="how many times to run each benchmark")
+    parser.add_argument("--jobs", "-j", type=int, default=8, help="jobs for the parallel scan benchmark")
+    parser.add_argument("--output", "-o", default=None, help="results file (default benchmark-<time>.json)")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the fixtures even if they're up to date")
+    parser.add_argument("--check", action="store_true", help="check gitlib's file readers against git instead")
+    args = parser.parse_args()
+
+    fixtures_dir = os.path.abspath(args.fixtures if args.fixtures is not None else "bench-fixtures")
+    fixtures, fixture_seconds = build_fixtures(fixtures_dir, args.scale, args.rebuild)
+
+    if args.check:
+        sys.exit(1 if run_checks(fixtures_dir) > 0 else 0)
+
+    results = run_benchmarks(fixtures_dir, args.repeat, args.jobs, args.names)
+    data = results_header(args.scale, args.repeat, fixtures)
+    data["fixture_seconds"] = fixture_seconds
+    data["results"] = results
+
+    output = args.output
+    if output is None:
+        output = f"benchmark-{data['started'].replace(':', '').replace('-', '')}.json"
+    save_results(output, data)
+    print(f"Saved results to {output}", file=sys.stderr)
+
+    if args.compare is not None:
+        for line in compare(load_results(args.compare), data):
+            print(line)
+
+# ------------------------------------------------------------------------------------------------
+# Fixtures
+# ------------------------------------------------------------------------------------------------
+
+def fixture_specs(scale):
+    """What each fixture should contain at this scale"""
+    def scaled(n):
+        return max(1, int(n * scale))
+
+    return {
+        "fleet": {"repos": scaled(SMALL_REPOS), "commits": 5},
+        "refs": {"refs": scaled(NUM_REFS), "commits": 10},
+        "roots": {"roots": scaled(NUM_ROOTS), "commits": 2},
+        "deep": {"commits": scaled(DEPTH)},
+        "dirty": {"files": scaled(DIRTY_FILES), "modified": max(1, scaled(DIRTY_FILES) // 20),
+                  "untracked": max(1, scaled(DIRTY_FILES) // 20)},
+        "remote": {"commits": 20, "tags": 5},
+        "merge": {"repos": max(2, int(MERGE_SOURCES * min(scale, 1) + 0.5)), "commits": 3},
+    }
+
+def build_fixtures(fixtures_dir, scale, rebuild=False):
+    """Build whatever fixtures are missing or out of date; returns (specs, seconds spent
+    building each one)"""
+    import json
+    import os
+    import os.path
+    import shutil
+    import sys
+    import time
+
+    specs = fixture_specs(scale)
+    os.makedirs(fixtures_dir, exist_ok=True)
+    seconds = dict()
+    for name, spec in specs.items():
+        path = os.path.join(fixtures_dir, name)
+        stamp_path = os.path.join(fixtures_dir, f".{name}.json")
+        try:
+            with open(stamp_path, "r", encoding="utf-8") as f:
+                built = json.load(f)
+        except (OSError, ValueError):
+            built = None
+        if built == spec and os.path.isdir(path) and not rebuild:
+            continue
+
+        print(f"Building fixture {name} {spec}", file=sys.stderr, flush=True)
+        start = time.perf_counter()
+        if os.path.exists(stamp_path):
+            os.unlink(stamp_path)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        FIXTURE_BUILDERS[name](path, spec)
+        seconds[name] = time.perf_counter() - start
+        with open(stamp_path, "w", encoding="utf-8") as f:
+            json.dump(spec, f)
+    return specs, seconds
+
+def build_fleet(path, spec):
+    """Many small worktrees; every fourth one has an uncommitted change"""
+    import os.path
+
+    for i in range(spec["repos"]):
+        repo = os.path.join(path, f"repo{i:04d}")
+        with FastImport(repo) as fi:
+            parent = None
+            for n in range(spec["commits"]):
+                files = [("README", f"repo {i}\n"), (f"src/file{n}.txt", f"{i}:{n}\n")]
+                parent = fi.commit("refs/heads/main", f"commit {n}", files, [parent] if parent else [])
+        checkout(repo)
+        if i % 4 == 0:
+            with open(os.path.join(repo, "README"), "a", encoding="utf-8") as f:
+                f.write("edited\n")
+
+def build_refs(path, spec):
+    """A worktree with a huge number of branches and tags over a short history"""
+    import os.path
+
+    repo = os.path.join(path, "repo")
+    with FastImport(repo) as fi:
+        marks = []
+        for n in range(spec["commits"]):
+            marks.append(fi.commit("refs/heads/main", f"commit {n}", [("file.txt", f"{n}\n")],
+                                   marks[-1:]))
+        for i in range(spec["refs"]):
+            kind = "heads/branch" if i % 2 == 0 else "tags/tag"
+            fi.reset(f"refs/{kind}{i:06d}", marks[i % len(marks)])
+    run_git(repo, ["pack-refs", "--all"])
+    checkout(repo)
+
+def build_roots(path, spec):
+    """A worktree whose main branch merges many unrelated histories, each in its own
+    subdirectory (what merge-repos.py makes without rebasing)"""
+    import os.path
+
+    repo = os.path.join(path, "repo")
+    with FastImport(repo) as fi:
+        main = fi.commit("refs/heads/main", "Create repository", [("README", "monorepo\n")])
+        for r in range(spec["roots"]):
+            tip = None
+            files = []
+            for n in range(spec["commits"]):
+                files = [(f"r{r:04d}/file{n}.txt", f"{r}:{n}\n")]
+                tip = fi.commit(f"refs/heads/orig/r{r:04d}", f"root {r} commit {n}", files, [tip] if tip else [])
+            # the merge brings the root's files along
+            merged = [(f"r{r:04d}/file{n}.txt", f"{r}:{n}\n") for n in range(spec["commits"])]
+            main = fi.commit("refs/heads/main", f"Merge r{r:04d}", merged, [main, tip])
+    checkout(repo)
+
+def build_deep(path, spec):
+    """A worktree with one long linear history"""
+    import os.path
+
+    repo = os.path.join(path, "repo")
+    with FastImport(repo) as fi:
+        parent = None
+        for n in range(spec["commits"]):
+            parent = fi.commit("refs/heads/main", f"commit {n}", [("counter.txt", f"{n}\n")],
+                               [parent] if parent else [])
+    checkout(repo)
+
+def build_dirty(path, spec):
+    """A big worktree with modified and untracked files"""
+    import os
+    import os.path
+
+    repo = os.path.join(path, "repo")
+    names = [f"d{i // 100:04d}/f{i:06d}.txt" for i in range(spec["files"])]
+    with FastImport(repo) as fi:
+        fi.commit("refs/heads/main", "add files", [(name, f"{name}\n") for name in names])
+    checkout(repo)
+    step = max(1, len(names) // spec["modified"])
+    for name in names[::step][:spec["modified"]]:
+        with open(os.path.join(repo, name), "a", encoding="utf-8") as f:
+            f.write("modified\n")
+    for i in range(spec["untracked"]):
+        untracked = os.path.join(repo, f"u{i // 100:04d}", f"new{i:06d}.txt")
+        os.makedirs(os.path.dirname(untracked), exist_ok=True)
+        with open(untracked, "w", encoding="utf-8") as f:
+            f.write("untracked\n")
+
+def build_remote(path, spec):
+    """A bare upstream, a file:// clone with unpushed work (and upstream work it hasn't
+    fetched), and a bare mirror"""
+    import os.path
+
+    upstream = os.path.join(path, "up.git")
+    with FastImport(upstream, bare=True) as fi:
+        marks = []
+        for n in range(spec["commits"]):
+            marks.append(fi.commit("refs/heads/main", f"commit {n}", [("file.txt", f"{n}\n")], marks[-1:]))
+        for t in range(spec["tags"]):
+            fi.reset(f"refs/tags/v{t}", marks[t * len(marks) // spec["tags"]])
+
+    url = "file://" + upstream
+    clone = os.path.join(path, "clone")
+    run_git(None, ["clone", "-q", url, clone])
+    run_git(None, ["clone", "-q", "--bare", url, os.path.join(path, "mirror.git")])
+
+    # local work that isn't pushed
+    run_git(clone, ["checkout", "-q", "-b", "topic"])
+    run_git(clone, ["commit", "-q", "--allow-empty", "-m", "local work"])
+    run_git(clone, ["checkout", "-q", "main"])
+    run_git(clone, ["commit", "-q", "--allow-empty", "-m", "unpushed work"])
+
+    # upstream work that isn't fetched
+    with FastImport(upstream, bare=True, init=False) as fi:
+        fi.commit("refs/heads/main", "upstream work", [("upstream.txt", "new\n")], [f"refs/heads/main^0"])
+
+def build_merge(path, spec):
+    """Small source repos and a merge.ini for merge-repos.py (monorepos are made
+    next to them by the benchmark)"""
+    import os.path
+
+    sources = os.path.join(path, "sources")
+    for i in range(spec["repos"]):
+        repo = os.path.join(sources, f"src{i}")
+        with FastImport(repo) as fi:
+            parent = None
+            for n in range(spec["commits"]):
+                parent = fi.commit("refs/heads/main", f"src{i} commit {n}", [(f"file{n}.txt", f"{i}:{n}\n")],
+                                   [parent] if parent else [])
+            fi.reset(f"refs/tags/v{i}", parent)
+        checkout(repo)
+
+FIXTURE_BUILDERS = {
+    "fleet": build_fleet,
+    "refs": build_refs,
+    "roots": build_roots,
+    "deep": build_deep,
+    "dirty": build_dirty,
+    "remote": build_remote,
+    "merge": build_merge,
+}
+
+class FastImport:
+    """Writes history into a new repository through one `git fast-import`. Commits get
+    marks (returned by commit()) and dates a minute apart, so the result only depends
+    on what's written."""
+
+    def __init__(self, path, bare=False, init=True):
+        import subprocess
+
+        if init:
+            run_git(None, ["init", "-q", "-b", "main"] + (["--bare"] if bare else []) + [path])
+        self.proc = subprocess.Popen(["git", "-C", path, "fast-import", "--quiet", "--done"],
+                                     stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        self.next_mark = 1
+        self.when = EPOCH
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(exc_type is None)
+
+    def write(self, text):
+        self.proc.stdin.write(text.encode("utf-8"))
+
+    def data(self, text):
+        encoded = text.encode("utf-8")
+        self.proc.stdin.write(b"data %d\n" % len(encoded) + encoded + b"\n")
+
+    def commit(self, ref, message, files=(), parents=()):
+        """Add a commit on ref; parents are marks or other commit-ish names (the
+        default is wherever ref already points). Returns the commit's mark."""
+        mark = self.next_mark
+        self.next_mark += 1
+        self.when += 60
+        self.write(f"commit {ref}\nmark :{mark}\n")
+        self.write(f"author {IDENT} {self.when} +0000\ncommitter {IDENT} {self.when} +0000\n")
+        self.data(message + "\n")
+        for i, parent in enumerate(parents):
+            name = f":{parent}" if isinstance(parent, int) else parent
+            self.write(f"{'from' if i == 0 else 'merge'} {name}\n")
+        for path, content in files:
+            self.write(f"M 100644 inline {path}\n")
+            self.data(content)
+        self.write("\n")
+        return mark
+
+    def reset(self, ref, mark):
+        self.write(f"reset {ref}\nfrom :{mark}\n\n")
+
+    def close(self, ok=True):
+        if ok:
+            self.write("done\n")
+        self.proc.stdin.close()
+        if self.proc.wait() != 0 and ok:
+            raise RuntimeError("git fast-import failed")
+
+def checkout(repo):
+    """Fill in the worktree and index for the current branch"""
+    run_git(repo, ["reset", "-q", "--hard"])
+
+def run_git(repo, cmd, input=None):
+    """Run git with a fixed identity and dates; raises RuntimeError if it fails"""
+    import os
+    import subprocess
+
+    env = dict(os.environ)
+    env.update({
+        "GIT_AUTHOR_NAME": "Bench", "GIT_AUTHOR_EMAIL": "bench@example.com",
+        "GIT_COMMITTER_NAME": "Bench", "GIT_COMMITTER_EMAIL": "bench@example.com",
+        "GIT_AUTHOR_DATE": f"{EPOCH} +0000", "GIT_COMMITTER_DATE": f"{EPOCH} +0000",
+    })
+    git_cmd = ["git"] + (["-C", repo] if repo is not None else []) + cmd
+    result = subprocess.run(git_cmd, capture_output=True, text=True, env=env, input=input)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed: {git_cmd}: {result.stderr.strip()}")
+    return result.stdout.splitlines()
+
+# ------------------------------------------------------------------------------------------------
+# Benchmarks
+# ------------------------------------------------------------------------------------------------
+
+def run_benchmarks(fixtures_dir, repeat, jobs, names=()):
+    """Run every benchmark (or the ones named); returns name -> result"""
+    import os.path
+    import sys
+
+    benchmarks = []
+
+    # whole scans
+    benchmarks.append(("scan/fleet", lambda: bench_scan(os.path.join(fixtures_dir, "fleet"), 1)))
+    benchmarks.append((f"scan/fleet-j{jobs}", lambda: bench_scan(os.path.join(fixtures_dir, "fleet"), jobs)))
+    benchmarks.append(("scan/all", lambda: bench_scan(fixtures_dir, 1)))
+    benchmarks.append((f"scan/all-j{jobs}", lambda: bench_scan(fixtures_dir, jobs)))
+    benchmarks.append(("scan/all-dirty-only", lambda: bench_scan(fixtures_dir, 1, dirty_only=True)))
+
+    # one Git method at a time
+    repos = [
+        ("refs", os.path.join(fixtures_dir, "refs", "repo")),
+        ("roots", os.path.join(fixtures_dir, "roots", "repo")),
+        ("deep", os.path.join(fixtures_dir, "deep", "repo")),
+        ("dirty", os.path.join(fixtures_dir, "dirty", "repo")),
+        ("clone", os.path.join(fixtures_dir, "remote", "clone")),
+        ("mirror", os.path.join(fixtures_dir, "remote", "mirror.git")),
+    ]
+    for repo_name, repo_path in repos:
+        for method in GIT_METHODS:
+            benchmarks.append((f"git/{repo_name}/{method}",
+                               lambda repo_path=repo_path, method=method: bench_git_method(repo_path, method)))
+
+    benchmarks.append(("gather/fleet", lambda: bench_gather(os.path.join(fixtures_dir, "fleet"))))
+    benchmarks.append(("merge-repos/run", lambda: bench_merge_repos(os.path.join(fixtures_dir, "merge"))))
+
+    results = dict()
+    for name, bench in benchmarks:
+        if len(names) > 0 and not any(name.startswith(prefix) for prefix in names):
+            continue
+        result = time_benchmark(bench, repeat)
+        results[name] = result
+        if "skipped" in result:
+            print(f"{name}: skipped ({result['skipped']})", file=sys.stderr, flush=True)
+        elif "error" in result:
+            print(f"{name}: error ({result['error']})", file=sys.stderr, flush=True)
+        else:
+            print(f"{name}: median {result['median']:.4f}s, min {result['min']:.4f}s", file=sys.stderr, flush=True)
+    return results
+
+class Skip(Exception):
+    """Raised by a benchmark that can't run here"""
+
+def time_benchmark(bench, repeat):
+    """Run bench repeat times. A benchmark returns the seconds its timed part took
+    (so setup isn't counted)."""
+    import statistics
+
+    runs = []
+    try:
+        for _ in range(repeat):
+            runs.append(bench())
+    except Skip as e:
+        return {"skipped": str(e)}
+    except RuntimeError as e:
+        return {"error": str(e), "runs": runs}
+    return {"runs": runs, "min": min(runs), "median": statistics.median(runs), "max": max(runs)}
+
+def quietly(function, *args):
+    """Call function with stdout and stderr thrown away; returns (seconds, result)"""
+    import contextlib
+    import os
+    import time
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        start = time.perf_counter()
+        result = function(*args)
+        return time.perf_counter() - start, result
+
+def bench_scan(path, jobs, dirty_only=False):
+    import analyze
+
+    seconds, _ = quietly(analyze.scan, path, False, dirty_only, False, jobs)
+    return seconds
+
+def bench_git_method(repo_path, method):
+    import gitlib
+
+    repo = gitlib.Git(repo_path)
+    if method in WORKTREE_METHODS and not repo.is_worktree:
+        raise Skip("needs a worktree")
+    # every fixture's main branch is "main"; asking for the branches would warm the
+    # ref snapshot that the method under test reads
+    repo.main_branch = "main"
+    # each URL is only queried once per process
+    gitlib.remote_queries_instance = None
+    seconds, _ = quietly(getattr(repo, method))
+    return seconds
+
+def bench_gather(path):
+    make_merge_ini = load_script("make-merge-ini.py")
+    seconds, _ = quietly(make_merge_ini.gather, path)
+    return seconds
+
+def bench_merge_repos(path):
+    import configparser
+    import os
+    import os.path
+    import shutil
+    import subprocess
+
+    if subprocess.run(["git", "filter-repo", "--version"], capture_output=True).returncode != 0:
+        raise Skip("git filter-repo is not installed")
+
+    merge_repos = load_script("merge-repos.py")
+    sources = os.path.join(path, "sources")
+    # merge-repos.py makes its temp clones next to the monorepo, so keep it in the fixture
+    monorepo = os.path.join(sources, "monorepo")
+    if os.path.exists(monorepo):
+        shutil.rmtree(monorepo)
+
+    cfg = configparser.ConfigParser()
+    cfg["core"] = {"monorepo": monorepo}
+    for name in sorted(os.listdir(sources)):
+        if name.startswith("src"):
+            cfg[f"repo.{name}"] = {"source": os.path.join(sources, name), "subtree": name, "main": "main"}
+    try:
+        seconds, _ = quietly(merge_repos.run, cfg)
+    finally:
+        shutil.rmtree(monorepo, ignore_errors=True)
+    return seconds
+
+def load_script(filename):
+    """Import one of our hyphenated scripts as a module. It goes in sys.modules, so
+    process pools can find its functions."""
+    import importlib.util
+    import os.path
+    import sys
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    spec = importlib.util.spec_from_file_location(filename[:-3].replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+# ------------------------------------------------------------------------------------------------
+# Checks
+# ------------------------------------------------------------------------------------------------
+
+def run_checks(fixtures_dir):
+    """Compare gitlib's readers of repository files with git on the fixture repos,
+    printing a line per check; returns how many failed"""
+    import os.path
+    import shutil
+    import sys
+    import tempfile
+
+    repos = [
+        ("fleet", os.path.join(fixtures_dir, "fleet", "repo0000")),
+        ("refs", os.path.join(fixtures_dir, "refs", "repo")),
+        ("roots", os.path.join(fixtures_dir, "roots", "repo")),
+        ("deep", os.path.join(fixtures_dir, "deep", "repo")),
+        ("clone", os.path.join(fixtures_dir, "remote", "clone")),
+        ("mirror", os.path.join(fixtures_dir, "remote", "mirror.git")),
+    ]
+    # the checks that need to write get a scratch directory each
+    work_dir = tempfile.mkdtemp(prefix="benchmark-check-")
+    checks = []
+    for repo_name, repo_path in repos:
+        checks.append((f"check/{repo_name}/refs", lambda repo_path=repo_path: check_refs(repo_path)))
+        checks.append((f"check/{repo_name}/reftable",
+                       lambda repo_path=repo_path: check_reftable(repo_path, tempfile.mkdtemp(dir=work_dir))))
+        checks.append((f"check/{repo_name}/git-reftable",
+                       lambda repo_path=repo_path: check_git_reftable(repo_path, tempfile.mkdtemp(dir=work_dir))))
+        checks.append((f"check/{repo_name}/pack-index",
+                       lambda repo_path=repo_path: check_pack_indexes(repo_path, tempfile.mkdtemp(dir=work_dir))))
+        for split in (False, True):
+            checks.append((f"check/{repo_name}/commit-graph{'-chain' if split else ''}",
+                           lambda repo_path=repo_path, split=split:
+                               check_commit_graph(repo_path, tempfile.mkdtemp(dir=work_dir), split)))
+
+    failed = 0
+    try:
+        for name, check in checks:
+            try:
+                problems = check()
+            except Skip as e:
+                print(f"{name}: skipped ({e})", file=sys.stderr, flush=True)
+                continue
+            except (RuntimeError, OSError, ValueError) as e:
+                problems = [f"{type(e).__name__}: {e}"]
+            if len(problems) == 0:
+                print(f"{name}: ok", flush=True)
+                continue
+            failed += 1
+            print(f"{name}: FAILED", flush=True)
+            for line in problems[:20]:
+                print(f"  {line}", flush=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return failed
+
+def differences(what, expected, got):
+    """Lines showing where got differs from expected (both lists of lines)"""
+    import difflib
+
+    if expected == got:
+        return []
+    diff = difflib.unified_diff(expected, got, "git", "gitlib", lineterm="", n=0)
+    return [f"{what} differs:", *list(diff)[2:]]
+
+def common_dir(repo_path):
+    import os.path
+
+    output = run_git(repo_path, ["rev-parse", "--git-common-dir"])
+    return os.path.join(repo_path, output[0])
+
+def check_refs(repo_path):
+    """RefStore against `git show-ref --head`"""
+    import gitlib
+
+    repo = gitlib.Git(repo_path)
+    if repo.refstore is None:
+        return ["gitlib can't read the refs of this repo"]
+    return differences("show-ref --head", run_git(repo_path, ["show-ref", "--head"]), repo.refstore.show_ref())
+
+def check_reftable(repo_path, work_dir):
+    """RefStore on a reftable stack written here from the repo's refs: a table with most
+    of them, then a second one with the rest, a deletion and a peeled update. It's
+    checked against the refs the stack should hold, and against `git show-ref --head`
+    if git can read reftables."""
+    import os
+    import os.path
+
+    import gitlib
+
+    # the refs as git has them, symbolic ones included
+    raw = dict()
+    for line in run_git(repo_path, ["for-each-ref", "--format=%(refname) %(objectname) %(symref)"]):
+        refname, oid, target = line.split(" ")
+        raw[refname] = ("symref", target) if len(target) > 0 else ("oid", oid, None)
+    raw["HEAD"] = ("symref", run_git(repo_path, ["symbolic-ref", "HEAD"])[0])
+
+    names = sorted(raw)
+    split = max(1, len(names) * 3 // 4)
+    first = {refname: raw[refname] for refname in names[:split]}
+    second = {refname: raw[refname] for refname in names[split:]}
+    targets = {value[1] for value in raw.values() if value[0] == "symref"}
+    plain = [refname for refname in names[:split] if raw[refname][0] == "oid" and refname not in targets]
+    expected = dict(raw)
+    if len(plain) >= 2:
+        deleted, updated = plain[0], plain[-1]
+        second[deleted] = None
+        second[updated] = ("oid", raw[updated][1], raw[deleted][1])
+        del expected[deleted]
+        expected[updated] = second[updated]
+
+    gitdir = os.path.join(work_dir, "repo.git")
+    table_dir = os.path.join(gitdir, "reftable")
+    os.makedirs(table_dir)
+    os.makedirs(os.path.join(gitdir, "objects", "info"))
+    with open(os.path.join(gitdir, "objects", "info", "alternates"), "w", encoding="utf-8") as f:
+        f.write(os.path.abspath(os.path.join(common_dir(repo_path), "objects")) + "\n")
+    with open(os.path.join(gitdir, "HEAD"), "w", encoding="utf-8") as f:
+        f.write("ref: refs/heads/.invalid\n")
+    os.makedirs(os.path.join(gitdir, "refs"))
+    with open(os.path.join(gitdir, "refs", "heads"), "w", encoding="utf-8") as f:
+        f.write("this repository uses the reftable format\n")
+    with open(os.path.join(gitdir, "config"), "w", encoding="utf-8") as f:
+        f.write("[core]\n\trepositoryformatversion = 1\n\tbare = true\n[extensions]\n\trefStorage = reftable\n")
+    tables = []
+    for update_index, refs in enumerate([first, second], 1):
+        if len(refs) > 0:
+            tables.append(f"0x{update_index:012x}-0x{update_index:012x}-check.ref")
+            write_reftable(os.path.join(table_dir, tables[-1]), refs, update_index)
+    with open(os.path.join(table_dir, "tables.list"), "w", encoding="utf-8") as f:
+        f.write("".join(f"{table}\n" for table in tables))
+
+    store = gitlib.open_ref_store(gitdir, True)
+    if store is None:
+        return ["gitlib can't read the reftable stack"]
+
+    def resolve(refname):
+        value = expected.get(refname)
+        if value is not None and value[0] == "symref":
+            value = expected.get(value[1])
+        return value
+
+    want = [f"{resolve('HEAD')[1]} HEAD"]
+    want += [f"{resolve(refname)[1]} {refname}" for refname in sorted(expected) if refname.startswith("refs/")]
+    problems = differences("show-ref --head", want, store.show_ref())
+    problems += differences("peeled", [f"{refname} {value[2]}" for refname, value in sorted(expected.items())
+                                       if value[0] == "oid" and value[2] is not None],
+                            [f"{refname} {peeled}" for refname, oid, peeled, target in store.refs() if peeled is not None])
+    if gitlib.find_git_version() >= (2, 45):
+        problems += differences("git show-ref --head", run_git(gitdir, ["show-ref", "--head"]), store.show_ref())
+    return problems
+
+def check_git_reftable(repo_path, work_dir):
+    """RefStore against `git show-ref` on a reftable stack that git wrote (a clone of the
+    repo, then an annotated tag, a symbolic ref and a deletion, each its own table)"""
+    import os.path
+
+    import gitlib
+
+    if gitlib.find_git_version() < (2, 45):
+        raise Skip(f"git {'.'.join(str(part) for part in gitlib.find_git_version())} can't write reftables")
+    gitdir = os.path.join(work_dir, "repo.git")
+    run_git(None, ["clone", "-q", "--bare", "--shared", "--ref-format=reftable", repo_path, gitdir])
+    run_git(gitdir, ["tag", "-a", "-m", "check", "check-annotated", "HEAD"])
+    run_git(gitdir, ["symbolic-ref", "refs/heads/check-alias", "refs/tags/check-annotated"])
+    run_git(gitdir, ["update-ref", "refs/heads/check-deleted", "HEAD"])
+    run_git(gitdir, ["update-ref", "-d", "refs/heads/check-deleted"])
+
+    store = gitlib.Git(gitdir).refstore
+    if store is None:
+        return ["gitlib can't read the reftable stack"]
+    peeled = [line.split(" ")[1][:-3] + " " + line.split(" ")[0]
+              for line in run_git(gitdir, ["show-ref", "-d"]) if line.endswith("^{}")]
+    return (differences("show-ref --head", run_git(gitdir, ["show-ref", "--head"]), store.show_ref()) +
+            differences("peeled", peeled, [f"{refname} {peeled}" for refname, oid, peeled, target in store.refs()
+                                           if peeled is not None]))
+
+def check_pack_indexes(repo_path, work_dir):
+    """PackIndex against `git show-index` for each pack (and a version 1 index of it
+    made with index-pack), including names that aren't in the pack"""
+    import os
+    import os.path
+    import subprocess
+
+    import gitlib
+
+    pack_dir = os.path.join(common_dir(repo_path), "objects", "pack")
+    problems = []
+    for name in sorted(os.listdir(pack_dir)):
+        if not name.endswith(".pack"):
+            continue
+        idx_v1 = os.path.join(work_dir, name[:-5] + ".v1.idx")
+        run_git(repo_path, ["index-pack", "--index-version=1", "-o", idx_v1, os.path.join(pack_dir, name)])
+        for idx in (os.path.join(pack_dir, name[:-5] + ".idx"), idx_v1):
+            with open(idx, "rb") as f:
+                output = subprocess.run(["git", "-C", repo_path, "show-index"], stdin=f, capture_output=True,
+                                        text=True, check=True).stdout
+            oids = [line.split(" ")[1] for line in output.splitlines()]
+            index = gitlib.PackIndex(idx)
+            try:
+                if index.count != len(oids):
+                    problems.append(f"{idx}: {index.count} objects, git says {len(oids)}")
+                present = set(oids)
+                for oid in oids:
+                    if not index.contains(bytes.fromhex(oid)):
+                        problems.append(f"{idx}: {oid} is missing")
+                    # the same name with the last digit changed is (almost always) not there
+                    other = oid[:-1] + ("0" if oid[-1] != "0" else "1")
+                    if other not in present and index.contains(bytes.fromhex(other)):
+                        problems.append(f"{idx}: {other} is found but isn't in the pack")
+            finally:
+                index.close()
+    return problems
+
+def check_commit_graph(repo_path, work_dir, split):
+    """CommitGraphFile against `git rev-list` on a commit-graph git wrote for a clone of
+    the repo with an octopus merge added: one file, or with split=True a chain of two
+    (the older half of the history, then the rest)"""
+    import os
+    import os.path
+    import shutil
+
+    import gitlib
+
+    # git looks for commit-graphs in alternates too, so this clone has its own objects
+    # (hard links), without any commit-graph the repo already had
+    gitdir = os.path.join(work_dir, "repo.git")
+    run_git(None, ["clone", "-q", "--bare", repo_path, gitdir])
+    info_dir = os.path.join(gitdir, "objects", "info")
+    if os.path.exists(os.path.join(info_dir, "commit-graph")):
+        os.unlink(os.path.join(info_dir, "commit-graph"))
+    shutil.rmtree(os.path.join(info_dir, "commit-graphs"), ignore_errors=True)
+    commits = run_git(gitdir, ["rev-list", "--all"])
+    if len(commits) >= 3:
+        tree = run_git(gitdir, ["rev-parse", f"{commits[0]}^{{tree}}"])[0]
+        parents = [commits[0], commits[len(commits) // 2], commits[-1]]
+        octopus = run_git(gitdir, ["commit-tree", tree, "-m", "octopus", *[arg for parent in parents for arg in ("-p", parent)]])[0]
+        run_git(gitdir, ["update-ref", "refs/heads/check-octopus", octopus])
+    if split:
+        run_git(gitdir, ["commit-graph", "write", "--split", "--stdin-commits", "--no-progress"],
+                input=commits[len(commits) // 2] + "\n")
+        run_git(gitdir, ["commit-graph", "write", "--split=no-merge", "--reachable", "--no-progress"])
+    else:
+        run_git(gitdir, ["commit-graph", "write", "--reachable", "--no-progress"])
+
+    want = run_git(gitdir, ["rev-list", "--all", "--no-commit-header", "--format=%H %ct %P"])
+    graph = gitlib.CommitGraphFile(os.path.join(gitdir, "objects"))
+    try:
+        problems = []
+        if split and len(commits) > 1 and len(graph.layers) != 2:
+            problems.append(f"expected a chain of 2 commit-graphs, got {len(graph.layers)}")
+        got = []
+        for pos in range(len(graph)):
+            oid = graph.oid(pos)
+            time, parents = graph.commit(pos)
+            got.append(" ".join([oid.hex(), str(time), *[graph.oid(parent).hex() for parent in parents]]))
+            if graph.position(oid) != pos:
+                problems.append(f"{oid.hex()} is at {pos}, position() says {graph.position(oid)}")
+            generation = graph.generation(pos)
+            expected_generation = 1 + max([graph.generation(parent) for parent in parents], default=0)
+            if generation != 0 and generation != expected_generation:
+                problems.append(f"{oid.hex()} has generation {generation}, expected {expected_generation}")
+        problems += differences("commits", sorted(line.strip() for line in want), sorted(got))
+    finally:
+        graph.close()
+    return problems
+
+def write_reftable(path, refs, update_index, block_size=4096):
+    """Write refs {refname: value, or None for a deletion} as a reftable file with only
+    ref blocks (https://git-scm.com/docs/reftable), all at update_index"""
+    import zlib
+
+    header = b"REFT" + bytes([1]) + block_size.to_bytes(3, "big") + update_index.to_bytes(8, "big") * 2
+
+    def varint(value):
+        encoded = [value & 0x7f]
+        value >>= 7
+        while value > 0:
+            value -= 1
+            encoded.insert(0, 0x80 | (value & 0x7f))
+            value >>= 7
+        return bytes(encoded)
+
+    def record(name, last_name, value):
+        prefix = 0
+        if last_name is not None:
+            while prefix < min(len(name), len(last_name)) and name[prefix] == last_name[prefix]:
+                prefix += 1
+        if value is None:
+            value_type, data = 0, b""
+        elif value[0] == "symref":
+            target = value[1].encode("utf-8")
+            value_type, data = 3, varint(len(target)) + target
+        elif value[2] is None:
+            value_type, data = 1, bytes.fromhex(value[1])
+        else:
+            value_type, data = 2, bytes.fromhex(value[1]) + bytes.fromhex(value[2])
+        return varint(prefix) + varint((len(name) - prefix) << 3 | value_type) + name[prefix:] + varint(0) + data
+
+    # blocks are filled up to block_size, with a restart point (a record with the whole
+    # name) every 16 records; the first block holds the file header too
+    blocks = []
+    body, restarts, count, last_name = bytearray(), [], 0, None
+    for refname in sorted(refs, key=lambda refname: refname.encode("utf-8")):
+        name = refname.encode("utf-8")
+        for attempt in range(2):
+            start = (len(header) if len(blocks) == 0 else 0) + 4
+            restart = count % 16 == 0
+            data = record(name, None if restart else last_name, refs[refname])
+            if count == 0 or start + len(body) + len(data) + 3 * (len(restarts) + restart) + 2 <= block_size:
+                break
+            blocks.append(ref_block(body, restarts, len(blocks) == 0, block_size))
+            body, restarts, count, last_name = bytearray(), [], 0, None
+        if restart:
+            restarts.append(start + len(body))
+        body += data
+        count += 1
+        last_name = name
+    blocks.append(ref_block(body, restarts, len(blocks) == 0, block_size))
+
+    footer = header + bytes(40)
+    footer += zlib.crc32(footer).to_bytes(4, "big")
+    with open(path, "wb") as f:
+        f.write(header + b"".join(blocks) + footer)
+
+def ref_block(body, restarts, first, block_size):
+    """A ref block ("r", its length, the records and the restart table), padded with
+    zeros to block_size. The length of the first block counts the file header."""
+    header_len = 24 if first else 0
+    block_len = header_len + 4 + len(body) + 3 * len(restarts) + 2
+    block = b"r" + block_len.to_bytes(3, "big") + bytes(body)
+    block += b"".join(offset.to_bytes(3, "big") for offset in restarts) + len(restarts).to_bytes(2, "big")
+    return block + bytes(block_size - header_len - len(block))
+
+# ------------------------------------------------------------------------------------------------
+# Results
+# ------------------------------------------------------------------------------------------------
+
+def results_header(scale, repeat, fixtures):
+    import datetime
+    import os.path
+    import platform
+    import subprocess
+
+    import gitlib
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    commit = subprocess.run(["git", "-C", here, "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    return {
+        "version": RESULTS_VERSION,
+        "started": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "commit": commit or None,
+        "git": ".".join(str(part) for part in gitlib.find_git_version()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": scale,
+        "repeat": repeat,
+        "fixtures": fixtures,
+    }
+
+def save_results(path, data):
+    import json
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1)
+
+def load_results(path):
+    import json
+
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("version") != RESULTS_VERSION:
+        raise RuntimeError(f"{path} has results version {data.get('version')}, expected {RESULTS_VERSION}")
+    return data
+
+def compare(old, new):
+    """Lines comparing the median times of the benchmarks both runs have"""
+    lines = [f"{'benchmark':<40} {'before':>9} {'after':>9} {'change':>8}"]
+    if old.get("scale") != new.get("scale"):
+        lines.insert(0, f"warning: scale was {old.get('scale')}, now {new.get('scale')}")
+    for name, result in new["results"].items():
+        before = old["results"].get(name, {}).get("median")
+        after = result.get("median")
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before > 0 else 0.0
+        lines.append(f"{name:<40} {before:>9.4f} {after:>9.4f} {change:>+7.1f}%")
+    return lines
+
+if __name__ == "__main__":
+    main()
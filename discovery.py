@@ -0,0 +1,289 @@
+# discovery.py
+# - find the git repositories under a directory
+
+def find_repos(base_path, exclude=(), max_depth=None, min_depth=0, follow_symlinks=False, jobs=1, index=None):
+    """Yield (path, kind) for each repository under base_path, where kind is "worktree"
+    (a directory with a .git directory), "gitlink" (a directory with a .git file, like a
+    linked worktree) or "bare". We don't look inside repositories.
+
+    Paths are os.path.join(base_path, ...), and come out in sorted depth-first order
+    whatever the value of jobs. With jobs > 1, sibling directories are listed in
+    parallel on a thread pool while we work through the tree.
+
+    exclude is a list of glob patterns, matched against directory names and against
+    paths relative to base_path (with / separators). Excluded directories are skipped
+    entirely. max_depth limits how far below base_path we look (base_path is depth 0),
+    and repos shallower than min_depth aren't reported (we keep looking inside them).
+    Symlinked directories are only followed with follow_symlinks=True, in which case a
+    directory we've already been in is not entered again.
+
+    With a DiscoveryIndex, directories that haven't changed since the last scan aren't
+    listed again.
+    """
+    import concurrent.futures
+    import os
+
+    pool = None
+    if jobs > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+    def start(path, relpath, depth):
+        if pool is None:
+            return (path, relpath, depth)
+        return pool.submit(list_dir, path, relpath, depth, exclude, max_depth, min_depth, follow_symlinks, index)
+
+    # The stack holds directories in the order we'll report them; with a pool, they
+    # are already being listed by the time we get to them
+    visited = set()
+    if follow_symlinks:
+        try:
+            st = os.stat(base_path)
+            visited.add((st.st_dev, st.st_ino))
+        except OSError:
+            pass
+    if index is not None:
+        index.scanning(base_path)
+    stack = [start(base_path, "", 0)]
+    try:
+        while len(stack) > 0:
+            item = stack.pop()
+            if pool is None:
+                path, kind, children = list_dir(*item, exclude, max_depth, min_depth, follow_symlinks, index)
+            else:
+                path, kind, children = item.result()
+
+            if kind is not None:
+                yield path, kind
+                continue
+
+            pending = []
+            for child_path, child_relpath, child_depth, key in children:
+                if key is not None:
+                    if key in visited:
+                        continue
+                    visited.add(key)
+                pending.append(start(child_path, child_relpath, child_depth))
+            stack.extend(reversed(pending))
+    finally:
+        if pool is not None:
+            # stopped early: don't list what's left (cancel_futures needs 3.9)
+            for item in stack:
+                item.cancel()
+            pool.shutdown(wait=False)
+
+def list_dir(path, relpath, depth, exclude, max_depth, min_depth, follow_symlinks, index=None):
+    """Look at one directory: returns (path, kind, children), where kind is the kind of
+    repository at path (or None), and children is a sorted list of (path, relpath,
+    depth, key) for the subdirectories to look at next. key is the (st_dev, st_ino) of
+    the subdirectory when following symlinks (for loop detection), otherwise None."""
+    import fnmatch
+    import os
+    import os.path
+
+    if index is not None:
+        kind, subdirs = index.read_dir(path)
+    else:
+        kind, subdirs = read_dir(path)
+
+    if kind is not None and depth >= min_depth:
+        return path, kind, []
+
+    if max_depth is not None and depth >= max_depth:
+        return path, None, []
+
+    children = []
+    for name, is_symlink in subdirs:
+        if is_symlink and not follow_symlinks:
+            continue
+        child_relpath = f"{relpath}/{name}" if relpath else name
+        if any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(child_relpath, pattern) for pattern in exclude):
+            continue
+        child_path = os.path.join(path, name)
+        key = None
+        if follow_symlinks:
+            try:
+                st = os.stat(child_path)
+            except OSError:
+                continue
+            key = (st.st_dev, st.st_ino)
+        children.append((child_path, child_relpath, depth + 1, key))
+    return path, None, children
+
+def read_dir(path):
+    """Return (kind, subdirs) for a directory: kind is the kind of repository it is (or
+    None), and subdirs is a sorted list of [name, is_symlink] for its subdirectories
+    (including symlinks to directories), leaving out .git"""
+    import os
+
+    kind = None
+    has_head = False
+    has_objects = False
+    has_refs = False
+    subdirs = []
+
+    # DirEntry caches the file type from the directory listing, so in most cases this
+    # needs no stat calls at all
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                name = entry.name
+                try:
+                    if name == ".git":
+                        if entry.is_dir():
+                            kind = "worktree"
+                        elif entry.is_file() and is_gitlink(entry.path):
+                            kind = "gitlink"
+                        continue
+                    if name == "HEAD":
+                        has_head = entry.is_file()
+                    elif name == "objects":
+                        has_objects = entry.is_dir()
+                    elif name == "refs":
+                        has_refs = entry.is_dir()
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append([name, False])
+                    elif entry.is_symlink() and entry.is_dir():
+                        subdirs.append([name, True])
+                except OSError:
+                    pass
+    except OSError:
+        return None, []
+
+    # the same test git uses to recognize a repository directory
+    if kind is None and has_head and has_objects and has_refs:
+        kind = "bare"
+    subdirs.sort()
+    return kind, subdirs
+
+def is_gitlink(path):
+    """True if path is a .git file pointing at a gitdir"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read(8) == "gitdir: "
+    except (OSError, ValueError):
+        return False
+
+# ------------------------------------------------------------------------------------------------
+# Remembering directory listings between scans
+# ------------------------------------------------------------------------------------------------
+
+# Bump this when the shape of index entries changes
+INDEX_VERSION = 1
+
+def default_index_path():
+    import os.path
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "git-tools", "discovery-index.json")
+
+class DiscoveryIndex:
+    """On-disk record of what read_dir() found in each directory, with the directory's
+    mtime. Adding, removing or renaming anything in a directory (including making it a
+    repo) changes its mtime, so while the mtime is the same, the old listing is still
+    right and a stat replaces the scandir. Listings taken within a couple of seconds of
+    the directory changing aren't trusted, since a later change could keep the same
+    mtime (like git's racy index entries).
+
+    Every directory is still stat'ed, so this only wins where a stat is much cheaper
+    than a listing; analyze uses it with --use-index. With refresh=True, existing entries
+    are ignored but the new ones are still saved. Entries for directories under a
+    scanned path that the scan didn't reach are dropped on save, and the file is only
+    rewritten if some entry changed. Safe to use from several threads.
+    """
+
+    RACY_NS = 2 * 1000 * 1000 * 1000
+
+    def __init__(self, path=None, refresh=False):
+        import threading
+
+        self.path = path if path is not None else default_index_path()
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.dirs = dict()
+        self.visited = set()
+        self.bases = []
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+        self.load()
+
+    def load(self):
+        import json
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if data.get("version") == INDEX_VERSION:
+            self.dirs = data.get("dirs", dict())
+
+    def save(self):
+        import json
+        import os
+        import tempfile
+
+        with self.lock:
+            # forget directories that were under a scanned path but weren't seen this time
+            dirs = dict()
+            for path, entry in self.dirs.items():
+                if path in self.visited or not any(is_under(path, base) for base in self.bases):
+                    dirs[path] = entry
+            if len(dirs) != len(self.dirs):
+                self.changed = True
+            self.dirs = dirs
+            if not self.changed:
+                return
+            self.changed = False
+            data = {"version": INDEX_VERSION, "dirs": self.dirs}
+
+        index_dir = os.path.dirname(self.path)
+        os.makedirs(index_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=index_dir, prefix=".discovery-index-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def scanning(self, base_path):
+        import os.path
+
+        with self.lock:
+            self.bases.append(os.path.abspath(base_path))
+
+    def read_dir(self, path):
+        """Same as read_dir(path), from the index when the directory hasn't changed"""
+        import os
+        import os.path
+        import time
+
+        key = os.path.abspath(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None, []
+
+        with self.lock:
+            self.visited.add(key)
+            entry = self.dirs.get(key)
+            if not self.refresh and entry is not None and entry["mtime"] == mtime:
+                self.hits += 1
+                return entry["kind"], entry["subdirs"]
+            self.misses += 1
+
+        kind, subdirs = read_dir(path)
+        if time.time_ns() - mtime >= self.RACY_NS:
+            entry = {"mtime": mtime, "kind": kind, "subdirs": subdirs}
+            with self.lock:
+                if self.dirs.get(key) != entry:
+                    self.dirs[key] = entry
+                    self.changed = True
+        return kind, subdirs
+
+def is_under(path, base):
+    import os.path
+
+    return path == base or path.startswith(base.rstrip(os.sep) + os.sep)
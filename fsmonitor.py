@@ -0,0 +1,452 @@
+# fsmonitor.py
+# - a file-watcher for git's core.fsmonitor hook, so git status doesn't have to look at
+#   every file in a big worktree (Linux only, uses inotify via ctypes)
+#
+# Used by gitlib in large-worktree mode. Two commands:
+#   fsmonitor.py watch <worktree> <gitdir>
+#     watch the worktree and append every changed path to a journal
+#   fsmonitor.py query <worktree> <gitdir> <version> <token>
+#     the hook itself (git appends version and token): print a new token and the
+#     paths changed since the given one, starting the watcher if it isn't running
+#
+# The journal and the watcher's state live in <gitdir>/fsmonitor-py. Tokens look like
+# "py:<session>:<offset>". A new session starts whenever the watcher can't vouch for
+# what happened since the old token (it just started, or events were lost), and then
+# the hook answers "/", which tells git to look at everything.
+#
+# Before reading the journal, the hook syncs with the watcher (like watchman's cookies):
+# it creates a file in fsmonitor-py/cookies, which the watcher watches on the same
+# inotify queue as the worktree, and waits for the watcher to delete it. By then every
+# change made before the cookie is in the journal. If the watcher doesn't answer in
+# time, the hook says "/".
+
+# Watchers exit when nobody has queried them for this long (seconds)
+IDLE_TIMEOUT = 3600
+
+# Start a new session (and an empty journal) when the journal gets this big
+MAX_JOURNAL = 16 * 1024 * 1024
+
+# How long the hook waits for the watcher to catch up (seconds)
+COOKIE_TIMEOUT = 1.0
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_EXCL_UNLINK = 0x4000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_EXCL_UNLINK)
+
+def main():
+    import sys
+
+    if len(sys.argv) >= 4 and sys.argv[1] == "watch":
+        watch(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) >= 5 and sys.argv[1] == "query":
+        token = sys.argv[5] if len(sys.argv) >= 6 else ""
+        sys.stdout.buffer.write(query(sys.argv[2], sys.argv[3], sys.argv[4], token))
+    else:
+        print("usage: fsmonitor.py watch <worktree> <gitdir>", file=sys.stderr)
+        print("       fsmonitor.py query <worktree> <gitdir> <version> <token>", file=sys.stderr)
+        sys.exit(2)
+
+def available():
+    """True if we can watch files on this system"""
+    import sys
+
+    return sys.platform.startswith("linux") and load_libc() is not None
+
+def hook_command(worktree, gitdir):
+    """The core.fsmonitor command for a worktree (git appends version and token)"""
+    import os.path
+    import shlex
+    import sys
+
+    script = os.path.abspath(__file__)
+    return " ".join(shlex.quote(arg) for arg in [sys.executable, script, "query", worktree, gitdir])
+
+# ------------------------------------------------------------------------------------------------
+# The hook
+# ------------------------------------------------------------------------------------------------
+
+def query(worktree, gitdir, version, token):
+    """Return the hook's output as bytes"""
+    import os
+    import os.path
+
+    # we only speak version 2; for version 1, say everything changed
+    if version != "2":
+        return b"/\0"
+
+    state_dir = os.path.join(gitdir, "fsmonitor-py")
+    os.makedirs(state_dir, exist_ok=True)
+    touch(os.path.join(state_dir, "last-query"))
+
+    state = read_state(state_dir)
+    if state is None or not watcher_running(state_dir):
+        start_watcher(worktree, gitdir)
+        return b"py:none:0\0/\0"
+
+    synced = sync_with_watcher(state_dir)
+
+    # the session may have started over while we waited
+    state = read_state(state_dir)
+    if state is None:
+        return b"py:none:0\0/\0"
+    session = state["session"]
+    journal_path = os.path.join(state_dir, "journal")
+    parts = token.split(":")
+    try:
+        with open(journal_path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return b"py:none:0\0/\0"
+
+    # a record being appended right now is left for next time
+    end = data.rfind(b"\0") + 1
+    new_token = f"py:{session}:{end}".encode("utf-8")
+
+    if not synced or len(parts) != 3 or parts[0] != "py" or parts[1] != session or not parts[2].isdigit() or int(parts[2]) > end:
+        return new_token + b"\0/\0"
+
+    paths = []
+    seen = set()
+    for path in data[int(parts[2]):end].split(b"\0"):
+        if len(path) > 0 and path not in seen:
+            seen.add(path)
+            paths.append(path)
+    return new_token + b"\0" + b"".join(path + b"\0" for path in paths)
+
+def sync_with_watcher(state_dir):
+    """Make a cookie and wait for the watcher to delete it; True if it did in time"""
+    import os
+    import os.path
+    import time
+
+    path = os.path.join(state_dir, "cookies", f"{os.getpid()}-{time.monotonic_ns()}")
+    try:
+        with open(path, "x"):
+            pass
+    except OSError:
+        return False  # no cookies directory: a watcher that doesn't know about them
+
+    deadline = time.monotonic() + COOKIE_TIMEOUT
+    while time.monotonic() < deadline:
+        if not os.path.exists(path):
+            return True
+        time.sleep(0.002)
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    return False
+
+def read_state(state_dir):
+    import json
+    import os.path
+
+    try:
+        with open(os.path.join(state_dir, "state"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def watcher_running(state_dir):
+    """True if a watcher holds the lock"""
+    import fcntl
+    import os
+    import os.path
+
+    fd = os.open(os.path.join(state_dir, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+def start_watcher(worktree, gitdir):
+    import os
+    import os.path
+    import subprocess
+    import sys
+    import time
+
+    if not available():
+        return
+    try:
+        if time.time() - os.stat(os.path.join(gitdir, "fsmonitor-py", "failed")).st_mtime < IDLE_TIMEOUT:
+            return
+    except OSError:
+        pass
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "watch", worktree, gitdir],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+def touch(path):
+    import os
+
+    with open(path, "a"):
+        pass
+    os.utime(path)
+
+# ------------------------------------------------------------------------------------------------
+# The watcher
+# ------------------------------------------------------------------------------------------------
+
+libc = None
+
+def load_libc():
+    import ctypes
+    import ctypes.util
+
+    global libc
+    if libc is None:
+        try:
+            lib = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            lib.inotify_init1
+            lib.inotify_add_watch
+        except (OSError, AttributeError):
+            return None
+        lib.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc = lib
+    return libc
+
+def inotify_init():
+    """Return a new inotify file descriptor"""
+    import ctypes
+
+    fd = load_libc().inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    return fd
+
+def add_watch(fd, path, mask):
+    """Watch path (str or bytes); returns the watch descriptor, or None if path can't be
+    watched (it's gone, say). Running out of watches raises OSError."""
+    import ctypes
+    import os
+
+    wd = load_libc().inotify_add_watch(fd, os.fsencode(path), mask)
+    if wd < 0:
+        if ctypes.get_errno() == 28:  # ENOSPC: out of watches
+            raise OSError("out of inotify watches (see fs.inotify.max_user_watches)")
+        return None
+    return wd
+
+def read_events(fd):
+    """Read what's waiting on an inotify fd; returns a list of (wd, mask, name)"""
+    import os
+    import struct
+
+    data = os.read(fd, 256 * 1024)
+    events = []
+    pos = 0
+    while pos + 16 <= len(data):
+        wd, mask, cookie, length = struct.unpack_from("iIII", data, pos)
+        events.append((wd, mask, data[pos + 16:pos + 16 + length].rstrip(b"\0")))
+        pos += 16 + length
+    return events
+
+class Watcher:
+    """Keeps inotify watches on every directory of a worktree (except .git) and writes
+    changed paths, relative to the worktree, to the journal"""
+
+    def __init__(self, worktree, gitdir):
+        import os
+        import os.path
+
+        self.worktree = os.fsencode(os.path.abspath(worktree))
+        self.state_dir = os.path.join(gitdir, "fsmonitor-py")
+        self.journal_path = os.path.join(self.state_dir, "journal")
+        self.cookie_dir = os.path.join(self.state_dir, "cookies")
+        self.fd = None
+        self.dirs = dict()  # watch descriptor -> path relative to the worktree (b"" for the top)
+        self.cookie_wd = None
+        self.journal = None
+        self.session = None
+
+    def run(self):
+        import fcntl
+        import os
+        import os.path
+        import select
+
+        os.makedirs(self.state_dir, exist_ok=True)
+        lock_fd = os.open(os.path.join(self.state_dir, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return  # someone else is already watching
+
+        try:
+            self.new_session()
+            while True:
+                ready, _, _ = select.select([self.fd], [], [], 60)
+                if len(ready) > 0:
+                    self.read_events()
+                elif self.idle():
+                    break
+                if not os.path.isdir(os.fsdecode(self.worktree)):
+                    break
+        finally:
+            try:
+                os.unlink(os.path.join(self.state_dir, "state"))
+            except OSError:
+                pass
+            os.close(lock_fd)
+
+    def idle(self):
+        import os
+        import os.path
+        import time
+
+        try:
+            last_query = os.stat(os.path.join(self.state_dir, "last-query")).st_mtime
+        except OSError:
+            return True
+        return time.time() - last_query > IDLE_TIMEOUT
+
+    def new_session(self):
+        """Start over: fresh watches and an empty journal. Tokens from before this point
+        get "/" (look at everything), since we can't say what changed."""
+        import json
+        import os
+        import tempfile
+        import uuid
+
+        # nobody may trust the old session while the journal is reset
+        try:
+            os.unlink(os.path.join(self.state_dir, "state"))
+        except OSError:
+            pass
+        if self.fd is not None:
+            os.close(self.fd)
+        if self.journal is not None:
+            self.journal.close()
+
+        self.fd = inotify_init()
+        self.dirs = dict()
+        self.journal = open(self.journal_path, "wb", buffering=0)
+        os.makedirs(self.cookie_dir, exist_ok=True)
+        self.cookie_wd = add_watch(self.fd, self.cookie_dir, IN_CREATE | IN_ONLYDIR)
+
+        # Only once every directory is watched can we vouch for changes
+        self.add_tree(b"")
+        self.session = uuid.uuid4().hex[:12]
+        fd, temp_path = tempfile.mkstemp(dir=self.state_dir, prefix=".state-")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"session": self.session, "pid": os.getpid()}, f)
+        os.replace(temp_path, os.path.join(self.state_dir, "state"))
+
+        # hooks waiting on cookies from before can go ahead; they'll see the new session
+        for name in os.listdir(self.cookie_dir):
+            self.remove_cookie(name)
+
+    def remove_cookie(self, name):
+        import os
+
+        try:
+            os.unlink(os.path.join(os.fsencode(self.cookie_dir), os.fsencode(name)))
+        except OSError:
+            pass
+
+    def add_tree(self, relpath):
+        """Watch relpath and every directory below it; returns the paths found inside
+        (so a directory that appears along with its contents gets reported in full)"""
+        import os
+
+        found = []
+        stack = [relpath]
+        while len(stack) > 0:
+            rel = stack.pop()
+            path = os.path.join(self.worktree, rel) if rel else self.worktree
+            wd = add_watch(self.fd, path, WATCH_MASK)
+            if wd is None:
+                continue
+            self.dirs[wd] = rel
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.name == b".git":
+                            continue
+                        child = os.path.join(rel, entry.name) if rel else entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(child)
+                            found.append(child + b"/")
+                        else:
+                            found.append(child)
+            except OSError:
+                pass
+        return found
+
+    def read_events(self):
+        import os
+
+        paths = []
+        cookies = []
+        for wd, mask, name in read_events(self.fd):
+            if mask & IN_Q_OVERFLOW:
+                self.new_session()
+                return
+            if wd == self.cookie_wd:
+                if len(name) > 0:
+                    cookies.append(name)
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            rel = self.dirs.get(wd)
+            if rel is None:
+                continue
+            if len(name) == 0:
+                # the directory itself
+                if len(rel) > 0:
+                    paths.append(rel + b"/")
+                continue
+            if rel == b"" and name == b".git":
+                continue
+
+            path = os.path.join(rel, name) if rel else name
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                # the watches below it now have the wrong paths
+                self.new_session()
+                return
+            if mask & IN_ISDIR:
+                paths.append(path + b"/")
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    paths.extend(self.add_tree(path))
+            else:
+                paths.append(path)
+
+        # everything that happened before a cookie is journaled before it goes
+        if len(paths) > 0:
+            self.journal.write(b"".join(path + b"\0" for path in paths))
+        for name in cookies:
+            self.remove_cookie(name)
+        if self.journal.tell() > MAX_JOURNAL:
+            self.new_session()
+
+def watch(worktree, gitdir):
+    import os.path
+
+    try:
+        Watcher(worktree, gitdir).run()
+    except OSError:
+        # don't keep starting watchers that can't work (e.g. out of inotify watches)
+        touch(os.path.join(gitdir, "fsmonitor-py", "failed"))
+
+if __name__ == '__main__':
+    main()
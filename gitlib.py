@@ -3,27 +3,83 @@
 
 VERBOSE = 0
 
+# Remember query results on Git objects until the repository changes (see memoized)
+# - MEMO = 0 runs every query afresh
+# - SHARED_MEMO = 1 shares remembered results between Git objects for the same repository
+MEMO = 1
+SHARED_MEMO = 0
+
+shared_memos = dict()  # gitdir path -> [fingerprint, memo]
+shared_memos_lock = None
+
+# Large-worktree mode: for worktrees whose index has at least LARGE_INDEX_ENTRIES
+# entries, run status with the untracked cache, parallel index checks and a file
+# watcher (see Git.status_options). Off by default, since it writes extensions into
+# the index and leaves a watcher process running per worktree.
+LARGE_WORKTREE = 0
+LARGE_INDEX_ENTRIES = 20000
+
+# Print git errors as they happen (to stdout, along with the report). They are also
+# kept in Git.errors either way, for callers that report them some other way.
+PRINT_ERRORS = 1
+
 git_exe = None  # cached git executable path (speeds up repeated calls on Windows)
+git_version = None  # cached git version as a tuple of ints
+
+def memoized(method):
+    """Decorator for read-only Git queries: the result is remembered (see Git.memo_table)
+    and handed back again until the repository changes. Results must not be modified
+    by callers."""
+    import functools
+    import inspect
+
+    name = method.__name__
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not MEMO:
+            return method(self, *args, **kwargs)
+        # f(5), f(5, False) and f(k=5) are the same query
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (name, tuple(bound.arguments.items())[1:], self.main_branch)
+        memo = self.memo_table()
+        if key not in memo:
+            memo[key] = method(self, *args, **kwargs)
+        return memo[key]
+    return wrapper
 
 class Git:
     def __init__(self, gitdir=None):
-        import re
-
         self.gitdir = gitdir
+        self.errors = []
 
-        # test if we are inside a git worktree
-        self.is_worktree = self.is_inside_worktree()
+        # are we inside a git worktree, or if not, maybe a bare repo? (one rev-parse
+        # answers both)
+        self.is_worktree, self.is_bare_repo = self.repo_kind()
 
-        # if we are not inside a git worktree, maybe a bare repo?
-        self.is_bare_repo = False if self.is_worktree else self.is_bare_repository()
-
-        # set up regex that we might need
-        self.re_worktree = re.compile(r'(.+) ([a-fA-F0-9]{7,}) \[([^]]+)\]( prunable)?')
-        self.re_ls_remote = re.compile(r'([a-fA-F0-9]+)\s+(.+)')
+        # Read refs and remotes straight from the repository files when we can
+        self.refstore = None
+        if self.is_worktree or self.is_bare_repo:
+            self.refstore = open_ref_store(gitdir, self.is_bare_repo)
 
         # Some information we cache
         self.main_branch = None
         self.remote_names = None
+        self.dirs = None
+        self.status_info = None
+        self.memo = dict()
+        self.memo_fingerprint = None
+        self.batch_fingerprint = None  # (fingerprint,) inside query_batch()
+
+    def repo_kind(self):
+        """Return (is_worktree, is_bare_repo) from a single rev-parse"""
+        output = self.run_git_cmd(["rev-parse", "--is-inside-work-tree", "--is-bare-repository"])
+        if output is None or len(output) < 2:
+            return False, False
+        is_worktree = output[0] == 'true'
+        return is_worktree, not is_worktree and output[1] == 'true'
 
     def is_inside_worktree(self):
         output = self.run_git_cmd(["rev-parse", "--is-inside-work-tree"])
@@ -42,18 +98,243 @@ class Git:
     # --------------------------------------------------------------------------------------------
 
     def fetch_remotes(self):
+        if self.remote_names is None:
+            if self.refstore is not None:
+                self.remote_names = self.refstore.remote_names()
+            else:
+                self.remote_names = self.ref_snapshot().remote_names()
         if self.remote_names is None:
             output = self.run_git_cmd(["remote"])
             self.remote_names = []
             for remote_name in output:
                 self.remote_names.append(remote_name)
 
+    def ref_snapshot(self):
+        """Return the RefSnapshot for this repository, reading it on first use"""
+        memo = self.memo_table()
+        if ("ref_snapshot",) not in memo:
+            memo[("ref_snapshot",)] = RefSnapshot(self)
+        return memo[("ref_snapshot",)]
+
+    def commit_graph(self):
+        """Return the CommitGraph for this repository, reading it on first use"""
+        memo = self.memo_table()
+        if ("commit_graph",) not in memo:
+            memo[("commit_graph",)] = CommitGraph(self)
+        return memo[("commit_graph",)]
+
+    def has_commit_graph(self):
+        """True if the CommitGraph has already been read"""
+        return ("commit_graph",) in self.memo_table()
+
+    def history_rewritten(self):
+        """True if grafts, replace refs or a shallow clone make git show a different
+        history than a commit-graph file records"""
+        import os.path
+
+        dirs = self.git_dirs()
+        if dirs is None:
+            return False
+        commondir = dirs[1]
+        if os.path.exists(os.path.join(commondir, "shallow")) or os.path.exists(os.path.join(commondir, "info", "grafts")):
+            return True
+        return any(refname.startswith("refs/replace/") for refname, oid, peeled, target in self.ref_tips())
+
+    def memo_table(self):
+        """The dict of remembered results (including the RefSnapshot and CommitGraph).
+        It is emptied whenever stat_fingerprint() changes, which covers everything
+        memoized queries depend on; inside a query_batch() that's checked once. The
+        worktree itself is not covered, so status queries are never memoized. With
+        SHARED_MEMO, Git objects for the same repository share one table."""
+        import os.path
+        import threading
+
+        global shared_memos_lock
+
+        if self.batch_fingerprint is not None:
+            fingerprint = self.batch_fingerprint[0]
+        else:
+            fingerprint = self.stat_fingerprint()
+        if fingerprint is None:
+            # we can't tell when the repository changes, so keep results for the life of
+            # this object (as we always used to)
+            return self.memo
+
+        if SHARED_MEMO:
+            if shared_memos_lock is None:
+                shared_memos_lock = threading.Lock()
+            key = os.path.normcase(os.path.abspath(self.dirs[0]))
+            with shared_memos_lock:
+                entry = shared_memos.get(key)
+                if entry is None or entry[0] != fingerprint:
+                    entry = [fingerprint, dict()]
+                    shared_memos[key] = entry
+                if self.memo is not entry[1]:
+                    self.memo = entry[1]
+                    self.remote_names = None
+                return self.memo
+
+        if fingerprint != self.memo_fingerprint:
+            self.memo = dict()
+            self.memo_fingerprint = fingerprint
+            self.remote_names = None
+        return self.memo
+
+    def query_batch(self):
+        """A context manager for a run of queries that make up one answer, like a report:
+        the repository is taken not to change inside it, so stat_fingerprint() is read
+        once on entry instead of on every memoized call. Batches can nest."""
+        import contextlib
+
+        @contextlib.contextmanager
+        def batch():
+            outer = self.batch_fingerprint
+            if outer is None:
+                self.batch_fingerprint = (self.stat_fingerprint(),)
+            try:
+                yield self
+            finally:
+                self.batch_fingerprint = outer
+        return batch()
+
+    def git_dirs(self):
+        """Return (gitdir, commondir) as paths, or None if this isn't a repository"""
+        import os.path
+
+        if self.dirs is None:
+            if self.refstore is not None:
+                self.dirs = (self.refstore.gitdir, self.refstore.commondir)
+            elif self.is_worktree or self.is_bare_repo:
+                output = self.run_git_cmd(["rev-parse", "--absolute-git-dir", "--git-common-dir"], quiet=True)
+                if output is not None and len(output) == 2:
+                    self.dirs = (output[0], os.path.join(self.gitdir or ".", output[1]))
+        return self.dirs
+
+    def stat_fingerprint(self):
+        """Stat info for HEAD, the index, config, packed-refs, the stash reflog, each
+        linked worktree's HEAD and gitdir file, and every directory under refs/ (loose
+        refs are written by renaming, which changes the directory), or None if we don't
+        know where the repository is"""
+        import os
+        import os.path
+
+        dirs = self.git_dirs()
+        if dirs is None:
+            return None
+        gitdir, commondir = dirs
+
+        paths = [
+            os.path.join(gitdir, "HEAD"),
+            os.path.join(gitdir, "index"),
+            os.path.join(gitdir, "config.worktree"),
+            os.path.join(commondir, "config"),
+            os.path.join(commondir, "packed-refs"),
+            os.path.join(commondir, "logs", "refs", "stash"),
+            os.path.join(commondir, "reftable"),
+            os.path.join(commondir, "worktrees"),
+        ]
+        ref_dirs = [os.path.join(commondir, "refs")]
+        if gitdir != commondir:
+            ref_dirs.append(os.path.join(gitdir, "refs"))
+            paths.append(os.path.join(gitdir, "reftable"))
+            paths.append(os.path.join(commondir, "HEAD"))
+
+        # the other worktrees' HEADs are tips too, and worktrees() shows them
+        try:
+            with os.scandir(os.path.join(commondir, "worktrees")) as it:
+                for entry in sorted(it, key=lambda entry: entry.name):
+                    paths.append(os.path.join(entry.path, "HEAD"))
+                    paths.append(os.path.join(entry.path, "gitdir"))
+        except OSError:
+            pass
+
+        fingerprint = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                fingerprint.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            except OSError:
+                fingerprint.append(None)
+
+        while len(ref_dirs) > 0:
+            path = ref_dirs.pop()
+            try:
+                fingerprint.append((path, os.stat(path).st_mtime_ns))
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            ref_dirs.append(entry.path)
+            except OSError:
+                pass
+        return tuple(fingerprint)
+
+    @memoized
+    def ref_tips(self):
+        """All refs as a list of (refname, oid, peeled oid or None, symref target or None)"""
+        if self.refstore is not None:
+            return self.refstore.refs()
+        return [(ref["refname"], ref["objectname"], ref["peeled"], ref["symref"])
+                for ref in self.ref_snapshot().refs]
+
+    @memoized
+    def commit_tips(self):
+        """All refs as a list of (refname, commit oid, symref target or None), with tags
+        peeled to the commit they point at. Refs to other kinds of objects are left out."""
+        graph = self.commit_graph()
+        tips = []
+        unpeeled = []
+        for refname, oid, peeled, target in self.ref_tips():
+            if graph.index(oid) is not None:
+                tips.append((refname, oid, target))
+            elif peeled is not None:
+                if graph.index(peeled) is not None:
+                    tips.append((refname, peeled, target))
+            else:
+                unpeeled.append((refname, oid, target))
+
+        # loose annotated tags don't record what they point at, so ask git in one go
+        if len(unpeeled) > 0:
+            request = "".join(f"{oid}^{{}}\n" for refname, oid, target in unpeeled)
+            output = self.run_git_cmd(["cat-file", "--batch-check=%(objectname)"], input=request)
+            for (refname, oid, target), peeled in zip(unpeeled, output or []):
+                if graph.index(peeled) is not None:
+                    tips.append((refname, peeled, target))
+            tips.sort()
+        return tips
+
+    @memoized
+    def head_commit(self):
+        """Return the oid HEAD points at, or None"""
+        if self.refstore is not None:
+            return self.refstore.resolve("HEAD")
+        for ref in self.ref_snapshot().refs:
+            if ref["head"]:
+                return ref["objectname"]
+        output = self.run_git_cmd(["rev-parse", "--verify", "--quiet", "HEAD"], quiet=True)
+        return output[0] if output else None
+
+    @memoized
+    def head_is_detached(self):
+        if self.refstore is not None:
+            head = self.refstore.head()
+            return head is not None and head[0] == "oid"
+        output = self.run_git_cmd(["rev-parse", "--symbolic-full-name", "HEAD"], quiet=True)
+        return output is not None and output[0] == "HEAD"
+
     # --------------------------------------------------------------------------------------------
     # Report information about the repository
     # At the moment, many of these fetch information and also create a report
     # --------------------------------------------------------------------------------------------
 
+    @memoized
     def branches(self):
+        if self.refstore is not None:
+            branches_report = self.refstore.branches()
+        else:
+            branches_report = self.ref_snapshot().branches()
+        if branches_report is not None:
+            return branches_report
+
         output = self.run_git_cmd(["branch", "--list"])
         if output is None:
             return None
@@ -62,17 +343,41 @@ class Git:
             branches_report.append(line[2:])
         return branches_report
 
+    @memoized
     def last_commit_date(self):
+        if COMMIT_GRAPH:
+            graph = self.commit_graph()
+            last = graph.last_commit()
+            return None if last is None else graph.short_date(last)
+
         output = self.run_git_cmd(["log", "--all", "-1", "--date-order", "--format=format:%cs"])
         if output is None or len(output) == 0:
             return None
         return output[0]
 
+    @memoized
     def num_commits(self):
+        if COMMIT_GRAPH:
+            return len(self.commit_graph())
         return int(self.run_git_cmd(["rev-list", "--all", "--count"])[0])
 
     def count_objects(self):
-        output = self.run_git_cmd(["count-objects", "-v"])
+        """Object store statistics, as `git count-objects -v` reports them (sizes in
+        KiB). When we can read the repository files ourselves, there is also a
+        "pack-details" list (see read_object_stats)."""
+        import os
+        import os.path
+
+        if OBJECT_STATS and self.refstore is not None and "GIT_OBJECT_DIRECTORY" not in os.environ:
+            return read_object_stats(os.path.join(self.refstore.commondir, "objects"), self.refstore.hash_len)
+
+        # garbage warnings go to stderr, but the numbers are still good
+        output = self.run_git_cmd(["count-objects", "-v"], quiet=True)
+        if output is None and self.returncode == 0:
+            output = self.last_stdout
+        if output is None:
+            self.report_error(f"count-objects failed for {self.gitdir}", self.last_stderr)
+            return dict()
         # count: 4356
         # size: 90642
         # in-pack: 309
@@ -84,9 +389,51 @@ class Git:
         stats = dict()
         for line in output:
             label, value = line.split(": ")
-            stats[label] = int(value)
+            if label != "alternate":
+                stats[label] = int(value)
         return stats
 
+    @memoized
+    def largest_objects(self, k=10, paths=False):
+        """The k biggest objects in the repository (loose or packed, reachable or not),
+        as a list of (size, disk size, type, oid, path) tuples, biggest first. The object
+        list streams through a heap of the k biggest so far, so memory use doesn't grow
+        with the repository.
+
+        With paths=True, blobs and trees among them get the first path `rev-list --all
+        --objects` shows them at; that walk stops once every one has turned up. Otherwise,
+        and for objects no ref reaches, path is None."""
+        import heapq
+
+        heap = []
+        output = self.iter_git_cmd(["cat-file", "--batch-all-objects", "--unordered",
+                                    "--batch-check=%(objectsize) %(objectsize:disk) %(objecttype) %(objectname)"])
+        for line in output:
+            size, disk_size, kind, oid = line.split(" ")
+            entry = (int(size), oid, int(disk_size), kind)
+            # ties go by oid, so the result doesn't depend on the order objects come out in
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+        if self.returncode != 0:
+            raise RuntimeError(f"could not list objects of {self.gitdir}")
+        heap.sort(reverse=True)
+
+        found = dict()
+        wanted = {oid for size, oid, disk_size, kind in heap if kind in ("blob", "tree")}
+        if paths and len(wanted) > 0:
+            output = self.iter_git_cmd(["rev-list", "--all", "--objects"])
+            for line in output:
+                oid, _, path = line.partition(" ")
+                if oid in wanted and path != "":
+                    found[oid] = path
+                    wanted.discard(oid)
+                    if len(wanted) == 0:
+                        output.close()  # kills rev-list
+                        break
+        return [(size, disk_size, kind, oid, found.get(oid)) for size, oid, disk_size, kind in heap]
+
     def hooks(self):
         import os
         import os.path
@@ -141,29 +488,39 @@ class Git:
         return hooks_report
 
     def ls_remote(self):
-        import re
-
-        self.fetch_remotes()
+        # Remotes are queried concurrently, and a URL shared with other repos is
+        # only queried once (see RemoteQueries)
 
-        # the output looks like this
-        # d43ea8b5cb8e70596f783171627ed66d06aec087        refs/heads/main
+        queries = remote_queries()
+        remote_urls = {remote_name: remote_query_url(url, self.gitdir) for remote_name, url in self.remote_urls().items()}
+        futures = {remote_name: queries.submit(url, self.gitdir) for remote_name, url in remote_urls.items()}
 
         remote_refs = dict()
-        for remote_name in self.remote_names:
-            remote_refs[remote_name] = []
-            output = self.run_git_cmd(["ls-remote", remote_name])
-            if output is None:
-                print(f"Got nothing from ls-remote {remote_name} for {self.gitdir}")
-                return remote_refs
-            for line in output:
-                m = self.re_ls_remote.fullmatch(line)
-                if m is None:
-                    raise RuntimeError(f"failed to match: {output}")
-                refhash = m.group(1)
-                refname = m.group(2)
-                remote_refs[remote_name].append([refhash, refname])
+        for remote_name, future in futures.items():
+            refs = future.result()
+            if refs is None:
+                error = queries.errors.get(remote_urls[remote_name], "")
+                self.report_error(f"Got nothing from ls-remote {remote_name} for {self.gitdir}: {error}")
+                refs = []
+            remote_refs[remote_name] = refs
         return remote_refs
 
+    def prefetch_ls_remote(self):
+        """Start querying this repo's remotes in the background, so ls_remote() (or
+        unfetched()) has less to wait for"""
+        queries = remote_queries()
+        for url in self.remote_urls().values():
+            queries.submit(remote_query_url(url, self.gitdir), self.gitdir)
+
+    @memoized
+    def remote_urls(self):
+        """Return {remote name: url} for the remotes that have a URL"""
+        remote_urls = dict()
+        for remote in self.remotes():
+            remote_name, sep, url = remote.partition(":")
+            remote_urls[remote_name] = url
+        return remote_urls
+
     def read_gitignore(self):
         import os.path
 
@@ -178,10 +535,29 @@ class Git:
                 gitignore_data.append(line.strip())
         return gitignore_data
 
+    @memoized
     def refs(self):
-        return self.run_git_cmd(["show-ref", "--head"])
+        if self.refstore is not None:
+            return self.refstore.show_ref()
+        output = []
+        head = self.head_commit()
+        if head is not None:
+            output.append(f"{head} HEAD")
+        for ref in self.ref_snapshot().refs:
+            output.append(f"{ref['objectname']} {ref['refname']}")
+        if len(output) == 0:
+            return None
+        return output
 
+    @memoized
     def remotes(self):
+        if self.refstore is not None:
+            remotes_report = self.refstore.remotes()
+        else:
+            remotes_report = self.ref_snapshot().remotes()
+        if remotes_report is not None:
+            return remotes_report
+
         self.fetch_remotes()
 
         remotes_report = []
@@ -191,38 +567,90 @@ class Git:
                 remotes_report.append(f"{remote_name}:{remote[0]}")
         return remotes_report
 
+    @memoized
     def roots(self):
         """Get roots (commits without parents)"""
 
+        if COMMIT_GRAPH:
+            return self.roots_from_graph()
+
         roots_report = []
         output = self.run_git_cmd(["rev-list", "--all", "--max-parents=0"])
         for hash in output:
 
             # Find local branches that contain the root
             branches = [ref[2:] for ref in self.run_git_cmd(["branch", "--contains", hash])]
-            #branches = []
-            #output_branches = self.run_git_cmd(["branch", "--contains", hash])
-            #if len(output_branches) > 0:
-            #    for line in output_branches:
-            #        branches.append(line[2:])
 
             # Or, look for remote branches containing the root
             if len(branches) == 0:
-                branches = [ref for ref in self.run_git_cmd(["branch", "-r", "--contains", hash])]
-                # we have no local branches, so look for remote branches owning this root
-                #output_branches = self.run_git_cmd(["branch", "-r", "--contains", hash])
-                #for line in output_branches:
-                #    branches.append(line[2:])
+                branches = [ref[2:] for ref in self.run_git_cmd(["branch", "-r", "--contains", hash])]
 
             # Or, look for tags containing the root
             if len(branches) == 0:
-                branches = [ref[2:] for ref in self.run_git_cmd(["tag", "--contains", hash])]
-                # branches.append("NONE")
+                branches = self.run_git_cmd(["tag", "--contains", hash])
 
             roots_report.append(f"{hash}:{' '.join(branches)}")
         return roots_report
 
+    def roots_from_graph(self):
+        """Same report as roots(), but every ref's reach is worked out in one pass over
+        the commit graph instead of running `git branch --contains` per root"""
+        graph = self.commit_graph()
+        roots = graph.roots()
+        if len(roots) == 0:
+            return []
+
+        # Give every ref a bit, and the local branches, remote branches and tags each a mask
+        names = []
+        masks = {"local": 0, "remote": 0, "tag": 0}
+        starts = dict()
+        for refname, oid, target in self.commit_tips():
+            if refname.startswith("refs/heads/"):
+                kind, name = "local", refname[11:]
+            elif refname.startswith("refs/remotes/"):
+                kind, name = "remote", refname[13:]
+                if target is not None and target.startswith("refs/remotes/"):
+                    name = f"{name} -> {target[13:]}"
+            elif refname.startswith("refs/tags/"):
+                kind, name = "tag", refname[10:]
+            else:
+                continue
+            bit = 1 << len(names)
+            names.append(name)
+            masks[kind] |= bit
+            i = graph.index(oid)
+            starts[i] = starts.get(i, 0) | bit
+
+        # `git branch --contains` also lists a detached HEAD, in its own words
+        if self.head_is_detached():
+            head = graph.index(self.head_commit())
+            if head is not None:
+                label = [line[2:] for line in self.run_git_cmd(["branch", "--list"]) if line.startswith("* (")]
+                bit = 1 << len(names)
+                names.append(label[0] if len(label) > 0 else "(HEAD detached)")
+                masks["local"] |= bit
+                starts[head] = starts.get(head, 0) | bit
+
+        reach = graph.propagate(starts, roots)
+
+        roots_report = []
+        for root in roots:
+            bits = reach[root]
+            for kind in ["local", "remote", "tag"]:
+                owned = bits & masks[kind]
+                if owned:
+                    break
+            # detached HEAD sorts first, like git shows it; everything else by name
+            branches = sorted(names[n] for n in range(len(names)) if owned >> n & 1)
+            branches.sort(key=lambda name: not name.startswith("("))
+            roots_report.append(f"{graph.oid(root)}:{' '.join(branches)}")
+        return roots_report
+
+    @memoized
     def stashes(self):
+        # git stash only works in a worktree
+        if not self.is_worktree:
+            return []
         return self.run_git_cmd(["stash", "list"])
 
     def submodules(self):
@@ -233,60 +661,186 @@ class Git:
             return self.last_stderr
         return output
 
+    @memoized
     def tags(self):
-        return self.run_git_cmd(["tag", "--list"])
+        if self.refstore is not None:
+            return self.refstore.tags()
+        return self.ref_snapshot().tags()
 
     def uncommitted(self):
-        output = self.run_git_cmd(["status", "-s"])
-        uncommitted_report = []
-        for line in output:
-            uncommitted_report.append(line)
+        import time
+
+        options, accelerations = self.status_options()
+        start_time = time.time()
+        uncommitted_report = status_report(self.iter_git_cmd([*options, "status", "-s", "-z"], nul=True))
+        if LARGE_WORKTREE:
+            self.status_info = {"accelerations": accelerations, "seconds": time.time() - start_time}
         return uncommitted_report
 
+    def index_entries(self):
+        """Number of entries in the index, from its header (0 if there's no index)"""
+        import os.path
+
+        dirs = self.git_dirs()
+        if dirs is None:
+            return 0
+        try:
+            with open(os.path.join(dirs[0], "index"), "rb") as f:
+                header = f.read(12)
+        except OSError:
+            return 0
+        # "DIRC", version, entry count (all big-endian)
+        if len(header) < 12 or header[:4] != b"DIRC":
+            return 0
+        return int.from_bytes(header[8:12], "big")
+
+    def status_options(self):
+        """Return (git options, names of the accelerations they turn on) for running
+        status here. Only big worktrees in LARGE_WORKTREE mode get any."""
+        import os.path
+        import sys
+
+        if not LARGE_WORKTREE or not self.is_worktree or self.index_entries() < LARGE_INDEX_ENTRIES:
+            return [], []
+
+        # keep the untracked scan results in the index, and check index entries
+        # against the worktree on several threads
+        options = ["-c", "core.untrackedCache=true", "-c", "core.preloadIndex=true", "-c", "index.threads=true"]
+        accelerations = ["untracked-cache", "preload-index", "index-threads"]
+
+        # ask a file watcher what changed instead of looking at everything: git's own
+        # daemon where it has one, otherwise our inotify hook
+        import fsmonitor
+        if sys.platform in ("darwin", "win32") and find_git_version() >= (2, 36):
+            options += ["-c", "core.fsmonitor=true"]
+            accelerations.append("fsmonitor-daemon")
+        elif fsmonitor.available():
+            worktree = os.path.abspath(self.gitdir if self.gitdir is not None else ".")
+            options += ["-c", f"core.fsmonitor={fsmonitor.hook_command(worktree, self.git_dirs()[0])}",
+                        "-c", "core.fsmonitorHookVersion=2"]
+            accelerations.append("fsmonitor-inotify")
+        return options, accelerations
+
     def unfetched(self):
-        # Get the local idea of remote refs
-        output = self.refs()
-        local_refs = dict()
-        for line in output:
-            m = self.re_ls_remote.fullmatch(line)
-            if m is None:
-                raise RuntimeError(f"failed to match: {output}")
-            refhash = m.group(1)
-            refname = m.group(2)
-            if refname == "HEAD" or refname.startswith("refs/heads"):
-                continue
-            local_refs[refname] = refhash
-            # print(f"local_refs[{refname}] = {refhash}")
-
-        # Get the upstream's idea of its refs, translated to the same pattern
-        # as the local names
-        upstream_refs = dict()
-        remote_refs = self.ls_remote()
-        for origin in remote_refs:
-            for refhash, refname in remote_refs[origin]:
-                if refname == "HEAD" or not refname.startswith("refs/heads"):
-                    continue
-                tip = refname[11:]
-                localname = f"refs/remotes/{origin}/{tip}"
-                upstream_refs[localname] = refhash
-                # print(f"upstream_refs[{localname}] = {refhash}")
-
-        unfetched_refs = []
-        for refname in upstream_refs:
-            if refname not in local_refs:
-                # print(f"found remote ref {refname} at {upstream_refs[refname]} with no matching local ref")
-                continue
-            if local_refs[refname] != upstream_refs[refname]:
-                unfetched_refs.append(f"{refname} local={local_refs[refname]} remote={upstream_refs[refname]}")
-        return unfetched_refs
+        return unfetched_report(self.refs(), self.ls_remote())
 
+    @memoized
     def unmerged(self):
+        """The oids of commits not on the main branch. This is a list held in memory;
+        count_unmerged() gets the number without building it."""
+        if self.main_branch is None:
+            return []
+        if COMMIT_GRAPH:
+            graph = self.commit_graph()
+            main = [oid for refname, oid, peeled, target in self.ref_tips() if refname == f"refs/heads/{self.main_branch}"]
+            if len(main) == 0:
+                return []
+            return [graph.oid(i) for i in graph.excluding(None, main)]
+
+        return self.run_git_cmd(["rev-list", "--all", "--not", self.main_branch]) or []
+
+    @memoized
+    def count_unmerged(self):
+        """Same as len(unmerged()), without building the list"""
         if self.main_branch is None:
             return 0
-        output = self.run_git_cmd(["log", "--all", "--format=format:%H", "--not", self.main_branch])
-        return output
+        if COMMIT_GRAPH:
+            main = [oid for refname, oid, peeled, target in self.ref_tips() if refname == f"refs/heads/{self.main_branch}"]
+            if len(main) == 0:
+                return 0
+            return self.commit_graph().mask_excluding(None, main).count(1)
+
+        output = self.run_git_cmd(["rev-list", "--count", "--all", "--not", self.main_branch])
+        return int(output[0]) if output else 0
+
+    @memoized
+    def count_unpushed(self):
+        """Return (branches, commits) with unpushed work; the same numbers as the lengths
+        of the two lists unpushed() returns, or (0, 0)"""
+        if not self.has_commit_graph() and self.ref_snapshot().all_branches_pushed():
+            return 0, 0
+        if COMMIT_GRAPH:
+            graph = self.commit_graph()
+            tips = self.ref_tips()
+            branch_tips = [oid for refname, oid, peeled, target in tips if refname.startswith("refs/heads/")]
+            remote_tips = [oid for refname, oid, peeled, target in tips if refname.startswith("refs/remotes/")]
+            unpushed = graph.mask_excluding(branch_tips, remote_tips)
+            num_commits = unpushed.count(1)
+            if num_commits == 0:
+                return 0, 0
+            decorated = set(graph.index(oid) for refname, oid, target in self.commit_tips())
+            head = self.head_commit()
+            if head is not None and graph.index(head) is not None:
+                decorated.add(graph.index(head))
+            roots = [i for i in graph.roots() if unpushed[i]]
+            kept = self.roots_with_files([graph.oid(i) for i in roots])
+            for i in roots:
+                if graph.oid(i) in kept:
+                    decorated.add(i)
+                else:
+                    decorated.discard(i)
+            return sum(1 for i in decorated if unpushed[i]), num_commits
+
+        output = self.run_git_cmd(["rev-list", "--count", "--branches", "--not", "--remotes", "--simplify-by-decoration"])
+        num_branches = int(output[0]) if output else 0
+        if num_branches == 0:
+            return 0, 0
+        output = self.run_git_cmd(["rev-list", "--count", "--branches", "--not", "--remotes"])
+        return num_branches, int(output[0])
+
+    def dirty_reason(self, check_upstream=False):
+        """Return why this repo needs attention, or None if it doesn't. The cheapest
+        signs are checked first, and we stop at the first one found, so a clean repo
+        costs a few quick probes instead of a full report. The answer is one of
+        "stash", "unmerged", "uncommitted", "untracked", "unpushed" or "unfetched"; the
+        rules are the ones analyze uses, plus stashes. Set main_branch first."""
+        if not self.is_worktree:
+            return None
 
+        # a stash is just a ref
+        if self.refstore is not None:
+            if self.refstore.resolve("refs/stash") is not None:
+                return "stash"
+        elif any(ref["refname"] == "refs/stash" for ref in self.ref_snapshot().refs):
+            return "stash"
+
+        # one commit is enough to know there's unmerged work
+        if self.main_branch is not None:
+            if self.has_commit_graph():
+                if self.count_unmerged() > 0:
+                    return "unmerged"
+            elif self.head_commit() is not None:
+                if self.first_record(["rev-list", "-n1", "--all", "--not", f"refs/heads/{self.main_branch}"]) is not None:
+                    return "unmerged"
+
+        # tracked files first (only needs the index), then the worktree walk for untracked files
+        options, accelerations = self.status_options()
+        if self.first_record([*options, "status", "--porcelain", "--untracked-files=no", "-z"], nul=True) is not None:
+            return "uncommitted"
+        if self.first_record(["ls-files", "--others", "--exclude-standard", "--directory", "--no-empty-directory", "-z"], nul=True) is not None:
+            return "untracked"
+
+        # tracking info usually settles this without walking history
+        if self.count_unpushed()[0] > 0:
+            return "unpushed"
+
+        if check_upstream and len(self.unfetched()) > 0:
+            return "unfetched"
+        return None
+
+    @memoized
+    def ahead_behind(self):
+        """For each local branch with an upstream, return (branch, upstream, ahead, behind).
+        ahead and behind are None if the upstream branch is gone."""
+        return self.ref_snapshot().ahead_behind()
+
+    @memoized
     def unpushed(self):
+        if not self.has_commit_graph() and self.ref_snapshot().all_branches_pushed():
+            return []
+        if COMMIT_GRAPH:
+            return self.unpushed_from_graph()
+
         # Find branches with unpushed work
         branches = self.run_git_cmd(["log", "--branches", "--not", "--remotes", "--simplify-by-decoration", "--oneline"])
         if len(branches) == 0:
@@ -296,41 +850,64 @@ class Git:
         commits = self.run_git_cmd(["log", "--branches", "--not", "--remotes", "--oneline"])
         return [branches, commits]
 
-    def worktrees(self):
-        import re
-        import os.path
+    def unpushed_from_graph(self):
+        graph = self.commit_graph()
+        tips = self.ref_tips()
+        branch_tips = [oid for refname, oid, peeled, target in tips if refname.startswith("refs/heads/")]
+        remote_tips = [oid for refname, oid, peeled, target in tips if refname.startswith("refs/remotes/")]
+        unpushed = graph.excluding(branch_tips, remote_tips)
+        if len(unpushed) == 0:
+            return []
+
+        # We only need git for the oneline text of the commits we found. The branches
+        # list is the unpushed commits that some ref (or HEAD) points at, with roots
+        # going by roots_with_files(), like --simplify-by-decoration.
+        decorated = set(oid for refname, oid, target in self.commit_tips())
+        head = self.head_commit()
+        if head is not None:
+            decorated.add(head)
+        roots = [graph.oid(i) for i in unpushed if len(graph.parents_of(i)) == 0]
+        kept = self.roots_with_files(roots)
+        decorated.difference_update(roots)
+        decorated.update(kept)
+
+        oids = [graph.oid(i) for i in unpushed]
+        commits = self.run_git_cmd(["log", "--no-walk=unsorted", "--oneline", "--stdin"],
+                                   input="".join(f"{oid}\n" for oid in oids))
+        branches = [line for oid, line in zip(oids, commits) if oid in decorated]
+        if len(branches) == 0:
+            return []
+        return [branches, commits]
 
+    def roots_with_files(self, oids):
+        """The root commits among oids whose tree isn't empty. --simplify-by-decoration
+        shows those whether or not a ref points at them, and leaves out the others,
+        even ones a ref points at."""
+        if len(oids) == 0:
+            return set()
+        output = self.run_git_cmd(["cat-file", "--batch-check=%(objectname)"],
+                                  input="".join(f"{oid}^{{tree}}\n" for oid in oids))
+        return {oid for oid, tree in zip(oids, output or []) if tree not in EMPTY_TREES}
+
+    @memoized
+    def worktrees(self):
         # Don't bother to return the built-in worktree. And note that it's atypical for someone
         # to have worktrees. We'd like to know, because it's easy to lose track of them.
         output = self.run_git_cmd(["worktree", "list"])
-
-        # The output looks like this
-        # C:/projects/github/neurocline/a  f9a41f8 [main]
-
-        worktrees_report = []
-        for line in output:
-            m = self.re_worktree.fullmatch(line)
-            if m is None:
-                raise RuntimeError(f"failed to match: {output}")
-            worktree_path = m.group(1).rstrip()
-            worktree_hash = m.group(2)
-            worktree_branch = m.group(3)
-            if worktree_path.lower() == os.path.abspath(self.gitdir).lower().replace("\\", "/"):
-                # print(f"Skipping {worktree_path} because this is {self.gitdir}")
-                pass
-            else:
-                worktrees_report.append(f"{worktree_branch}:{worktree_hash}:{worktree_path}")
-        return worktrees_report
+        if output is None:
+            raise RuntimeError(f"could not list the worktrees of {self.gitdir}")
+        return worktrees_report(output, self.gitdir)
 
     # --------------------------------------------------------------------------------------------
 
+    @memoized
     def signature(self):
         import hashlib
 
         # We are hashing both the ref hahes and the ref names, in the order returned
         # by git show-ref. We should probably make sure it's in a canonical order and format
-        refs = self.refs()
-        stashes = self.stashes()
+        refs = self.refs() or []  # None for a repo with no commits yet
+        stashes = self.stashes() or []
         sha1 = hashlib.sha1()
         for ref in refs:
             sha1.update(ref.encode('utf-8'))
@@ -342,31 +919,36 @@ class Git:
     # --------------------------------------------------------------------------------------------
 
     def get_gitdir_path(self, sub_path):
+        import os.path
+
         if self.is_bare_repo:
             return os.path.join(self.gitdir, sub_path)
         else:
             return os.path.join(self.gitdir, ".git", sub_path)
 
-    def run_git_cmd(self, cmd):
-        import subprocess
-        import sys
-
-        global git_exe
-        if git_exe is None:
-            import shutil
-            git_exe = shutil.which("git")
-            if git_exe is None:
-                raise RuntimeError("Could not find location of 'git' binary")
-
+    def git_cmd_line(self, cmd):
+        """Build the full argv for running git cmd against this repository"""
         git_cmd = cmd[:]
-        git_cmd.insert(0, git_exe)
+        git_cmd.insert(0, find_git())
         if self.gitdir is not None:
             git_cmd.insert(1, "-C")
             git_cmd.insert(2, self.gitdir)
+        return git_cmd
+
+    def run_git_cmd(self, cmd, input=None, quiet=False):
+        import subprocess
+        import sys
+        import time
+
+        git_cmd = self.git_cmd_line(cmd)
 
         if VERBOSE:
             print(git_cmd, end="", file=sys.stderr, flush=True)
-        result = subprocess.run(git_cmd, capture_output=True, text=True)
+        start = time.perf_counter()
+        result = subprocess.run(git_cmd, capture_output=True, text=True, input=input)
+        if PROFILE is not None:
+            PROFILE.record(self.gitdir, cmd, start, len(result.stdout.encode('utf-8', errors='surrogateescape')),
+                           result.returncode)
         if VERBOSE:
             print("  done", file=sys.stderr, flush=True)
 
@@ -375,9 +957,2281 @@ class Git:
         self.returncode = result.returncode
 
         if self.returncode != 0 or len(self.last_stderr) > 0:
-            print(f"{git_cmd} returned error={self.returncode}")
-            for line in self.last_stderr:
-                print(line)
+            if not quiet:
+                self.report_error(f"{git_cmd} returned error={self.returncode}", self.last_stderr)
             return None
 
         return self.last_stdout
+
+    def report_error(self, message, details=()):
+        """Keep an error (and any detail lines, like git's stderr) in self.errors, and
+        print it unless PRINT_ERRORS is off"""
+        self.errors.append("\n".join([message, *details]))
+        if PRINT_ERRORS:
+            print(message)
+            for line in details:
+                print(line)
+
+    def first_record(self, cmd, nul=False):
+        """Run git and return the first record of its output (None if there is none),
+        stopping git there"""
+        records = self.iter_git_cmd(cmd, nul=nul)
+        try:
+            return next(records, None)
+        finally:
+            records.close()
+
+    def iter_git_cmd(self, cmd, nul=False, binary=False):
+        """Run git and yield its output a record at a time instead of buffering all of it.
+
+        Records are lines, or NUL-terminated with nul=True (for commands run with -z).
+        They are str, with undecodable bytes kept via surrogateescape, or bytes with
+        binary=True. Memory only stays flat if the caller uses each record and lets it
+        go (CommitGraph.build, status, ls-remote); collecting them into a list gains
+        nothing over run_git_cmd(). Stopping early kills git. Once the output is used up,
+        self.returncode and self.last_stderr are set, and errors are reported the
+        same way run_git_cmd() reports them."""
+        import subprocess
+        import sys
+        import tempfile
+        import time
+
+        git_cmd = self.git_cmd_line(cmd)
+        separator = b"\0" if nul else b"\n"
+
+        if VERBOSE:
+            print(git_cmd, "(streaming)", file=sys.stderr, flush=True)
+
+        # stderr goes to a file, so git can't block on a full stderr pipe while we read stdout
+        with tempfile.TemporaryFile() as stderr_file:
+            start = time.perf_counter()
+            proc = subprocess.Popen(git_cmd, stdout=subprocess.PIPE, stderr=stderr_file)
+            finished = False
+            nbytes = 0
+            try:
+                pending = b""
+                while True:
+                    chunk = proc.stdout.read1(65536)
+                    if len(chunk) == 0:
+                        break
+                    nbytes += len(chunk)
+                    records = (pending + chunk).split(separator)
+                    pending = records.pop()
+                    for record in records:
+                        yield record if binary else record.decode('utf-8', errors='surrogateescape')
+                if len(pending) > 0:
+                    yield pending if binary else pending.decode('utf-8', errors='surrogateescape')
+                finished = True
+            finally:
+                if not finished:
+                    proc.kill()
+                proc.stdout.close()
+                proc.wait()
+                if PROFILE is not None:
+                    PROFILE.record(self.gitdir, cmd, start, nbytes, proc.returncode)
+
+            stderr_file.seek(0)
+            self.last_stderr = stderr_file.read().decode('utf-8', errors='replace').splitlines()
+        self.returncode = proc.returncode
+
+        if self.returncode != 0 or len(self.last_stderr) > 0:
+            self.report_error(f"{git_cmd} returned error={self.returncode}", self.last_stderr)
+
+# ------------------------------------------------------------------------------------------------
+# Turning git output into reports (shared by Git and AsyncGit)
+# ------------------------------------------------------------------------------------------------
+
+def status_report(records):
+    """Report lines from the records of `git status -s -z`"""
+    # With -z, paths come through unquoted, and a rename or copy is followed by a
+    # record holding the original path
+    records = iter(records)
+    uncommitted_report = []
+    for record in records:
+        if record[0] in "RC" or record[1] in "RC":
+            record = f"{record[:3]}{next(records, '')} -> {record[3:]}"
+        uncommitted_report.append(record)
+    return uncommitted_report
+
+def worktrees_report(output, gitdir):
+    """Report lines from `git worktree list`, leaving out the worktree at gitdir"""
+    import os.path
+    import re
+
+    # The output looks like this
+    # C:/projects/github/neurocline/a  f9a41f8 [main]
+
+    worktrees_report = []
+    for line in output:
+        m = re.fullmatch(r'(.+) ([a-fA-F0-9]{7,}) \[([^]]+)\]( prunable)?', line)
+        if m is None:
+            raise RuntimeError(f"failed to match: {output}")
+        worktree_path = m.group(1).rstrip()
+        worktree_hash = m.group(2)
+        worktree_branch = m.group(3)
+        if worktree_path.lower() == os.path.abspath(gitdir).lower().replace("\\", "/"):
+            # print(f"Skipping {worktree_path} because this is {gitdir}")
+            pass
+        else:
+            worktrees_report.append(f"{worktree_branch}:{worktree_hash}:{worktree_path}")
+    return worktrees_report
+
+def unfetched_report(refs, remote_refs):
+    """Remote-tracking refs that are behind the remote. refs is `git show-ref --head`
+    output, remote_refs is what ls_remote() returns."""
+    import re
+
+    # Get the local idea of remote refs
+    local_refs = dict()
+    for line in refs or []:
+        m = re.fullmatch(r'([a-fA-F0-9]+)\s+(.+)', line)
+        if m is None:
+            raise RuntimeError(f"failed to match: {refs}")
+        refhash = m.group(1)
+        refname = m.group(2)
+        if refname == "HEAD" or refname.startswith("refs/heads"):
+            continue
+        local_refs[refname] = refhash
+        # print(f"local_refs[{refname}] = {refhash}")
+
+    # Get the upstream's idea of its refs, translated to the same pattern
+    # as the local names
+    upstream_refs = dict()
+    for origin in remote_refs:
+        for refhash, refname in remote_refs[origin]:
+            if refname == "HEAD" or not refname.startswith("refs/heads"):
+                continue
+            tip = refname[11:]
+            localname = f"refs/remotes/{origin}/{tip}"
+            upstream_refs[localname] = refhash
+            # print(f"upstream_refs[{localname}] = {refhash}")
+
+    unfetched_refs = []
+    for refname in upstream_refs:
+        if refname not in local_refs:
+            # print(f"found remote ref {refname} at {upstream_refs[refname]} with no matching local ref")
+            continue
+        if local_refs[refname] != upstream_refs[refname]:
+            unfetched_refs.append(f"{refname} local={local_refs[refname]} remote={upstream_refs[refname]}")
+    return unfetched_refs
+
+# ------------------------------------------------------------------------------------------------
+# asyncio client
+# ------------------------------------------------------------------------------------------------
+
+ASYNC_JOBS = 64  # how many git processes AsyncGit runs at once (per event loop)
+
+async_states = None
+
+class AsyncGit:
+    """Git for asyncio: the methods that run git are coroutines built on
+    asyncio.create_subprocess_exec, so a single event loop can work through many
+    repos at once without a thread per git call. All AsyncGit objects on a loop
+    share one semaphore, so at most ASYNC_JOBS git processes run at a time.
+
+    Create one with `await AsyncGit.open(gitdir)`. Like Git, refs and remotes are
+    read straight from the repository files when possible. History queries use
+    separate git commands (as Git does with COMMIT_GRAPH = 0). Methods that only
+    read files (hooks, read_gitignore) are plain functions shared with Git.
+    """
+
+    def __init__(self, gitdir, is_worktree, is_bare_repo):
+        self.gitdir = gitdir
+        self.errors = []
+        self.is_worktree = is_worktree
+        self.is_bare_repo = is_bare_repo
+
+        self.refstore = None
+        if self.is_worktree or self.is_bare_repo:
+            self.refstore = open_ref_store(gitdir, self.is_bare_repo)
+
+        # Some information we cache
+        self.main_branch = None
+        self.remote_names = None
+        self.snapshot_task = None
+
+        self.returncode = 0
+        self.last_stderr = []
+
+    @classmethod
+    async def open(cls, gitdir=None):
+        repo = cls(gitdir, False, False)
+        output = await repo.run_git_cmd(["rev-parse", "--is-inside-work-tree", "--is-bare-repository"], quiet=True)
+        if output is None or len(output) < 2:
+            return repo
+        is_worktree = output[0] == 'true'
+        is_bare_repo = not is_worktree and output[1] == 'true'
+        return cls(gitdir, is_worktree, is_bare_repo)
+
+    # plain functions that don't run git
+    hooks = Git.hooks
+    read_gitignore = Git.read_gitignore
+    get_gitdir_path = Git.get_gitdir_path
+    git_cmd_line = Git.git_cmd_line
+    report_error = Git.report_error
+
+    # --------------------------------------------------------------------------------------------
+    # Cache information about the repository
+    # --------------------------------------------------------------------------------------------
+
+    async def fetch_remotes(self):
+        if self.remote_names is None:
+            if self.refstore is not None:
+                self.remote_names = self.refstore.remote_names()
+            else:
+                self.remote_names = (await self.ref_snapshot()).remote_names()
+        if self.remote_names is None:
+            self.remote_names = await self.run_git_cmd(["remote"]) or []
+
+    async def ref_snapshot(self):
+        """Return the RefSnapshot for this repository, reading it on first use"""
+        import asyncio
+
+        # concurrent callers share one read
+        if self.snapshot_task is None:
+            self.snapshot_task = asyncio.ensure_future(self.read_ref_snapshot())
+        return await self.snapshot_task
+
+    async def read_ref_snapshot(self):
+        import asyncio
+
+        ref_lines, config_lines = await asyncio.gather(
+            self.run_git_cmd(RefSnapshot.FOR_EACH_REF_CMD),
+            self.run_git_cmd(RefSnapshot.CONFIG_CMD, quiet=True))
+        return RefSnapshot(self, ref_lines or [], config_lines or [])
+
+    async def head_commit(self):
+        """Return the oid HEAD points at, or None"""
+        if self.refstore is not None:
+            return self.refstore.resolve("HEAD")
+        output = await self.run_git_cmd(["rev-parse", "--verify", "--quiet", "HEAD"], quiet=True)
+        return output[0] if output else None
+
+    # --------------------------------------------------------------------------------------------
+    # Report information about the repository
+    # --------------------------------------------------------------------------------------------
+
+    async def branches(self):
+        if self.refstore is not None:
+            branches_report = self.refstore.branches()
+        else:
+            branches_report = (await self.ref_snapshot()).branches()
+        if branches_report is not None:
+            return branches_report
+
+        output = await self.run_git_cmd(["branch", "--list"])
+        if output is None:
+            return None
+        return [line[2:] for line in output]
+
+    async def tags(self):
+        if self.refstore is not None:
+            return self.refstore.tags()
+        return (await self.ref_snapshot()).tags()
+
+    async def refs(self):
+        if self.refstore is not None:
+            return self.refstore.show_ref()
+        output = []
+        head = await self.head_commit()
+        if head is not None:
+            output.append(f"{head} HEAD")
+        for ref in (await self.ref_snapshot()).refs:
+            output.append(f"{ref['objectname']} {ref['refname']}")
+        if len(output) == 0:
+            return None
+        return output
+
+    async def remotes(self):
+        if self.refstore is not None:
+            remotes_report = self.refstore.remotes()
+        else:
+            remotes_report = (await self.ref_snapshot()).remotes()
+        if remotes_report is not None:
+            return remotes_report
+
+        await self.fetch_remotes()
+        remotes_report = []
+        for remote_name in self.remote_names:
+            remote = await self.run_git_cmd(["remote", "get-url", remote_name])
+            if remote is not None:
+                remotes_report.append(f"{remote_name}:{remote[0]}")
+        return remotes_report
+
+    async def remote_urls(self):
+        """Return {remote name: url} for the remotes that have a URL"""
+        remote_urls = dict()
+        for remote in await self.remotes():
+            remote_name, sep, url = remote.partition(":")
+            remote_urls[remote_name] = url
+        return remote_urls
+
+    async def last_commit_date(self):
+        output = await self.run_git_cmd(["log", "--all", "-1", "--date-order", "--format=format:%cs"])
+        if output is None or len(output) == 0:
+            return None
+        return output[0]
+
+    async def num_commits(self):
+        output = await self.run_git_cmd(["rev-list", "--all", "--count"])
+        return int(output[0]) if output else 0
+
+    async def stashes(self):
+        # git stash only works in a worktree
+        if not self.is_worktree:
+            return []
+        return await self.run_git_cmd(["stash", "list"])
+
+    async def uncommitted(self):
+        output = await self.run_git_cmd(["status", "-s", "-z"], nul=True)
+        return status_report(output or [])
+
+    async def unmerged(self):
+        """Same as Git.unmerged(): a list, empty if there's no main branch or git fails"""
+        if self.main_branch is None:
+            return []
+        return await self.run_git_cmd(["rev-list", "--all", "--not", self.main_branch]) or []
+
+    async def unpushed(self):
+        if (await self.ref_snapshot()).all_branches_pushed():
+            return []
+
+        # Find branches with unpushed work
+        branches = await self.run_git_cmd(["log", "--branches", "--not", "--remotes", "--simplify-by-decoration", "--oneline"])
+        if not branches:
+            return []
+
+        # Get all unpushed commits
+        commits = await self.run_git_cmd(["log", "--branches", "--not", "--remotes", "--oneline"])
+        return [branches, commits]
+
+    async def ahead_behind(self):
+        """For each local branch with an upstream, return (branch, upstream, ahead, behind).
+        ahead and behind are None if the upstream branch is gone."""
+        return (await self.ref_snapshot()).ahead_behind()
+
+    async def ls_remote(self):
+        import asyncio
+
+        remote_urls = dict()
+        for remote_name, url in (await self.remote_urls()).items():
+            remote_urls[remote_name] = remote_query_url(url, self.gitdir)
+        state = async_state()
+        results = await asyncio.gather(*[self.ls_remote_url(url) for url in remote_urls.values()])
+
+        remote_refs = dict()
+        for (remote_name, url), refs in zip(remote_urls.items(), results):
+            if refs is None:
+                self.report_error(f"Got nothing from ls-remote {remote_name} for {self.gitdir}: {state['errors'].get(url, '')}")
+                refs = []
+            remote_refs[remote_name] = refs
+        return remote_refs
+
+    async def ls_remote_url(self, url):
+        """ls-remote url, at most once per event loop; same rules as RemoteQueries"""
+        import asyncio
+
+        tasks = async_state()["ls_remote"]
+        if url not in tasks:
+            tasks[url] = asyncio.ensure_future(self.query_remote(url))
+        return await tasks[url]
+
+    async def query_remote(self, url):
+        import asyncio
+        import subprocess
+        import time
+
+        state = async_state()
+        timeout = LS_REMOTE_TIMEOUT
+        async with state["semaphore"]:
+            start = time.perf_counter()
+            proc = await asyncio.create_subprocess_exec(
+                *ls_remote_cmd_line(url, self.gitdir), stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=ls_remote_env(), start_new_session=True)
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+            except asyncio.TimeoutError:
+                kill_process_group(proc)
+                await proc.wait()
+                state["errors"][url] = f"timed out after {timeout} seconds"
+                if PROFILE is not None:
+                    PROFILE.record(self.gitdir, ["ls-remote", "--", url], start, 0, proc.returncode, "ls_remote")
+                return None
+            finally:
+                # cancelled: don't leave git (or ssh) behind
+                if proc.returncode is None:
+                    kill_process_group(proc)
+        if PROFILE is not None:
+            PROFILE.record(self.gitdir, ["ls-remote", "--", url], start, len(stdout), proc.returncode, "ls_remote")
+
+        if proc.returncode != 0:
+            state["errors"][url] = " ".join(stderr.decode('utf-8', errors='replace').splitlines()) or f"error={proc.returncode}"
+            return None
+        return parse_ls_remote(stdout.decode('utf-8', errors='surrogateescape'))
+
+    async def unfetched(self):
+        import asyncio
+
+        refs, remote_refs = await asyncio.gather(self.refs(), self.ls_remote())
+        return unfetched_report(refs, remote_refs)
+
+    async def worktrees(self):
+        # Don't bother to return the built-in worktree
+        return worktrees_report(await self.run_git_cmd(["worktree", "list"]) or [], self.gitdir)
+
+    async def signature(self):
+        import asyncio
+        import hashlib
+
+        refs, stashes = await asyncio.gather(self.refs(), self.stashes())
+        sha1 = hashlib.sha1()
+        for ref in refs or []:
+            sha1.update(ref.encode('utf-8'))
+        for stash in stashes or []:
+            sha1.update(stash.encode('utf-8'))
+        return sha1.hexdigest()
+
+    # --------------------------------------------------------------------------------------------
+
+    async def run_git_cmd(self, cmd, input=None, quiet=False, nul=False):
+        """Same as Git.run_git_cmd(), waiting for a slot first. With nul=True the
+        output is split on NUL rather than newlines."""
+        import asyncio
+        import subprocess
+        import sys
+        import time
+
+        git_cmd = self.git_cmd_line(cmd)
+
+        if VERBOSE:
+            print(git_cmd, "(async)", file=sys.stderr, flush=True)
+        async with async_state()["semaphore"]:
+            start = time.perf_counter()
+            proc = await asyncio.create_subprocess_exec(
+                *git_cmd, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                stdout, stderr = await proc.communicate(input.encode('utf-8') if input is not None else None)
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+        if PROFILE is not None:
+            PROFILE.record(self.gitdir, cmd, start, len(stdout), proc.returncode)
+
+        stdout = stdout.decode('utf-8', errors='surrogateescape')
+        self.last_stderr = stderr.decode('utf-8', errors='replace').splitlines()
+        self.returncode = proc.returncode
+
+        if self.returncode != 0 or len(self.last_stderr) > 0:
+            if not quiet:
+                self.report_error(f"{git_cmd} returned error={self.returncode}", self.last_stderr)
+            return None
+
+        if nul:
+            records = stdout.split("\0")
+            if records[-1] == "":
+                records.pop()
+            return records
+        return stdout.splitlines()
+
+def async_state():
+    """The semaphore limiting git processes and the ls-remote tasks by URL, for the
+    running event loop (asyncio objects can't be shared between loops)"""
+    import asyncio
+    import weakref
+
+    global async_states
+    if async_states is None:
+        async_states = weakref.WeakKeyDictionary()
+    loop = asyncio.get_running_loop()
+    state = async_states.get(loop)
+    if state is None:
+        state = {"semaphore": asyncio.Semaphore(ASYNC_JOBS), "ls_remote": dict(), "errors": dict()}
+        async_states[loop] = state
+    return state
+
+# ------------------------------------------------------------------------------------------------
+# Ref snapshot
+# ------------------------------------------------------------------------------------------------
+
+class RefSnapshot:
+    """Refs, upstream tracking state and remote URLs, read with one `git for-each-ref`
+    and one `git config` call.
+
+    refs is a list of dicts, sorted by refname, with keys refname, objectname, peeled
+    (for annotated tags), symref, upstream, track (ahead/behind text), worktreepath
+    and head (True for the branch HEAD points at). config holds the remote.* and
+    url.*.insteadOf entries as (key, value) pairs.
+    """
+
+    FIELDS = ["refname", "objectname", "*objectname", "symref", "upstream",
+              "upstream:track,nobracket", "worktreepath", "HEAD"]
+
+    FOR_EACH_REF_CMD = ["for-each-ref", "--format=" + "%00".join(f"%({field})" for field in FIELDS)]
+    CONFIG_CMD = ["config", "--get-regexp", r"^(remote\..*|url\..*\.insteadof)$"]
+
+    def __init__(self, repo, ref_lines=None, config_lines=None):
+        """Runs the two git commands, unless their output is passed in (as AsyncGit does)"""
+        import os.path
+
+        self.repo = repo
+        self.refs = []
+        self.config = []
+
+        if ref_lines is None:
+            ref_lines = repo.iter_git_cmd(self.FOR_EACH_REF_CMD)
+        for line in ref_lines:
+            refname, objectname, peeled, symref, upstream, track, worktreepath, head = line.split("\0")
+            self.refs.append({
+                "refname": refname,
+                "objectname": objectname,
+                "peeled": peeled or None,
+                "symref": symref or None,
+                "upstream": upstream or None,
+                "track": track,
+                "worktreepath": worktreepath or None,
+                "head": head == "*",
+            })
+
+        # exits with 1 when nothing matches
+        if config_lines is None:
+            config_lines = repo.run_git_cmd(self.CONFIG_CMD, quiet=True)
+        for line in config_lines or []:
+            key, sep, value = line.partition(" ")
+            self.config.append((key, value))
+
+        # where to look for legacy remotes/ and branches/ files
+        self.commondir = None
+        if repo.refstore is not None:
+            self.commondir = repo.refstore.commondir
+        elif repo.gitdir is not None:
+            self.commondir = repo.gitdir if repo.is_bare_repo else os.path.join(repo.gitdir, ".git")
+
+    def branches(self):
+        """Same as `git branch --list`, or None if HEAD isn't on a branch (git words
+        that line itself)"""
+        branches_report = []
+        on_branch = False
+        for ref in self.refs:
+            if ref["refname"].startswith("refs/heads/"):
+                branches_report.append(ref["refname"][11:])
+                on_branch = on_branch or ref["head"]
+        if not on_branch:
+            return None
+        return branches_report
+
+    def tags(self):
+        return [ref["refname"][10:] for ref in self.refs if ref["refname"].startswith("refs/tags/")]
+
+    def remote_names(self):
+        if self.commondir is None or uses_legacy_remotes(self.commondir):
+            return None
+        return remote_names_from_config(self.config)
+
+    def remotes(self):
+        if self.commondir is None or uses_legacy_remotes(self.commondir):
+            return None
+        return remotes_from_config(self.config)
+
+    def ahead_behind(self):
+        """(branch, upstream, ahead, behind) for each local branch with an upstream"""
+        summary = []
+        for ref in self.refs:
+            if ref["refname"].startswith("refs/heads/") and ref["upstream"] is not None:
+                upstream = ref["upstream"]
+                for prefix in ["refs/remotes/", "refs/heads/"]:
+                    if upstream.startswith(prefix):
+                        upstream = upstream[len(prefix):]
+                        break
+                summary.append((ref["refname"][11:], upstream, *parse_track(ref["track"])))
+        return summary
+
+    def all_branches_pushed(self):
+        """True if every local branch is contained in its remote-tracking upstream, which
+        means there is nothing unpushed (found without walking any history)"""
+        for ref in self.refs:
+            if not ref["refname"].startswith("refs/heads/"):
+                continue
+            upstream = ref["upstream"]
+            if upstream is None or not upstream.startswith("refs/remotes/"):
+                return False
+            ahead, behind = parse_track(ref["track"])
+            if ahead is None or ahead > 0:
+                return False
+        return True
+
+# ------------------------------------------------------------------------------------------------
+# Reading refs and config straight from the repository files
+# ------------------------------------------------------------------------------------------------
+
+REFSTORE = 1  # set to 0 to always ask git for refs
+
+# Refs that live in each worktree's own gitdir rather than in the common dir
+PER_WORKTREE_REFS = ("refs/bisect/", "refs/worktree/", "refs/rewritten/")
+
+class RefStore:
+    """Read refs from a repository's files without running git.
+
+    Understands loose refs, packed-refs (including peeled entries), symbolic
+    refs, per-worktree refs of linked worktrees, and reftable stacks. Use
+    open_ref_store() to get one; it returns None for layouts we don't
+    understand, and callers should ask git instead.
+    """
+
+    def __init__(self, gitdir, commondir, config_entries):
+        self.gitdir = gitdir
+        self.commondir = commondir
+        self.config_entries = config_entries
+        self.config_map = dict(config_entries)
+        self.hash_len = 32 if self.config_map.get("extensions.objectformat") == "sha256" else 20
+        self.is_reftable = self.config_map.get("extensions.refstorage") == "reftable"
+
+        # packed-refs is re-read only if its stat changes
+        self.packed_stat = None
+        self.packed = None
+
+    def is_oid(self, value):
+        return len(value) == self.hash_len * 2 and all(c in "0123456789abcdef" for c in value)
+
+    # --------------------------------------------------------------------------------------------
+    # files backend
+
+    def packed_refs(self):
+        """Return {refname: (oid, peeled)} from packed-refs (peeled is None if unknown),
+        or None if it has lines we don't understand"""
+        import os
+
+        path = os.path.join(self.commondir, "packed-refs")
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.packed_stat = None
+            self.packed = dict()
+            return self.packed
+
+        packed_stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if self.packed is not None and packed_stat == self.packed_stat:
+            return self.packed
+
+        # packed-refs looks like this
+        # # pack-refs with: peeled fully-peeled sorted
+        # d43ea8b5cb8e70596f783171627ed66d06aec087 refs/heads/main
+        # 9b1a3c5f0e1d7d2c3b4a5f6e7d8c9b0a1f2e3d4c refs/tags/v1.0
+        # ^d43ea8b5cb8e70596f783171627ed66d06aec087
+        packed = dict()
+        last_refname = None
+        with open(path, "rb") as f:
+            data = f.read().decode("utf-8", errors="surrogateescape")
+        for line in data.splitlines():
+            if line.startswith("#") or len(line) == 0:
+                continue
+            if line.startswith("^"):
+                if last_refname is None:
+                    return None  # a peeled line without a ref
+                packed[last_refname] = (packed[last_refname][0], line[1:])
+                continue
+            oid, sep, refname = line.partition(" ")
+            if not self.is_oid(oid) or len(refname) == 0:
+                return None
+            packed[refname] = (oid, None)
+            last_refname = refname
+
+        self.packed_stat = packed_stat
+        self.packed = packed
+        return packed
+
+    def read_loose_ref(self, path):
+        """Return ('oid', value) or ('symref', target) for a loose ref file, or None"""
+        try:
+            with open(path, "rb") as f:
+                content = f.read().decode("utf-8", errors="surrogateescape").strip()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+        if content.startswith("ref:"):
+            return ("symref", content[4:].strip())
+        if self.is_oid(content[:self.hash_len * 2]):
+            return ("oid", content[:self.hash_len * 2])
+        return None
+
+    def loose_refs(self, base, prefix, refs):
+        """Collect loose refs below base/prefix into refs {refname: value}"""
+        import os
+
+        try:
+            it = os.scandir(os.path.join(base, prefix))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        with it:
+            for entry in it:
+                if entry.name.startswith(".") or entry.name.endswith(".lock"):
+                    continue
+                refname = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    self.loose_refs(base, refname + "/", refs)
+                else:
+                    value = self.read_loose_ref(entry.path)
+                    if value is not None:
+                        refs[refname] = value
+
+    def files_refs(self):
+        """Return {refname: ('oid', oid, peeled) | ('symref', target)} for the files backend,
+        or None if packed-refs can't be read"""
+        import os
+
+        packed = self.packed_refs()
+        if packed is None:
+            return None
+        refs = dict()
+        for refname, (oid, peeled) in packed.items():
+            refs[refname] = ("oid", oid, peeled)
+
+        loose = dict()
+        self.loose_refs(self.commondir, "refs/", loose)
+        if self.gitdir != self.commondir:
+            # per-worktree refs come from this worktree's gitdir, never the common dir
+            loose = {refname: value for refname, value in loose.items()
+                     if not refname.startswith(PER_WORKTREE_REFS)}
+            for prefix in PER_WORKTREE_REFS:
+                self.loose_refs(self.gitdir, prefix, loose)
+            refs = {refname: value for refname, value in refs.items()
+                    if not refname.startswith(PER_WORKTREE_REFS)}
+
+        for refname, value in loose.items():
+            refs[refname] = ("oid", value[1], None) if value[0] == "oid" else value
+
+        head = self.read_loose_ref(os.path.join(self.gitdir, "HEAD"))
+        if head is not None:
+            refs["HEAD"] = ("oid", head[1], None) if head[0] == "oid" else head
+        return refs
+
+    # --------------------------------------------------------------------------------------------
+    # reftable backend
+
+    def reftable_refs(self):
+        """Return {refname: ('oid', oid, peeled) | ('symref', target)} for a reftable stack,
+        or None if a table can't be read"""
+        import os
+
+        refs = dict()
+        stacks = [self.commondir]
+        if self.gitdir != self.commondir:
+            stacks.append(self.gitdir)
+        for stack_dir in stacks:
+            table_dir = os.path.join(stack_dir, "reftable")
+            try:
+                with open(os.path.join(table_dir, "tables.list"), "r", encoding="utf-8") as f:
+                    tables = [line.strip() for line in f if len(line.strip()) > 0]
+            except (OSError, UnicodeDecodeError):
+                return None
+            stack_refs = dict()
+            for table in tables:
+                if not read_reftable(os.path.join(table_dir, table), stack_refs):
+                    return None
+            for refname, value in stack_refs.items():
+                is_per_worktree = refname == "HEAD" or refname.startswith(PER_WORKTREE_REFS)
+                if stack_dir == self.commondir and self.gitdir != self.commondir and is_per_worktree:
+                    continue
+                if value is not None:
+                    refs[refname] = value
+        return refs
+
+    # --------------------------------------------------------------------------------------------
+
+    def read_raw_refs(self):
+        """All refs as {refname: value}, or None if the files have something we don't
+        understand"""
+        if self.is_reftable:
+            return self.reftable_refs()
+        return self.files_refs()
+
+    def raw_refs(self):
+        # open_ref_store() has read them once already, so this only fails if the files
+        # changed into something we can't read since
+        raw = self.read_raw_refs()
+        if raw is None:
+            raise RuntimeError(f"can't read the refs in {self.commondir}")
+        return raw
+
+    def head(self):
+        """Return ('symref', target) or ('oid', oid) for HEAD, or None"""
+        value = self.raw_refs().get("HEAD")
+        if value is None:
+            return None
+        return value[:2]
+
+    def refs(self):
+        """All refs under refs/ as a sorted list of (refname, oid, peeled, symref_target).
+        Symbolic refs are resolved; dangling ones are left out (like git does)."""
+        raw = self.raw_refs()
+        refs = []
+        for refname in sorted(raw):
+            if not refname.startswith("refs/"):
+                continue
+            oid, peeled, target = resolve_raw_ref(raw, refname)
+            if oid is not None:
+                refs.append((refname, oid, peeled, target))
+        return refs
+
+    def resolve(self, refname):
+        """Return the oid a ref (or HEAD) points to, or None"""
+        return resolve_raw_ref(self.raw_refs(), refname)[0]
+
+    # --------------------------------------------------------------------------------------------
+    # queries matching the git commands they replace
+
+    def branches(self):
+        """Same as `git branch --list`, or None if HEAD is detached (git words that line itself)"""
+        head = self.head()
+        if head is not None and head[0] == "oid":
+            return None
+        return [refname[11:] for refname, oid, peeled, target in self.refs()
+                if refname.startswith("refs/heads/")]
+
+    def tags(self):
+        return [refname[10:] for refname, oid, peeled, target in self.refs()
+                if refname.startswith("refs/tags/")]
+
+    def show_ref(self):
+        """Same as `git show-ref --head`"""
+        output = []
+        head = self.resolve("HEAD")
+        if head is not None:
+            output.append(f"{head} HEAD")
+        for refname, oid, peeled, target in self.refs():
+            output.append(f"{oid} {refname}")
+        if len(output) == 0:
+            return None
+        return output
+
+    def remote_names(self):
+        if uses_legacy_remotes(self.commondir):
+            return None
+        return remote_names_from_config(self.config_entries)
+
+    def remotes(self):
+        if uses_legacy_remotes(self.commondir):
+            return None
+        return remotes_from_config(self.config_entries)
+
+def resolve_raw_ref(raw, refname):
+    """Follow symbolic refs; return (oid, peeled, symref_target) or (None, None, None)"""
+    target = None
+    value = raw.get(refname)
+    for depth in range(5):  # git gives up after 5 levels as well
+        if value is None:
+            return None, None, None
+        if value[0] == "oid":
+            return value[1], value[2], target
+        if target is None:
+            target = value[1]
+        value = raw.get(value[1])
+    return None, None, None
+
+def open_ref_store(path, is_bare):
+    """Return a RefStore for the repository at path, or None if the layout is not one we
+    can read ourselves (git will be asked instead)"""
+    import os
+
+    if not REFSTORE or path is None:
+        return None
+    if "GIT_DIR" in os.environ or "GIT_COMMON_DIR" in os.environ:
+        return None
+
+    # Find the gitdir; linked worktrees and submodules have a .git file pointing at it
+    if is_bare:
+        gitdir = path
+    else:
+        dotgit = os.path.join(path, ".git")
+        if os.path.isdir(dotgit):
+            gitdir = dotgit
+        elif os.path.isfile(dotgit):
+            try:
+                with open(dotgit, "r", encoding="utf-8") as f:
+                    content = f.read().strip()
+            except (OSError, UnicodeDecodeError):
+                return None
+            if not content.startswith("gitdir:"):
+                return None
+            gitdir = os.path.join(path, content[7:].strip())
+        else:
+            return None
+    gitdir = os.path.normpath(gitdir)
+
+    commondir = gitdir
+    try:
+        with open(os.path.join(gitdir, "commondir"), "r", encoding="utf-8") as f:
+            commondir = os.path.normpath(os.path.join(gitdir, f.read().strip()))
+    except FileNotFoundError:
+        pass
+    except (OSError, UnicodeDecodeError):
+        return None
+
+    if not os.path.isfile(os.path.join(gitdir, "HEAD")):
+        return None
+
+    config_entries = read_repo_config(gitdir, commondir)
+    if config_entries is None:
+        return None
+    config_map = dict(config_entries)
+    if config_map.get("core.repositoryformatversion", "0") not in ["0", "1"]:
+        return None
+    if config_map.get("extensions.refstorage", "files") not in ["files", "reftable"]:
+        return None
+    if config_map.get("extensions.objectformat", "sha1") not in ["sha1", "sha256"]:
+        return None
+    store = RefStore(gitdir, commondir, config_entries)
+    if store.is_reftable and not os.path.isfile(os.path.join(commondir, "reftable", "tables.list")):
+        return None
+    if store.read_raw_refs() is None:
+        return None
+    return store
+
+# ------------------------------------------------------------------------------------------------
+# reftable (https://git-scm.com/docs/reftable)
+
+def reftable_varint(data, pos):
+    """Decode a reftable varint (same encoding as pack offsets); return (value, new_pos)"""
+    c = data[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
+
+def read_reftable(path, refs):
+    """Apply the ref records of one reftable file to refs {refname: value or None}.
+    Returns False if the file can't be read or has anything we don't understand."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        return parse_reftable(data, refs)
+    except (OSError, IndexError):
+        return False
+
+def parse_reftable(data, refs):
+    if data[:4] != b"REFT" or len(data) < 8:
+        return False
+    version = data[4]
+    if version == 1:
+        header_size, footer_size, hash_len = 24, 68, 20
+    elif version == 2:
+        header_size, footer_size = 28, 72
+        hash_len = 32 if data[24:28] == b"s256" else 20
+    else:
+        return False
+    block_size = int.from_bytes(data[5:8], "big")
+    footer_pos = len(data) - footer_size
+    ref_index_pos = int.from_bytes(data[footer_pos + header_size:footer_pos + header_size + 8], "big")
+    refs_end = ref_index_pos if ref_index_pos > 0 else footer_pos
+
+    block_start = 0
+    while block_start < refs_end:
+        header_pos = block_start + (header_size if block_start == 0 else 0)
+        if data[header_pos:header_pos + 1] != b"r":
+            break
+        block_len = int.from_bytes(data[header_pos + 1:header_pos + 4], "big")
+        block_end = block_start + block_len
+        if block_end > refs_end or block_end < header_pos + 6:
+            return False
+        restart_count = int.from_bytes(data[block_end - 2:block_end], "big")
+        records_end = block_end - 2 - 3 * restart_count
+
+        pos = header_pos + 4
+        last_name = b""
+        while pos < records_end:
+            prefix_len, pos = reftable_varint(data, pos)
+            suffix_and_type, pos = reftable_varint(data, pos)
+            suffix_len = suffix_and_type >> 3
+            value_type = suffix_and_type & 0x7
+            name = last_name[:prefix_len] + data[pos:pos + suffix_len]
+            pos += suffix_len
+            update_index_delta, pos = reftable_varint(data, pos)
+            refname = name.decode("utf-8", errors="surrogateescape")
+            if value_type == 0:
+                refs[refname] = None
+            elif value_type == 1:
+                refs[refname] = ("oid", data[pos:pos + hash_len].hex(), None)
+                pos += hash_len
+            elif value_type == 2:
+                refs[refname] = ("oid", data[pos:pos + hash_len].hex(),
+                                 data[pos + hash_len:pos + 2 * hash_len].hex())
+                pos += 2 * hash_len
+            elif value_type == 3:
+                target_len, pos = reftable_varint(data, pos)
+                refs[refname] = ("symref", data[pos:pos + target_len].decode("utf-8", errors="surrogateescape"))
+                pos += target_len
+            else:
+                return False
+            if pos > records_end:
+                return False
+            last_name = name
+
+        # ref blocks are padded out to block_size unless the table was written unaligned
+        block_start = block_end
+        if block_size > 0 and block_start < refs_end and data[block_start] == 0:
+            block_start = (block_start + block_size - 1) // block_size * block_size
+    return True
+
+# ------------------------------------------------------------------------------------------------
+# git config files
+
+def read_config_file(path, entries):
+    """Append (key, value) pairs from a git config file to entries, in `git config --list`
+    form. Returns False if the file uses features we don't handle (includes)."""
+    try:
+        with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+            text = f.read()
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return True
+
+    section = None
+    pos = 0
+    length = len(text)
+    while pos < length:
+        c = text[pos]
+        if c in " \t\r\n":
+            pos += 1
+        elif c in "#;":
+            pos = text.find("\n", pos)
+            pos = length if pos < 0 else pos
+        elif c == "[":
+            end = text.find("]", pos)
+            if end < 0:
+                return False
+            header = text[pos + 1:end].strip()
+            name, sep, subsection = header.partition(" ")
+            if sep:
+                subsection = subsection.strip()
+                if not (subsection.startswith('"') and subsection.endswith('"')):
+                    return False
+                subsection = subsection[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+                section = f"{name.lower()}.{subsection}"
+            elif "." in name:
+                # deprecated [section.subsection] syntax
+                section = name.lower()
+            else:
+                section = name.lower()
+            pos = end + 1
+        else:
+            # name [= value]
+            start = pos
+            while pos < length and (text[pos].isalnum() or text[pos] == "-"):
+                pos += 1
+            var = text[start:pos].lower()
+            if len(var) == 0 or section is None:
+                return False
+            while pos < length and text[pos] in " \t":
+                pos += 1
+            if pos >= length or text[pos] in "\r\n#;":
+                value = "true"
+            elif text[pos] == "=":
+                value, pos = parse_config_value(text, pos + 1)
+                if value is None:
+                    return False
+            else:
+                return False
+            key = f"{section}.{var}"
+            if section == "include" or section.startswith("includeif."):
+                return False
+            entries.append((key, value))
+    return True
+
+def parse_config_value(text, pos):
+    """Parse a config value starting at pos; return (value, new_pos). value is None if
+    the value is one we can't read (a newline inside quotes)."""
+    value = []
+    pending_space = ""
+    in_quote = False
+    length = len(text)
+    while pos < length:
+        c = text[pos]
+        if c == "\n" and not in_quote:
+            break
+        if c == "\n":
+            return None, pos  # a newline in a quoted value
+        if not in_quote and c in "#;":
+            pos = text.find("\n", pos)
+            pos = length if pos < 0 else pos
+            break
+        if c in " \t\r" and not in_quote:
+            if len(value) > 0:
+                pending_space += " "
+            pos += 1
+            continue
+        if len(pending_space) > 0:
+            value.append(pending_space)
+            pending_space = ""
+        if c == '"':
+            in_quote = not in_quote
+        elif c == "\\":
+            pos += 1
+            c = text[pos] if pos < length else ""
+            if c == "\n":
+                pass  # line continuation
+            elif c == "\r" and text[pos + 1:pos + 2] == "\n":
+                pos += 1
+            else:
+                value.append({"n": "\n", "t": "\t", "b": "\b", '"': '"', "\\": "\\"}.get(c, ""))
+        else:
+            value.append(c)
+        pos += 1
+    return "".join(value), pos
+
+def read_repo_config(gitdir, commondir):
+    """Read system, global, local and worktree config the way git would; returns a list of
+    (key, value), or None if something (includes, GIT_CONFIG_* overrides) is out of reach"""
+    import os
+
+    if "GIT_CONFIG" in os.environ or "GIT_CONFIG_PARAMETERS" in os.environ or "GIT_CONFIG_COUNT" in os.environ:
+        return None
+
+    paths = []
+    if "GIT_CONFIG_NOSYSTEM" not in os.environ:
+        paths.append(os.environ.get("GIT_CONFIG_SYSTEM", "/etc/gitconfig"))
+    if "GIT_CONFIG_GLOBAL" in os.environ:
+        paths.append(os.environ["GIT_CONFIG_GLOBAL"])
+    else:
+        xdg_config = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+        paths.append(os.path.join(xdg_config, "git", "config"))
+        paths.append(os.path.join(os.path.expanduser("~"), ".gitconfig"))
+    paths.append(os.path.join(commondir, "config"))
+
+    entries = []
+    for path in paths:
+        if not read_config_file(path, entries):
+            return None
+    if dict(entries).get("extensions.worktreeconfig", "false").lower() in ["true", "yes", "on", "1"]:
+        if not read_config_file(os.path.join(gitdir, "config.worktree"), entries):
+            return None
+    return entries
+
+def uses_legacy_remotes(commondir):
+    """Remotes can also come from the old remotes/ and branches/ files; we leave those
+    to git itself"""
+    import os
+
+    for sub_path in ["remotes", "branches"]:
+        try:
+            if len(os.listdir(os.path.join(commondir, sub_path))) > 0:
+                return True
+        except OSError:
+            pass
+    return False
+
+def remote_names_from_config(config_entries):
+    """Same as `git remote` given `git config --list` entries"""
+    names = set()
+    for key, value in config_entries:
+        if key.startswith("remote."):
+            name = key[7:].rpartition(".")[0]
+            if len(name) > 0:
+                names.add(name)
+    return sorted(names)
+
+def remotes_from_config(config_entries):
+    """Same as Git.remotes() (name:url, with url.*.insteadOf applied) given config entries"""
+    urls = dict()
+    rewrites = []
+    for key, value in config_entries:
+        if key.startswith("remote.") and key.endswith(".url"):
+            urls.setdefault(key[7:-4], value)
+        elif key.startswith("url.") and key.endswith(".insteadof"):
+            rewrites.append((value, key[4:-10]))
+
+    remotes_report = []
+    for remote_name in sorted(urls):
+        url = urls[remote_name]
+        # the longest matching insteadOf prefix wins
+        best = None
+        for prefix, base in rewrites:
+            if url.startswith(prefix) and (best is None or len(prefix) > len(best[0])):
+                best = (prefix, base)
+        if best is not None:
+            url = best[1] + url[len(best[0]):]
+        remotes_report.append(f"{remote_name}:{url}")
+    return remotes_report
+
+# ------------------------------------------------------------------------------------------------
+# Object store statistics straight from the repository files
+# ------------------------------------------------------------------------------------------------
+
+OBJECT_STATS = 1  # set to 0 to always ask git count-objects
+
+# Files that belong to a pack; they're garbage unless the pack has both .pack and .idx
+PACK_FILE_EXTENSIONS = ("pack", "idx", "rev", "bitmap", "keep", "promisor", "mtimes")
+
+HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+
+class PackIndex:
+    """A pack's .idx file (version 1 or 2), memory-mapped. Opening it reads only the
+    fanout table; contains() binary-searches the object names in place."""
+
+    def __init__(self, path, hash_len=20):
+        import mmap
+        import struct
+
+        self.path = path
+        self.hash_len = hash_len
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self.map[:4] == b"\377tOc":
+                self.version = struct.unpack_from(">I", self.map, 4)[0]
+                if self.version != 2:
+                    raise ValueError(f"unknown pack index version {self.version}")
+                self.fanout_offset = 8
+                self.names_offset = 8 + 256 * 4
+                self.entry_size = hash_len
+            else:
+                # version 1: the fanout table, then (4-byte offset, name) pairs
+                self.version = 1
+                self.fanout_offset = 0
+                self.names_offset = 256 * 4 + 4
+                self.entry_size = 4 + hash_len
+            if len(self.map) < self.fanout_offset + 256 * 4:
+                raise ValueError("pack index is truncated")
+            self.count = struct.unpack_from(">I", self.map, self.fanout_offset + 255 * 4)[0]
+            if len(self.map) < self.names_offset + self.count * self.entry_size:
+                raise ValueError("pack index is truncated")
+        except BaseException:
+            self.map.close()
+            raise
+
+    def close(self):
+        self.map.close()
+
+    def contains(self, oid):
+        """True if the object with this binary name is in the pack"""
+        import struct
+
+        first = oid[0]
+        lo = struct.unpack_from(">I", self.map, self.fanout_offset + (first - 1) * 4)[0] if first > 0 else 0
+        hi = struct.unpack_from(">I", self.map, self.fanout_offset + first * 4)[0]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.names_offset + mid * self.entry_size
+            name = self.map[start:start + self.hash_len]
+            if name == oid:
+                return True
+            if name < oid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+def read_object_stats(objects_dir, hash_len=20):
+    """Return the same dict as `git count-objects -v` (sizes in KiB), from the files in
+    objects_dir, plus "pack-details": a list with the name, object count, sizes and
+    .keep/.promisor/.bitmap flags of each pack. Garbage follows git's rules: unknown
+    files in the pack directory, pack files without both a .pack and an .idx, and
+    files in the loose object directories that aren't objects."""
+    import os
+    import os.path
+
+    def disk_bytes(st):
+        # what count-objects counts: blocks actually used, where the system tells us
+        blocks = getattr(st, "st_blocks", None)
+        return blocks * 512 if blocks is not None else st.st_size
+
+    garbage = 0
+    garbage_bytes = 0
+
+    def add_garbage(entry):
+        # (count-objects takes the plain file size here)
+        nonlocal garbage, garbage_bytes
+        garbage += 1
+        try:
+            garbage_bytes += entry.stat().st_size
+        except OSError:
+            pass
+
+    # Packs, grouped by name without the extension
+    groups = dict()
+    try:
+        with os.scandir(os.path.join(objects_dir, "pack")) as it:
+            for entry in it:
+                name = entry.name
+                if name == "multi-pack-index":
+                    continue
+                if name.startswith("multi-pack-index") and name.endswith((".bitmap", ".rev")):
+                    continue
+                base, dot, ext = name.rpartition(".")
+                if dot and ext in PACK_FILE_EXTENSIONS:
+                    groups.setdefault(base, dict())[ext] = entry
+                else:
+                    add_garbage(entry)
+    except FileNotFoundError:
+        pass
+
+    indexes = []
+    pack_details = []
+    in_pack = 0
+    pack_bytes = 0
+    try:
+        for base, files in sorted(groups.items()):
+            if "pack" not in files or "idx" not in files:
+                for entry in files.values():
+                    add_garbage(entry)
+                continue
+            try:
+                index = PackIndex(files["idx"].path, hash_len)
+                sizes = (files["pack"].stat().st_size, files["idx"].stat().st_size)
+            except (OSError, ValueError):
+                continue  # git skips packs whose index it can't open
+            indexes.append(index)
+            in_pack += index.count
+            pack_bytes += sizes[0] + sizes[1]
+            pack_details.append({
+                "name": base,
+                "objects": index.count,
+                "size-pack": sizes[0] // 1024,
+                "size-idx": sizes[1] // 1024,
+                "keep": "keep" in files,
+                "promisor": "promisor" in files,
+                "bitmap": "bitmap" in files,
+            })
+
+        # Loose objects live in objects/xx/<rest of the name>
+        count = 0
+        loose_bytes = 0
+        prune_packable = 0
+        name_len = hash_len * 2 - 2
+        try:
+            with os.scandir(objects_dir) as it:
+                fanout_dirs = [entry for entry in it if len(entry.name) == 2 and set(entry.name) <= HEX_DIGITS]
+        except FileNotFoundError:
+            fanout_dirs = []
+        for fanout_dir in fanout_dirs:
+            try:
+                with os.scandir(fanout_dir.path) as it:
+                    for entry in it:
+                        if len(entry.name) != name_len or not set(entry.name) <= HEX_DIGITS:
+                            add_garbage(entry)
+                            continue
+                        try:
+                            loose_bytes += disk_bytes(entry.stat(follow_symlinks=False))
+                        except OSError:
+                            continue
+                        count += 1
+                        if len(indexes) > 0:
+                            oid = bytes.fromhex(fanout_dir.name + entry.name)
+                            if any(index.contains(oid) for index in indexes):
+                                prune_packable += 1
+            except NotADirectoryError:
+                continue
+    finally:
+        for index in indexes:
+            index.close()
+
+    return {
+        "count": count,
+        "size": loose_bytes // 1024,
+        "in-pack": in_pack,
+        "packs": len(pack_details),
+        "size-pack": pack_bytes // 1024,
+        "prune-packable": prune_packable,
+        "garbage": garbage,
+        "size-garbage": garbage_bytes // 1024,
+        "pack-details": pack_details,
+    }
+
+# ------------------------------------------------------------------------------------------------
+# Querying remotes
+# ------------------------------------------------------------------------------------------------
+
+LS_REMOTE_JOBS = 8  # how many ls-remote calls may run at once
+LS_REMOTE_TIMEOUT = 30  # seconds before we give up on a remote
+
+remote_queries_instance = None
+
+class RemoteQueries:
+    """Runs `git ls-remote` against remote URLs on a bounded pool of threads.
+
+    Each URL is queried at most once, however many repos share it (callers make local
+    paths absolute first, see remote_query_url). Every call has a
+    deadline so a hung remote can't stall a scan, and credential prompts are turned
+    off (GIT_TERMINAL_PROMPT=0, and ssh BatchMode unless an ssh command is configured).
+    Results are lists of [refhash, refname], or None if the query failed, in which
+    case errors[url] says why.
+    """
+
+    def __init__(self, jobs=None, timeout=None):
+        import concurrent.futures
+        import threading
+
+        self.timeout = timeout if timeout is not None else LS_REMOTE_TIMEOUT
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs if jobs is not None else LS_REMOTE_JOBS)
+        self.lock = threading.Lock()
+        self.futures = dict()
+        self.errors = dict()
+
+    def submit(self, url, cwd=None):
+        """Start (or join) the query for url; returns a Future"""
+        with self.lock:
+            future = self.futures.get(url)
+            if future is None:
+                future = self.pool.submit(self.query, url, cwd)
+                self.futures[url] = future
+            return future
+
+    def ls_remote(self, url, cwd=None):
+        return self.submit(url, cwd).result()
+
+    def query(self, url, cwd):
+        import subprocess
+        import sys
+        import time
+
+        git_cmd = ls_remote_cmd_line(url, cwd)
+        env = ls_remote_env()
+
+        if VERBOSE:
+            print(git_cmd, "(ls-remote)", file=sys.stderr, flush=True)
+
+        # git may leave ssh or a remote helper running, so the call gets its own
+        # process group and the whole group is killed at the deadline
+        start = time.perf_counter()
+        proc = subprocess.Popen(git_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, text=True, env=env, start_new_session=True)
+        try:
+            stdout, stderr = proc.communicate(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_group(proc)
+            proc.communicate()
+            self.errors[url] = f"timed out after {self.timeout} seconds"
+            if PROFILE is not None:
+                PROFILE.record(cwd, ["ls-remote", "--", url], start, 0, proc.returncode, "ls_remote")
+            return None
+        if PROFILE is not None:
+            PROFILE.record(cwd, ["ls-remote", "--", url], start, len(stdout), proc.returncode, "ls_remote")
+
+        if proc.returncode != 0:
+            self.errors[url] = " ".join(stderr.splitlines()) or f"error={proc.returncode}"
+            return None
+
+        return parse_ls_remote(stdout)
+
+def remote_queries():
+    """The RemoteQueries shared by every Git object in this process"""
+    global remote_queries_instance
+    if remote_queries_instance is None:
+        remote_queries_instance = RemoteQueries()
+    return remote_queries_instance
+
+def remote_query_url(url, cwd):
+    """The URL to query for a remote URL configured in the repo at cwd. A relative path
+    names a different repository depending on where it's configured, so local paths
+    are made absolute; other URLs (scheme://..., host:path, transport::address) mean
+    the same thing from anywhere."""
+    import os.path
+
+    if "://" in url:
+        return url
+    colon = url.find(":")
+    slash = url.find("/")
+    if colon > 1 and (slash < 0 or colon < slash):
+        return url  # scp-like host:path (a single letter before the colon is a drive)
+    if cwd is None or os.path.isabs(url) or url.startswith("~"):
+        return url
+    return os.path.normpath(os.path.join(os.path.abspath(cwd), url)).replace("\\", "/")
+
+def ls_remote_cmd_line(url, cwd):
+    git_cmd = [find_git()]
+    if cwd is not None:
+        git_cmd += ["-C", cwd]
+    # have ssh fail rather than prompt, unless the user has picked their own ssh command
+    if not ssh_command_configured(cwd):
+        git_cmd += ["-c", "core.sshCommand=ssh -o BatchMode=yes"]
+    git_cmd += ["ls-remote", "--", url]
+    return git_cmd
+
+ssh_commands = dict()  # cwd -> True if core.sshCommand is set there (cached)
+
+def ssh_command_configured(cwd):
+    """True if GIT_SSH_COMMAND, GIT_SSH or core.sshCommand (in any config git reads
+    at cwd) says which ssh to run"""
+    import os
+    import subprocess
+
+    if "GIT_SSH_COMMAND" in os.environ or "GIT_SSH" in os.environ:
+        return True
+    if cwd not in ssh_commands:
+        git_cmd = [find_git()]
+        if cwd is not None:
+            git_cmd += ["-C", cwd]
+        result = subprocess.run([*git_cmd, "config", "--get", "core.sshCommand"], capture_output=True)
+        ssh_commands[cwd] = result.returncode == 0
+    return ssh_commands[cwd]
+
+def ls_remote_env():
+    """Environment for ls-remote that makes git fail rather than ask for credentials"""
+    import os
+
+    env = dict(os.environ)
+    env["GIT_TERMINAL_PROMPT"] = "0"
+    return env
+
+def parse_ls_remote(stdout):
+    """[refhash, refname] pairs from ls-remote output"""
+    # the output looks like this
+    # d43ea8b5cb8e70596f783171627ed66d06aec087        refs/heads/main
+    import re
+
+    refs = []
+    for line in stdout.splitlines():
+        m = re.fullmatch(r'([a-fA-F0-9]+)\s+(.+)', line)
+        if m is None:
+            raise RuntimeError(f"failed to match: {line}")
+        refs.append([m.group(1), m.group(2)])
+    return refs
+
+def kill_process_group(proc):
+    import os
+    import signal
+
+    if hasattr(os, "killpg"):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        proc.kill()
+
+# ------------------------------------------------------------------------------------------------
+# Commit graph
+# ------------------------------------------------------------------------------------------------
+
+COMMIT_GRAPH = 1  # set to 0 to answer history queries with separate git commands
+COMMIT_GRAPH_FILE = 1  # set to 0 to always run rev-list, even if git has written a commit-graph
+
+class CommitGraph:
+    """Every commit reachable from any ref, read with a single streamed `git rev-list --all`,
+    or straight from the repository's commit-graph file when it is there and up to date.
+
+    Commits are numbered in rev-list order, and everything is kept in flat arrays:
+    object ids packed 20 (or 32) bytes apiece, commit times and timezone offsets, and
+    the parent indices of each commit (parents[parent_start[i]:parent_start[i+1]]).
+    index() finds a commit by binary search over the oids in sorted order, narrowed
+    by a fanout table on the first byte, like git's own index files.
+    num_commits(), last_commit_date(), roots(), unmerged() and unpushed() on Git are
+    answered from this instead of each walking history again.
+    """
+
+    def __init__(self, repo):
+        import array
+
+        self.repo = repo
+        self.hash_len = 20
+        self.oids = bytearray()
+        self.times = array.array('q')
+        self.tz_offsets = array.array('h')  # minutes east of UTC; None if we don't know them
+        self.parent_start = array.array('l', [0])
+        self.parents = array.array('l')
+        self.sorted_oids = b""  # the oids again, in sorted order
+        self.sorted_index = array.array('l')  # index of each oid in sorted_oids
+        self.fanout = array.array('l', [0] * 257)  # sorted_oids[fanout[b]:fanout[b+1]] start with byte b
+        self.from_file = bool(COMMIT_GRAPH_FILE) and self.build_from_file()
+        if not self.from_file:
+            self.build()
+
+    def build(self):
+        import array
+
+        # Parents usually show up after their children, so collect them as oids and
+        # turn them into indices once we have seen every commit
+        parent_oids = bytearray()
+        output = self.repo.iter_git_cmd(
+            ["rev-list", "--all", "--no-commit-header", "--format=%H %ct %cI %P"], binary=True)
+        for line in output:
+            fields = line.split()
+            oid = bytes.fromhex(fields[0].decode('ascii'))
+            self.hash_len = len(oid)
+            self.oids += oid
+            self.times.append(int(fields[1]))
+            iso_date = fields[2].decode('ascii')
+            offset = 0 if iso_date.endswith("Z") else int(iso_date[-6:-3]) * 60 + int(iso_date[-6] + iso_date[-2:])
+            self.tz_offsets.append(offset)
+            for parent in fields[3:]:
+                parent_oids += bytes.fromhex(parent.decode('ascii'))
+            self.parent_start.append(len(parent_oids) // self.hash_len)
+        if self.repo.returncode != 0:
+            raise RuntimeError(f"could not read commits of {self.repo.gitdir}")
+
+        self.build_lookup()
+
+        # Parents we never saw are beyond a shallow boundary; like git, treat those
+        # commits as having no parents
+        hash_len = self.hash_len
+        starts = self.parent_start
+        remapped_start = array.array('l', [0])
+        for i in range(len(self.times)):
+            for pos in range(starts[i], starts[i + 1]):
+                parent = self.find(parent_oids[pos * hash_len:(pos + 1) * hash_len])
+                if parent is not None:
+                    self.parents.append(parent)
+            remapped_start.append(len(self.parents))
+        self.parent_start = remapped_start
+
+    def build_from_file(self):
+        """Fill in the arrays from the commit-graph file, in the order rev-list would have
+        listed the commits, without running git. Returns False, having filled in nothing,
+        if there's no usable graph file or it's missing the commit of some ref."""
+        import array
+        import heapq
+        import os
+        import os.path
+
+        refstore = self.repo.refstore
+        if refstore is None or "GIT_OBJECT_DIRECTORY" in os.environ:
+            return False
+
+        if self.repo.history_rewritten():
+            return False
+
+        try:
+            graph_file = CommitGraphFile(os.path.join(refstore.commondir, "objects"), refstore.hash_len)
+        except (OSError, ValueError):
+            return False
+        try:
+            tips = self.file_tips(graph_file)
+            if tips is None:
+                return False
+
+            # rev-list keeps a list of commits ordered by date, newest first; it takes the
+            # first one, then puts each parent it hasn't seen yet behind any commits with
+            # the same date. The sequence number in the heap does the same tie-breaking.
+            queue = []
+            seen = set()
+            for pos in tips:
+                if pos not in seen:
+                    seen.add(pos)
+                    time, parents = graph_file.commit(pos)
+                    queue.append((-time, len(queue), pos, parents))
+            heapq.heapify(queue)
+            sequence = len(queue)
+
+            oids = bytearray()
+            times = array.array('q')
+            parent_start = array.array('l', [0])
+            parent_positions = array.array('l')
+            index_of = dict()  # position in the file -> index
+            while len(queue) > 0:
+                time, _, pos, parents = heapq.heappop(queue)
+                index_of[pos] = len(times)
+                oids += graph_file.oid(pos)
+                times.append(-time)
+                for parent in parents:
+                    parent_positions.append(parent)
+                    if parent not in seen:
+                        seen.add(parent)
+                        parent_time, grandparents = graph_file.commit(parent)
+                        heapq.heappush(queue, (-parent_time, sequence, parent, grandparents))
+                        sequence += 1
+                parent_start.append(len(parent_positions))
+        except ValueError:
+            return False  # a damaged file; rev-list will do
+        finally:
+            single_layer = len(graph_file.layers) == 1
+            graph_file.close()
+
+        hash_len = refstore.hash_len
+        self.hash_len = hash_len
+        self.oids = oids
+        self.times = times
+        self.tz_offsets = None  # the graph file doesn't record them
+        self.parent_start = parent_start
+        self.parents = array.array('l', (index_of[pos] for pos in parent_positions))
+        # a single graph file lists its commits sorted by oid, so we needn't sort them
+        if single_layer:
+            self.build_lookup([index_of[pos] for pos in sorted(index_of)])
+        else:
+            self.build_lookup()
+        return True
+
+    def build_lookup(self, order=None):
+        """Fill in sorted_oids, sorted_index and fanout for index(). order is the
+        indices of the commits sorted by oid, if the caller already knows it."""
+        import array
+
+        hash_len = self.hash_len
+        oids = self.oids
+        if order is None:
+            order = sorted(range(len(self.times)), key=lambda i: oids[i * hash_len:(i + 1) * hash_len])
+        self.sorted_oids = b"".join(oids[i * hash_len:(i + 1) * hash_len] for i in order)
+        self.sorted_index = array.array('l', order)
+        counts = [0] * 256
+        for pos in range(0, len(self.sorted_oids), hash_len):
+            counts[self.sorted_oids[pos]] += 1
+        fanout = array.array('l', [0])
+        for count in counts:
+            fanout.append(fanout[-1] + count)
+        self.fanout = fanout
+
+    def file_tips(self, graph_file):
+        """Positions in graph_file of the commits `rev-list --all` starts from, in its
+        order: every ref, then HEAD, then the HEADs of the other worktrees. Tags are
+        peeled and refs to other kinds of objects are left out. Returns None if one of
+        them is a commit the file doesn't have (the graph was written before the ref
+        last moved)."""
+        import os
+        import os.path
+
+        refstore = self.repo.refstore
+        candidates = []  # (oid, peeled oid or None)
+        for refname, oid, peeled, target in self.repo.ref_tips():
+            candidates.append((oid, peeled))
+        head = self.repo.head_commit()
+        if head is not None:
+            candidates.append((head, None))
+
+        # the HEADs of the main worktree (if we're in a linked one) and the linked worktrees
+        head_paths = []
+        if refstore.gitdir != refstore.commondir:
+            head_paths.append(os.path.join(refstore.commondir, "HEAD"))
+        worktrees_dir = os.path.join(refstore.commondir, "worktrees")
+        try:
+            names = sorted(os.listdir(worktrees_dir))
+        except OSError:
+            names = []
+        if len(names) > 0 and refstore.is_reftable:
+            return None  # their HEADs are in per-worktree tables
+        for name in names:
+            path = os.path.join(worktrees_dir, name)
+            if os.path.abspath(path) != os.path.abspath(refstore.gitdir):
+                head_paths.append(os.path.join(path, "HEAD"))
+        for path in head_paths:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    value = f.read().strip()
+            except OSError:
+                continue
+            if value.startswith("ref: "):
+                value = refstore.resolve(value[5:])
+            if value is not None and refstore.is_oid(value):
+                candidates.append((value, None))
+
+        tips = []
+        unknown = []  # (place in tips, oid) for objects that aren't commits in the file
+        for oid, peeled in candidates:
+            pos = graph_file.position(bytes.fromhex(peeled or oid))
+            if pos is None:
+                unknown.append((len(tips), peeled or oid))
+            tips.append(pos)
+
+        # these are tags that don't record what they point at, other kinds of objects,
+        # or commits the file is missing; one cat-file tells them apart
+        if len(unknown) > 0:
+            request = "".join(f"{oid}^{{}}\n" for place, oid in unknown)
+            output = self.repo.run_git_cmd(["cat-file", "--batch-check=%(objecttype) %(objectname)"], input=request)
+            if output is None or len(output) != len(unknown):
+                return None
+            for (place, oid), line in zip(unknown, output):
+                fields = line.split()
+                if len(fields) == 2 and fields[0] == "commit":
+                    tips[place] = graph_file.position(bytes.fromhex(fields[1]))
+                    if tips[place] is None:
+                        return None
+        return [pos for pos in tips if pos is not None]
+
+    def __len__(self):
+        return len(self.times)
+
+    def oid(self, i):
+        return self.oids[i * self.hash_len:(i + 1) * self.hash_len].hex()
+
+    def index(self, oid):
+        """Index of a commit given its hex oid, or None if it isn't in the graph"""
+        return self.find(bytes.fromhex(oid))
+
+    def find(self, oid):
+        """Index of a commit given its binary oid, or None if it isn't in the graph"""
+        if len(oid) != self.hash_len:
+            return None
+        hash_len = self.hash_len
+        sorted_oids = self.sorted_oids
+        lo = self.fanout[oid[0]]
+        hi = self.fanout[oid[0] + 1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = sorted_oids[mid * hash_len:(mid + 1) * hash_len]
+            if name == oid:
+                return self.sorted_index[mid]
+            if name < oid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def parents_of(self, i):
+        return self.parents[self.parent_start[i]:self.parent_start[i + 1]]
+
+    def reachable(self, starts):
+        """Return a bytearray marking every commit reachable from the indices in starts"""
+        seen = bytearray(len(self.times))
+        parents = self.parents
+        parent_start = self.parent_start
+        stack = list(starts)
+        while len(stack) > 0:
+            i = stack.pop()
+            if seen[i]:
+                continue
+            seen[i] = 1
+            stack.extend(parents[parent_start[i]:parent_start[i + 1]])
+        return seen
+
+    def tip_indices(self, tips):
+        """Indices for a list of hex oids, skipping ones that aren't commits in the graph"""
+        indices = []
+        for oid in tips:
+            i = self.index(oid)
+            if i is not None:
+                indices.append(i)
+        return indices
+
+    def short_date(self, i):
+        """Commit date of commit i as YYYY-MM-DD in the committer's timezone (like %cs)"""
+        import datetime
+
+        if self.tz_offsets is None:
+            output = self.repo.run_git_cmd(["log", "-1", "--no-walk", "--format=format:%cs", self.oid(i)])
+            if output is not None and len(output) > 0:
+                return output[0]
+            return None
+        stamp = datetime.datetime.fromtimestamp(self.times[i] + 60 * self.tz_offsets[i], datetime.timezone.utc)
+        return stamp.strftime("%Y-%m-%d")
+
+    # --------------------------------------------------------------------------------------------
+
+    def last_commit(self):
+        """Index of the commit `git log --all -1 --date-order` would show, or None.
+        That is the newest commit that isn't a parent of any other commit."""
+        has_child = bytearray(len(self.times))
+        for parent in self.parents:
+            has_child[parent] = 1
+        best = None
+        for i in range(len(self.times)):
+            if not has_child[i] and (best is None or self.times[i] > self.times[best]):
+                best = i
+        return best
+
+    def roots(self):
+        """Indices of commits without parents, in rev-list order"""
+        parent_start = self.parent_start
+        return [i for i in range(len(self.times)) if parent_start[i] == parent_start[i + 1]]
+
+    def propagate(self, starts, targets):
+        """Work out which refs reach each commit in targets.
+
+        starts maps commit index -> bitmask of the refs pointing at it. Masks are pushed
+        from children to parents in one topological pass, so the result is every ref
+        that contains each target, as {target index: mask}."""
+        n = len(self.times)
+        parents = self.parents
+        parent_start = self.parent_start
+
+        # number of children each commit is still waiting on
+        pending = array_of_counts(n, parents)
+        masks = [0] * n
+        for i, bits in starts.items():
+            masks[i] |= bits
+        wanted = set(targets)
+        result = dict()
+
+        ready = [i for i in range(n) if pending[i] == 0]
+        while len(ready) > 0:
+            i = ready.pop()
+            bits = masks[i]
+            for parent in parents[parent_start[i]:parent_start[i + 1]]:
+                masks[parent] |= bits
+                pending[parent] -= 1
+                if pending[parent] == 0:
+                    ready.append(parent)
+            if i in wanted:
+                result[i] = bits
+            masks[i] = 0  # done with it; keeps big masks from piling up
+        return result
+
+    def mask_excluding(self, include, exclude):
+        """Return a bytearray marking commits reachable from include but not from exclude,
+        where both are lists of hex oids. With include=None, all commits are included."""
+        hidden = self.reachable(self.tip_indices(exclude))
+        if include is None:
+            return bytearray(1 - hide for hide in hidden)
+        shown = self.reachable(self.tip_indices(include))
+        return bytearray(show & (1 - hide) for show, hide in zip(shown, hidden))
+
+    def excluding(self, include, exclude):
+        """Indices (in rev-list order) reachable from include but not from exclude"""
+        mask = self.mask_excluding(include, exclude)
+        return [i for i in range(len(mask)) if mask[i]]
+
+class CommitGraphFile:
+    """The commit-graph git writes (with `git commit-graph write`, gc or maintenance):
+    objects/info/commit-graph, or else a chain of split graphs listed in
+    objects/info/commit-graphs/commit-graph-chain. Each file is memory-mapped and read
+    in place. Positions run across the whole chain, base graph first; that's how
+    parents refer to each other.
+
+    Raises OSError if there is no graph and ValueError if it doesn't look right."""
+
+    PARENT_NONE = 0x70000000
+    EXTRA_EDGES = 0x80000000  # in the second parent: the rest are in the EDGE chunk
+    LAST_EDGE = 0x80000000
+
+    def __init__(self, objects_dir, hash_len=20):
+        import os.path
+
+        self.hash_len = hash_len
+        self.layers = []
+        self.count = 0
+
+        # git reads the single file if there is one, and only then looks for a chain
+        info_dir = os.path.join(objects_dir, "info")
+        paths = [os.path.join(info_dir, "commit-graph")]
+        if not os.path.exists(paths[0]):
+            chain_dir = os.path.join(info_dir, "commit-graphs")
+            with open(os.path.join(chain_dir, "commit-graph-chain"), "r", encoding="ascii") as f:
+                paths = [os.path.join(chain_dir, f"graph-{line.strip()}.graph") for line in f if line.strip()]
+            if len(paths) == 0:
+                raise ValueError("empty commit-graph chain")
+        try:
+            for path in paths:
+                layer = CommitGraphLayer(path, hash_len, len(self.layers), self.count)
+                self.layers.append(layer)
+                self.count += layer.count
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        for layer in self.layers:
+            layer.close()
+
+    def __len__(self):
+        return self.count
+
+    def layer(self, pos):
+        if pos < 0 or pos >= self.count:
+            raise ValueError(f"commit-graph position {pos} out of range")
+        for layer in reversed(self.layers):
+            if pos >= layer.base:
+                return layer
+
+    def position(self, oid):
+        """Position of the commit with this binary oid, or None if it isn't in the graph"""
+        for layer in self.layers:
+            pos = layer.position(oid)
+            if pos is not None:
+                return layer.base + pos
+        return None
+
+    def oid(self, pos):
+        layer = self.layer(pos)
+        start = layer.oids_offset + (pos - layer.base) * self.hash_len
+        return layer.map[start:start + self.hash_len]
+
+    def entry(self, pos):
+        """(layer, parent1, parent2, generation, commit time) from the CDAT chunk"""
+        import struct
+
+        layer = self.layer(pos)
+        start = layer.data_offset + (pos - layer.base) * (self.hash_len + 16) + self.hash_len
+        parent1, parent2, high, low = struct.unpack_from(">IIII", layer.map, start)
+        # the generation is the top 30 bits; the time has 34 bits, the rest of the 64
+        return layer, parent1, parent2, high >> 2, ((high & 0x3) << 32) | low
+
+    def commit(self, pos):
+        """(commit time, [parent positions]) for the commit at pos"""
+        import struct
+
+        layer, parent1, parent2, generation, time = self.entry(pos)
+        parents = []
+        if parent1 != self.PARENT_NONE:
+            parents.append(parent1)
+        if parent2 == self.PARENT_NONE:
+            pass
+        elif parent2 & self.EXTRA_EDGES:
+            if layer.edges_offset is None:
+                raise ValueError("commit-graph has octopus merges but no EDGE chunk")
+            edge = parent2 & ~self.EXTRA_EDGES
+            while True:
+                start = layer.edges_offset + edge * 4
+                if start + 4 > layer.edges_end:
+                    raise ValueError("commit-graph EDGE chunk is truncated")
+                value = struct.unpack_from(">I", layer.map, start)[0]
+                parents.append(value & ~self.LAST_EDGE)
+                if value & self.LAST_EDGE:
+                    break
+                edge += 1
+        else:
+            parents.append(parent2)
+        for parent in parents:
+            if parent >= self.count:
+                raise ValueError(f"commit-graph parent {parent} out of range")
+        return time, parents
+
+    def generation(self, pos):
+        """Topological level of the commit at pos: 1 for roots, otherwise one more than
+        the highest of its parents (0 if the graph was written without them)"""
+        return self.entry(pos)[3]
+
+class CommitGraphLayer:
+    """One file of a commit-graph (see CommitGraphFile); positions here are local, and
+    base is how many commits the layers below hold."""
+
+    def __init__(self, path, hash_len, num_base, base):
+        import mmap
+        import struct
+
+        self.path = path
+        self.hash_len = hash_len
+        self.base = base
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # header: signature, version, hash version, number of chunks, number of base graphs
+            if len(self.map) < 8 or self.map[:4] != b"CGPH":
+                raise ValueError(f"{path} is not a commit-graph")
+            version, hash_version, num_chunks, file_num_base = self.map[4], self.map[5], self.map[6], self.map[7]
+            if version != 1:
+                raise ValueError(f"unknown commit-graph version {version}")
+            if {1: 20, 2: 32}.get(hash_version) != hash_len:
+                raise ValueError(f"commit-graph {path} uses a different hash")
+            if file_num_base != num_base:
+                raise ValueError(f"commit-graph {path} doesn't fit its place in the chain")
+
+            # the table of contents has an extra entry marking where the last chunk ends
+            if len(self.map) < 8 + (num_chunks + 1) * 12:
+                raise ValueError(f"commit-graph {path} is truncated")
+            chunks = dict()
+            table = [struct.unpack_from(">4sQ", self.map, 8 + i * 12) for i in range(num_chunks + 1)]
+            for (chunk_id, start), (_, end) in zip(table, table[1:]):
+                if start > end or end > len(self.map):
+                    raise ValueError(f"commit-graph {path} has a bad chunk table")
+                chunks[chunk_id] = (start, end)
+            for chunk_id in (b"OIDF", b"OIDL", b"CDAT"):
+                if chunk_id not in chunks:
+                    raise ValueError(f"commit-graph {path} has no {chunk_id.decode()} chunk")
+
+            self.fanout_offset, fanout_end = chunks[b"OIDF"]
+            if fanout_end - self.fanout_offset < 256 * 4:
+                raise ValueError(f"commit-graph {path} has a short fanout table")
+            self.count = struct.unpack_from(">I", self.map, self.fanout_offset + 255 * 4)[0]
+            self.oids_offset, oids_end = chunks[b"OIDL"]
+            self.data_offset, data_end = chunks[b"CDAT"]
+            if oids_end - self.oids_offset < self.count * hash_len or data_end - self.data_offset < self.count * (hash_len + 16):
+                raise ValueError(f"commit-graph {path} is truncated")
+            self.edges_offset, self.edges_end = chunks.get(b"EDGE", (None, None))
+        except BaseException:
+            self.map.close()
+            raise
+
+    def close(self):
+        self.map.close()
+
+    def position(self, oid):
+        """Local position of the commit with this binary oid, or None"""
+        import struct
+
+        first = oid[0]
+        lo = struct.unpack_from(">I", self.map, self.fanout_offset + (first - 1) * 4)[0] if first > 0 else 0
+        hi = struct.unpack_from(">I", self.map, self.fanout_offset + first * 4)[0]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.oids_offset + mid * self.hash_len
+            name = self.map[start:start + self.hash_len]
+            if name == oid:
+                return mid
+            if name < oid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+# The empty tree, for sha1 and sha256 repositories
+EMPTY_TREES = {"4b825dc642cb6eb9a060e54bf8d69288fbee4904",
+               "6ef19b41225c5369f1c104d45d8d85efa9b057b53b14b4b9b939dd74decc5321"}
+
+def parse_track(track):
+    """Parse %(upstream:track,nobracket) ("ahead 1, behind 2", "gone" or "") into
+    (ahead, behind); both are None for a gone upstream"""
+    if track == "gone":
+        return None, None
+    ahead, behind = 0, 0
+    for part in track.split(", "):
+        if part.startswith("ahead "):
+            ahead = int(part[6:])
+        elif part.startswith("behind "):
+            behind = int(part[7:])
+    return ahead, behind
+
+def array_of_counts(n, values):
+    """array('l') of length n counting how often each index appears in values"""
+    import array
+
+    counts = array.array('l', bytes(n * array.array('l').itemsize))
+    for value in values:
+        counts[value] += 1
+    return counts
+
+# ------------------------------------------------------------------------------------------------
+# Profiling git commands
+# ------------------------------------------------------------------------------------------------
+
+PROFILE = None  # a Profile to record every git command in, or None for no profiling
+
+# Methods that run git on behalf of others; we credit a command to whoever called them
+PROFILE_PLUMBING = {"run_git_cmd", "iter_git_cmd", "first_record", "wrapper"}
+
+class Profile:
+    """Records each git command run while it is gitlib.PROFILE: its subcommand, the
+    Git method it was run for, when it started, how long it took, how many bytes of
+    output it produced and its exit status.
+
+    summary() groups the records by subcommand and by method, and write_trace()
+    saves them as Chrome trace events (for chrome://tracing or ui.perfetto.dev).
+    Safe to use from several threads.
+    """
+
+    def __init__(self):
+        import threading
+        import time
+
+        self.lock = threading.Lock()
+        self.records = []
+        self.origin = time.perf_counter()
+
+    def record(self, repo, cmd, start, nbytes, returncode, method=None):
+        """Record a command that started at start (a time.perf_counter() value) and
+        has just finished. cmd is the argv after "git"; the method is found from
+        the call stack unless given."""
+        import os
+        import threading
+        import time
+
+        seconds = time.perf_counter() - start
+        if method is None:
+            method = calling_method()
+        entry = {
+            "subcommand": git_subcommand(cmd),
+            "method": method,
+            "repo": os.path.abspath(repo) if repo is not None else os.getcwd(),
+            "argv": cmd,
+            "start": start - self.origin,
+            "seconds": seconds,
+            "bytes": nbytes,
+            "returncode": returncode,
+            "thread": threading.get_ident(),
+        }
+        with self.lock:
+            self.records.append(entry)
+
+    def summary(self):
+        """Return the summary tables as a list of lines"""
+        with self.lock:
+            records = self.records[:]
+
+        total = sum(entry["seconds"] for entry in records)
+        lines = [f"git commands: {len(records)}, {total:.3f}s"]
+        for group in ["subcommand", "method"]:
+            lines.append("")
+            lines.append(f"{'by ' + group:<24} {'count':>7} {'total':>9} {'p50':>8} {'p95':>8} {'max':>8} {'bytes':>11} {'errors':>6}")
+            groups = dict()
+            for entry in records:
+                groups.setdefault(entry[group], []).append(entry)
+            for name, entries in sorted(groups.items(), key=lambda item: -sum(entry["seconds"] for entry in item[1])):
+                seconds = sorted(entry["seconds"] for entry in entries)
+                nbytes = sum(entry["bytes"] for entry in entries)
+                errors = sum(1 for entry in entries if entry["returncode"] != 0)
+                lines.append(f"{name:<24} {len(seconds):>7} {sum(seconds):>9.3f} {percentile(seconds, 50):>8.3f} "
+                             f"{percentile(seconds, 95):>8.3f} {seconds[-1]:>8.3f} {nbytes:>11} {errors:>6}")
+        return lines
+
+    def write_trace(self, path):
+        """Save the records as Chrome trace events (one complete event per command)"""
+        import json
+        import os
+
+        with self.lock:
+            records = self.records[:]
+
+        threads = dict()
+        events = []
+        for entry in records:
+            tid = threads.setdefault(entry["thread"], len(threads) + 1)
+            events.append({
+                "name": entry["subcommand"],
+                "cat": entry["method"],
+                "ph": "X",
+                "ts": round(entry["start"] * 1e6),
+                "dur": round(entry["seconds"] * 1e6),
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {
+                    "repo": entry["repo"],
+                    "method": entry["method"],
+                    "argv": " ".join(entry["argv"]),
+                    "bytes": entry["bytes"],
+                    "returncode": entry["returncode"],
+                },
+            })
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def git_subcommand(cmd):
+    """The git subcommand in cmd (the argv after "git"), skipping options like -c"""
+    i = 0
+    while i < len(cmd):
+        if cmd[i] in ("-c", "-C"):
+            i += 2
+        elif cmd[i].startswith("-"):
+            i += 1
+        else:
+            return cmd[i]
+    return "git"
+
+def calling_method():
+    """Name of the Git (or AsyncGit) method a git command is being run for"""
+    import sys
+
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_code.co_name not in PROFILE_PLUMBING and isinstance(frame.f_locals.get("self"), (Git, AsyncGit)):
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return "?"
+
+def percentile(values, p):
+    """The p-th percentile of sorted values (nearest rank)"""
+    import math
+
+    rank = max(1, math.ceil(len(values) * p / 100))
+    return values[rank - 1]
+
+# ------------------------------------------------------------------------------------------------
+
+def find_git():
+    """Return the path of the git executable (cached)"""
+    global git_exe
+    if git_exe is None:
+        import shutil
+        git_exe = shutil.which("git")
+        if git_exe is None:
+            raise RuntimeError("Could not find location of 'git' binary")
+    return git_exe
+
+def find_git_version():
+    """Return the git version as a tuple of ints (cached)"""
+    global git_version
+    if git_version is None:
+        import re
+        import subprocess
+
+        result = subprocess.run([find_git(), "version"], capture_output=True, text=True)
+        m = re.search(r'(\d+)\.(\d+)(?:\.(\d+))?', result.stdout)
+        if m is None:
+            raise RuntimeError(f"Could not parse git version from '{result.stdout.strip()}'")
+        git_version = tuple(int(part or 0) for part in m.groups())
+    return git_version
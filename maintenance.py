@@ -0,0 +1,290 @@
+# maintenance.py
+# - tidy the object stores of the repos under a directory: gc, repack, and write
+#   multi-pack-indexes and commit-graphs where the object stats say they're needed
+#
+# Run with "analyze.py --maintain" (add --dry-run to only see the plan).
+#
+# Each repo gets a plan from count_objects() and what's in its objects directory:
+# - gc when there are too many packs
+# - otherwise, prune-packed when there are loose objects that are also in a pack, a
+#   repack (of the loose objects into a new pack) when there are too many loose objects,
+#   a multi-pack-index when there's more than one pack and no up to date index covers
+#   them, and a commit-graph when there's none that has every ref's commit (never for
+#   shallow clones or repos with grafts or replace refs, whose history git rewrites)
+#
+# The plans run on a pool of --jobs workers, biggest expected win first, with at most
+# --io-budget MB being written at once. The queries analyze runs are timed before and
+# after, so each repo's report shows what the work bought (only roughly with --jobs > 1,
+# since the other plans are running at the same time; use --jobs 1 for fair numbers).
+
+# When to act. git's own gc --auto waits for 6700 loose objects or 50 packs; we're
+# keener, since every query we run pays for a badly packed repo.
+LOOSE_OBJECTS_LIMIT = 1000
+PACKS_LIMIT = 10
+
+# The git command for each step
+STEP_COMMANDS = {
+    "gc": ["gc", "--quiet"],
+    "prune-packed": ["prune-packed", "-q"],
+    "repack": ["repack", "-d", "-l", "-q"],
+    "multi-pack-index": ["multi-pack-index", "write", "--no-progress"],
+    "commit-graph": ["commit-graph", "write", "--reachable", "--no-progress"],
+}
+
+# Queries timed before and after (the ones that read history and objects), taking the
+# best of LATENCY_RUNS rounds; the worktree ones are skipped for bare repos
+LATENCY_QUERIES = ["branches", "num_commits", "last_commit_date", "roots", "count_objects",
+                   "count_unmerged", "count_unpushed", "ahead_behind"]
+WORKTREE_QUERIES = {"count_unmerged", "count_unpushed", "ahead_behind"}
+LATENCY_RUNS = 3
+
+def plan(repo):
+    """Decide what repo's object store needs. Returns (steps, objects, io_bytes): the
+    steps in the order to run them, how many objects (or commits) they make cheaper
+    to look up, which is how we pick the biggest wins, and a rough count of the bytes
+    they'll write."""
+    import os.path
+
+    objects_dir = os.path.join(repo.refstore.commondir, "objects")
+    stats = repo.count_objects()
+    loose = stats.get("count", 0)
+    loose_bytes = stats.get("size", 0) * 1024
+    in_pack = stats.get("in-pack", 0)
+    pack_bytes = stats.get("size-pack", 0) * 1024
+    details = stats.get("pack-details", [])
+    packs = len([pack for pack in details if not pack["keep"]])
+
+    # a full gc packs everything into one pack, prunes, and writes the commit-graph.
+    # Garbage doesn't count: gc only clears it out once it's older than the prune
+    # expiry, so we'd be back every time.
+    if packs > PACKS_LIMIT:
+        return ["gc"], loose + in_pack, loose_bytes + pack_bytes
+
+    steps = []
+    objects = 0
+    io_bytes = 0
+
+    # loose copies of packed objects only need deleting; it writes nothing
+    prune_packable = min(stats.get("prune-packable", 0), loose)
+    if prune_packable > 0:
+        steps.append("prune-packed")
+        objects += prune_packable
+        loose_bytes -= loose_bytes * prune_packable // loose
+        loose -= prune_packable
+
+    if loose > LOOSE_OBJECTS_LIMIT:
+        steps.append("repack")
+        objects += loose
+        io_bytes += loose_bytes
+        packs += 1
+        in_pack += loose
+
+    if packs > 1 and ("repack" in steps or not multi_pack_index_current(objects_dir)):
+        steps.append("multi-pack-index")
+        objects += in_pack
+        io_bytes += in_pack * (repo.refstore.hash_len + 8)
+
+    # with grafts, replace refs or a shallow clone we never read the graph file, so
+    # writing one wouldn't change what we plan next time
+    graph = None if repo.history_rewritten() else repo.commit_graph()
+    if graph is not None and len(graph) > 0 and not commit_graph_current(repo, graph, objects_dir):
+        steps.append("commit-graph")
+        objects += len(graph)
+        io_bytes += len(graph) * (graph.hash_len * 2 + 16)
+
+    return steps, objects, io_bytes
+
+def commit_graph_current(repo, graph, objects_dir):
+    """True if graph was read from the commit-graph file, or objects/info has one that
+    has every ref's commit (we may not have read it, e.g. with COMMIT_GRAPH_FILE off)"""
+    import gitlib
+
+    if graph.from_file:
+        return True
+    try:
+        graph_file = gitlib.CommitGraphFile(objects_dir, repo.refstore.hash_len)
+    except (OSError, ValueError):
+        return False
+    try:
+        return graph.file_tips(graph_file) is not None
+    except ValueError:
+        return False
+    finally:
+        graph_file.close()
+
+def multi_pack_index_current(objects_dir):
+    """True if objects/pack has a multi-pack-index written after its newest pack index"""
+    import os
+    import os.path
+
+    pack_dir = os.path.join(objects_dir, "pack")
+    try:
+        written = os.stat(os.path.join(pack_dir, "multi-pack-index")).st_mtime_ns
+        with os.scandir(pack_dir) as it:
+            return all(entry.stat().st_mtime_ns <= written for entry in it if entry.name.endswith(".idx"))
+    except OSError:
+        return False
+
+def query_latency(repo_path):
+    """Seconds to run LATENCY_QUERIES on the repo, best of LATENCY_RUNS. Each round uses
+    a new Git object, so nothing is remembered from the one before."""
+    import time
+
+    import analyze
+    import gitlib
+
+    best = None
+    for _ in range(LATENCY_RUNS):
+        repo = gitlib.Git(repo_path)
+        start = time.perf_counter()
+        for query in LATENCY_QUERIES:
+            if query in WORKTREE_QUERIES and repo.is_bare_repo:
+                continue
+            try:
+                result = getattr(repo, query)()
+            except RuntimeError:
+                continue
+            if query == "branches":
+                repo.main_branch = analyze.pick_main_branch(result or [])
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+def plan_repo(repo_path):
+    """The report for one repo, with its plan but nothing done yet"""
+    import gitlib
+
+    repo = gitlib.Git(repo_path)
+    report = {"repo": repo_path, "plan": [], "objects": 0, "io": 0}
+    try:
+        with repo.query_batch():
+            report["plan"], report["objects"], report["io"] = plan(repo)
+    except RuntimeError as e:
+        repo.report_error(f"planning failed for {repo_path}: {e}")
+    report["errors"] = list(repo.errors)
+    return report
+
+def run_plan(report):
+    """Carry out a repo's plan, stopping at the first step that fails. Returns the
+    report with "seconds" (for the steps) and "before" and "after" (query latency).
+    The latency is only a fair comparison if nothing else was running; maintain()
+    marks the report "approximate" when other plans could have been."""
+    import time
+
+    import gitlib
+
+    repo_path = report["repo"]
+    before = query_latency(repo_path)
+
+    repo = gitlib.Git(repo_path)
+    start = time.perf_counter()
+    for step in report["plan"]:
+        # some of these print warnings and still work, so only the exit code counts
+        repo.run_git_cmd(STEP_COMMANDS[step], quiet=True)
+        if repo.returncode != 0:
+            repo.report_error(f"{step} failed for {repo_path}", repo.last_stderr)
+            break
+    seconds = time.perf_counter() - start
+
+    after = query_latency(repo_path)
+    return dict(report, seconds=seconds, before=before, after=after, errors=report["errors"] + repo.errors)
+
+def maintain(base_path, jobs=1, io_budget=None, dry_run=False,
+             exclude=(), max_depth=None, follow_symlinks=False, index=None):
+    """Plan maintenance for every repo under base_path and (unless dry_run) carry it
+    out, printing a [repo-N] block for each repo that needs anything. io_budget caps
+    the bytes that running plans may write between them (None for no cap); a plan
+    bigger than the budget still runs, once nothing else is."""
+    import concurrent.futures
+    import os.path
+    import sys
+
+    import discovery
+    import gitlib
+
+    # Linked worktrees share an object store with their main repo; look after each
+    # store once. We need to read the files to plan, so repos we can't are skipped.
+    repo_paths = dict()  # commondir -> repo path
+    for root, kind in discovery.find_repos(base_path, exclude, max_depth, follow_symlinks=follow_symlinks,
+                                           jobs=jobs, index=index):
+        repo_path = os.path.abspath(root).replace("\\", "/")
+        repo = gitlib.Git(repo_path)
+        if repo.refstore is None:
+            print(f"Skipping {repo_path}: can't read its repository files", file=sys.stderr, flush=True)
+            continue
+        repo_paths.setdefault(os.path.realpath(repo.refstore.commondir), repo_path)
+    if index is not None:
+        index.save()
+
+    jobs = max(jobs, 1)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    running = dict()  # future -> bytes it'll write
+    try:
+        reports = list(pool.map(plan_repo, repo_paths.values()))
+        waiting = [report for report in reports if len(report["plan"]) > 0 or len(report["errors"]) > 0]
+        waiting.sort(key=lambda report: report["objects"], reverse=True)
+        print(f"maintenance: {len(waiting)} of {len(reports)} repos need work", file=sys.stderr, flush=True)
+
+        if dry_run:
+            for report in waiting:
+                print_report(report)
+            return
+
+        # other plans compete for the disk and CPU while we time the queries
+        approximate = jobs > 1 and len([report for report in waiting if len(report["plan"]) > 0]) > 1
+
+        # With nothing running, the biggest win starts whatever its size; otherwise the
+        # biggest one that fits in what's left of the budget
+        in_flight = 0
+        while len(waiting) > 0 or len(running) > 0:
+            while len(waiting) > 0 and len(running) < jobs:
+                if len(running) == 0:
+                    report = waiting[0]
+                else:
+                    report = next((report for report in waiting
+                                   if io_budget is None or in_flight + report["io"] <= io_budget), None)
+                    if report is None:
+                        break
+                waiting.remove(report)
+                if len(report["plan"]) == 0:
+                    print_report(report)  # only errors to show
+                    continue
+                running[pool.submit(run_plan, dict(report, approximate=approximate))] = report["io"]
+                in_flight += report["io"]
+            if len(running) == 0:
+                continue
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                in_flight -= running.pop(future)
+                print_report(future.result())
+    finally:
+        # cancel_futures needs 3.9
+        for future in running:
+            future.cancel()
+        pool.shutdown()
+
+def print_report(report):
+    global repo_count
+    repo_count += 1
+    lines = [f"[repo-{repo_count}]", *report_lines(report), ""]
+    print("\n".join(lines), flush=True)
+
+repo_count = 0
+
+def report_lines(report):
+    """The report as "name = value" lines (without the [repo-N] header)"""
+    lines = [f"repo = {report['repo']}"]
+    if len(report["plan"]) > 0:
+        lines.append(f"plan = \"{', '.join(report['plan'])}\"")
+        lines.append(f"objects = {report['objects']}")
+        lines.append(f"io = {report['io'] // 1024} KB")
+    if "seconds" in report:
+        lines.append(f"seconds = {report['seconds']:.3f}")
+        # "~" when other plans were running while we timed the queries
+        mark = "~" if report.get("approximate") else ""
+        lines.append(f"latency = {mark}{report['before']:.3f} -> {mark}{report['after']:.3f}")
+    if len(report["errors"]) > 0:
+        flat_value = "\n".join(report["errors"]).replace("\n", "\\n")
+        lines.append(f"errors = \"{flat_value}\"")
+    return lines
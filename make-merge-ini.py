@@ -2,9 +2,39 @@
 # - generate merge.ini from repos
 
 def main():
-    info = gather(".")
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache', default=None, help='path of the scan cache (default ~/.cache/git-tools/scan-cache.json)')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the scan cache')
+    parser.add_argument('--refresh', action='store_true', help='re-read every repo, then update the scan cache')
+    parser.add_argument('--profile', action='store_true',
+                        help='time every git command and print a summary by subcommand and method at the end')
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help='also save the git commands as Chrome trace events in FILE (implies --profile)')
+    args = parser.parse_args()
+
+    import gitlib
+    if args.profile or args.trace is not None:
+        gitlib.PROFILE = gitlib.Profile()
+
+    cache = None
+    if not args.no_cache:
+        import scancache
+        cache = scancache.ScanCache(args.cache, refresh=args.refresh)
+
+    info = gather(".", cache)
     generate(info)
 
+    if cache is not None:
+        cache.save()
+
+    if gitlib.PROFILE is not None:
+        import sys
+        print("\n".join(gitlib.PROFILE.summary()), file=sys.stderr, flush=True)
+        if args.trace is not None:
+            gitlib.PROFILE.write_trace(args.trace)
+
 def generate(info):
     # print(info)
 
@@ -39,36 +69,52 @@ def generate(info):
         if len(entry['roots']) > 1:
             print(f"roots = \"{', '.join(entry['roots'])}\"")
 
-def gather(root):
-    import os
+def gather(root, cache=None):
     import os.path
     import sys
 
+    import discovery
+
+    # the repos directly inside root
     info = []
-    with os.scandir(root) as it:
-        for entry in it:
-            if not entry.name.startswith('.') and entry.is_dir():
-                gitpath = os.path.join(root, entry.name).replace("\\", "/")
-                item = gather_repo(gitpath)
-                if item is not None:
-                    info.append(item)
-                    print(".", end="", file=sys.stderr, flush=True)
-                else:
-                    print(f"\nSkipping {entry.name}", file=sys.stderr, flush=True)
+    for path, kind in discovery.find_repos(root, exclude=[".*"], min_depth=1, max_depth=1):
+        gitpath = path.replace("\\", "/")
+        item = gather_repo(gitpath, cache)
+        if item is not None:
+            info.append(item)
+            print(".", end="", file=sys.stderr, flush=True)
+        else:
+            print(f"\nSkipping {os.path.basename(path)}", file=sys.stderr, flush=True)
 
     print(file=sys.stderr, flush=True)
     return info
 
-def gather_repo(gitpath):
-    import os.path
+def gather_repo(gitpath, cache=None):
     import sys
 
     import gitlib
+    import scancache
+
     repo = gitlib.Git(gitpath)
     if not repo.is_worktree:
         print(f"Error, not worktree: {gitpath}", file=sys.stderr)
         return None
 
+    if cache is None:
+        return read_repo(repo, gitpath)
+
+    # the cache key uses the absolute path, but the item records gitpath as given
+    key = scancache.cache_key(repo, "gather", gitpath)
+    fingerprint = scancache.repo_fingerprint(repo)
+    found, item = cache.lookup(key, fingerprint)
+    if not found:
+        item = read_repo(repo, gitpath)
+        cache.store(key, fingerprint, item)
+    return item
+
+def read_repo(repo, gitpath):
+    import os.path
+
     branches = repo.branches()
     tags = repo.tags()
     remotes = repo.remotes()
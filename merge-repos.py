@@ -16,19 +16,62 @@ def load_config(inifile):
     return cfg
 
 def run(cfg):
+    import collections
+    import concurrent.futures
+    import itertools
+    import os
+    import os.path
+    import shutil
+    import tempfile
+
     monorepo_path = cfg['core']['monorepo']
-    create_monorepo(monorepo_path)
+    jobs = cfg['core'].getint('jobs', fallback=os.cpu_count() or 1)
 
+    sections = []
     for section in cfg.sections():
         if section == "core":
             continue
         if cfg.has_option(section, 'enabled') and cfg.getboolean(section, 'enabled') is False:
             print(f"Skipping {section} because it is not enabled")
             continue
-        source = cfg[section]['source']
-        subtree = cfg[section]['subtree']
-        branch = cfg[section]['main']
-        add_repo(monorepo_path, source, subtree, branch)
+        sections.append(section)
+
+    create_monorepo(monorepo_path)
+
+    # Cloning and rewriting each source doesn't depend on the others, so that happens on
+    # a process pool, each in its own directory. The monorepo can only take one at a
+    # time: sources are added in config order, each as soon as it's ready. At most jobs
+    # sources are being prepared or waiting at once, so no more than that many clones
+    # are on disk; add_repo() deletes each one once it's merged.
+    work_dir = tempfile.mkdtemp(prefix="merge-repos-", dir=os.path.dirname(os.path.abspath(monorepo_path)))
+    print(f"Preparing {len(sections)} repos in {work_dir} with {jobs} jobs")
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    pending = collections.deque()  # (section, temp_repo_dir, future), in config order
+    try:
+        upcoming = iter(enumerate(sections))
+        while True:
+            for i, section in itertools.islice(upcoming, max(0, jobs - len(pending))):
+                source = cfg[section]['source']
+                temp_repo_dir = os.path.join(work_dir, f"{i:04d}-{os.path.basename(source)}").replace("\\", "/")
+                pending.append((section, temp_repo_dir,
+                                pool.submit(prepare_repo, source, cfg[section]['subtree'], temp_repo_dir)))
+            if len(pending) == 0:
+                break
+
+            section, temp_repo_dir, future = pending.popleft()
+            source = cfg[section]['source']
+            subtree = cfg[section]['subtree']
+            branch = cfg[section]['main']
+            seconds = future.result()
+            print(f"Adding {source}:{branch} to {monorepo_path} as {subtree}:main")
+            print(f"  Cloned {source} into {temp_repo_dir} and moved it to {subtree} ({seconds:.1f}s)")
+            add_repo(monorepo_path, source, subtree, branch, temp_repo_dir)
+    finally:
+        # cancel_futures needs 3.9
+        for section, temp_repo_dir, future in pending:
+            future.cancel()
+        pool.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=False, onerror=rmtree_noaccess)
 
     # At the end, do a git gc to make a single pak
     print(f"Running git gc on {monorepo_path}")
@@ -44,31 +87,29 @@ def create_monorepo(gitpath):
     print(f"  creating initial commit for {gitpath}")
     output = run_git([gitpath, "commit", "--allow-empty", "-m", "Create repository"])
 
-def add_repo(monorepo, source, subtree, branch):
+def prepare_repo(source, subtree, temp_repo_dir):
+    """Clone source into temp_repo_dir and rewrite it so everything is under subtree
+    (and tags get a "subtree-" prefix). Runs in a worker process, so it doesn't print;
+    returns how many seconds it took."""
+    import time
+
+    start_time = time.time()
+    output = run_git([".", "clone", "--no-local", source, temp_repo_dir])
+    output = run_git([temp_repo_dir, "filter-repo", "--to-subdirectory-filter", subtree, "--tag-rename", f":{subtree}-"])
+    return time.time() - start_time
+
+def add_repo(monorepo, source, subtree, branch, temp_repo_dir):
+    """Bring the prepared clone in temp_repo_dir into the monorepo, on top of main"""
     import os.path
     import shutil
-    import sys
-
-    print(f"Adding {source}:{branch} to {monorepo} as {subtree}:main")
 
     source_name = os.path.basename(source)
 
-    temp_repo_name = f"a-{source_name}"
-    temp_repo_dir = os.path.join(os.path.dirname(source), temp_repo_name).replace("\\", "/")
-    if os.path.exists(temp_repo_dir):
-        raise RuntimeError(f"Directory in the way for {temp_repo_dir}")
-
     # make a friendly remote name
     remote = subtree.replace("/", "_")
 
-    print(f"  Cloning {source} into temp repo {temp_repo_dir}")
-    output = run_git([".", "clone", "--no-local", source, temp_repo_dir])
-
-    print(f"  filter-repo: moving {temp_repo_name} to {temp_repo_name}/{subtree}")
-    output = run_git([temp_repo_dir, "filter-repo", "--to-subdirectory-filter", subtree, "--tag-rename", f":{subtree}-"])
-
     print(f"  Adding {temp_repo_dir} to {monorepo} as remotes/{remote}")
-    output = run_git([monorepo, "remote", "add", "-f", remote, f"../{temp_repo_name}"])
+    output = run_git([monorepo, "remote", "add", "-f", remote, temp_repo_dir])
     print(f"  Adding branch orig/{source_name}/{branch} to {monorepo}")
     output = run_git([monorepo, "branch", f"orig/{source_name}/{branch}", f"remotes/{remote}/{branch}"])
 
@@ -0,0 +1,135 @@
+# scancache.py
+# - remember per-repo results between runs, so unchanged repos don't have to be re-analyzed
+
+# Bump this when the shape of cached results changes
+CACHE_VERSION = 5
+
+# Keep at most this many entries; the least recently used ones are dropped first
+MAX_ENTRIES = 10000
+
+def default_cache_path():
+    import os.path
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "git-tools", "scan-cache.json")
+
+class ScanCache:
+    """On-disk cache of per-repo results.
+
+    Entries are keyed on the repo path and what was computed (plus any options that
+    change the result), and are only used if the repo's fingerprint still matches.
+    The fingerprint is built from stat info only (Git.stat_fingerprint() plus hooks,
+    packs and the top of the worktree), so a hit doesn't run git at all. The catch is
+    that an edit to a tracked file isn't noticed until the index changes; use
+    refresh=True (--refresh) to see such edits right away.
+
+    With refresh=True, existing entries are ignored but new results are still saved.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES, refresh=False):
+        import threading
+
+        self.path = path if path is not None else default_cache_path()
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        import json
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if data.get("version") == CACHE_VERSION:
+            self.entries = data.get("entries", dict())
+
+    def save(self):
+        import json
+        import os
+        import tempfile
+
+        with self.lock:
+            # evict least recently used entries beyond the limit
+            if len(self.entries) > self.max_entries:
+                keep = sorted(self.entries, key=lambda key: self.entries[key]["used"], reverse=True)
+                self.entries = {key: self.entries[key] for key in keep[:self.max_entries]}
+            data = {"version": CACHE_VERSION, "entries": self.entries}
+
+        cache_dir = os.path.dirname(self.path)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix=".scan-cache-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def lookup(self, key, fingerprint):
+        """Return (True, result) if we have a result for key with this fingerprint,
+        otherwise (False, None)"""
+        import time
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if self.refresh or entry is None or entry["fingerprint"] != fingerprint:
+                self.misses += 1
+                return False, None
+            entry["used"] = time.time()
+            self.hits += 1
+            return True, entry["result"]
+
+    def store(self, key, fingerprint, result):
+        import time
+
+        with self.lock:
+            self.entries[key] = {"fingerprint": fingerprint, "result": result, "used": time.time()}
+
+def cache_key(repo, kind, *options):
+    """Key for a result of kind (e.g. "analyze") on repo, computed with options"""
+    import os.path
+
+    path = os.path.abspath(repo.gitdir if repo.gitdir is not None else ".").replace("\\", "/")
+    return "|".join([path, kind, *[str(option) for option in options]])
+
+def repo_fingerprint(repo):
+    """Hash of everything about repo that our reports depend on, from stat info only,
+    so checking an entry doesn't need to run git"""
+    import hashlib
+    import os
+
+    sha1 = hashlib.sha1()
+    fingerprint = repo.stat_fingerprint()
+    if fingerprint is None:
+        # we don't know where the gitdir is, so fall back to asking git about the refs
+        sha1.update(repo.signature().encode("utf-8"))
+        return sha1.hexdigest()
+    sha1.update(repr(fingerprint).encode("utf-8"))
+
+    commondir = repo.git_dirs()[1]
+    stat_paths = [
+        os.path.join(commondir, "hooks"),
+        os.path.join(commondir, "modules"),
+        os.path.join(commondir, "objects", "pack"),
+        os.path.join(commondir, "objects", "info"),
+    ]
+    # files added to or removed from the top of the worktree; edits to tracked files
+    # only show up once they are staged (or a git status refreshes the index)
+    if repo.is_worktree:
+        stat_paths.append(repo.gitdir if repo.gitdir is not None else ".")
+    for path in stat_paths:
+        try:
+            st = os.stat(path)
+            sha1.update(f"{path}:{st.st_mtime_ns}:{st.st_size}\n".encode("utf-8"))
+        except OSError:
+            sha1.update(f"{path}:-\n".encode("utf-8"))
+
+    return sha1.hexdigest()
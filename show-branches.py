@@ -5,13 +5,11 @@ def main():
     find_repos(".")
 
 def find_repos(root):
-    import os
-    import os.path
+    import discovery
 
-    with os.scandir(root) as it:
-        for entry in it:
-            if not entry.name.startswith('.') and entry.is_dir():
-                is_git_repo(os.path.join(root, entry.name))
+    # the repos directly inside root
+    for path, kind in discovery.find_repos(root, exclude=[".*"], min_depth=1, max_depth=1):
+        is_git_repo(path)
 
 def is_git_repo(gitpath):
     # print(f"Checking {gitpath}")
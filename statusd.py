@@ -0,0 +1,399 @@
+# statusd.py
+# - keep the status of every repo under a directory up to date, re-analyzing a repo only
+#   when its gitdir changes (Linux only, uses inotify through fsmonitor)
+#
+# Run with "analyze.py --watch", and ask a running daemon with "analyze.py --status".
+#
+# We watch each repo's gitdir (HEAD, index, packed-refs, config), every directory under
+# refs/, logs/refs (for the stash) and worktrees/. Anything git does to a repo touches
+# one of those, so a repo is only looked at again when it fires; a burst of events (a
+# rebase, a fetch) turns into one analysis once things have been quiet for a moment.
+# Edits to worktree files don't touch the gitdir, so those only show up once they're
+# staged, or at the next full rescan.
+#
+# The current status (the same text analyze.py prints) is written to a snapshot file
+# whenever it changes, and sent to anyone who connects to the daemon's socket.
+
+# Analyze a repo once it has been quiet this long (seconds)...
+SETTLE_TIME = 0.5
+
+# ...or once it's been waiting this long, even if it's still busy
+MAX_DELAY = 5.0
+
+# Rediscover and re-analyze everything this often (seconds; 0 for never)
+RESCAN_INTERVAL = 600
+
+def default_socket_path():
+    import os.path
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "git-tools", "statusd.sock")
+
+def default_snapshot_path():
+    import os.path
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "git-tools", "status.txt")
+
+def error_line(errors):
+    """errors as an "errors = ..." report line, the way maintenance reports them"""
+    flat_value = "\n".join(errors).replace("\n", "\\n")
+    return f"errors = \"{flat_value}\""
+
+def read_status(socket_path=None):
+    """Ask a running daemon for the current status; returns the text, or None if no
+    daemon is listening"""
+    import socket
+
+    if socket_path is None:
+        socket_path = default_socket_path()
+    chunks = []
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(30)
+            sock.connect(socket_path)
+            while True:
+                chunk = sock.recv(65536)
+                if len(chunk) == 0:
+                    break
+                chunks.append(chunk)
+    except OSError:
+        return None
+    return b"".join(chunks).decode("utf-8", errors="replace")
+
+class StatusDaemon:
+    """Watches the repos found under base_path and keeps their reports in memory.
+
+    The repo list, the watches and the reports all belong to the thread running run();
+    only analyze_repo() runs on the pool.
+    """
+
+    def __init__(self, base_path, verbose, dirty_only, jobs=1, exclude=(), max_depth=None,
+                 follow_symlinks=False, index=None, socket_path=None, snapshot_path=None):
+        import fsmonitor
+
+        self.base_path = base_path
+        self.verbose = verbose
+        self.dirty_only = dirty_only
+        self.jobs = jobs
+        self.exclude = exclude
+        self.max_depth = max_depth
+        self.follow_symlinks = follow_symlinks
+        self.index = index
+        self.socket_path = socket_path if socket_path is not None else default_socket_path()
+        self.snapshot_path = snapshot_path if snapshot_path is not None else default_snapshot_path()
+
+        self.mask = (fsmonitor.IN_MODIFY | fsmonitor.IN_CLOSE_WRITE | fsmonitor.IN_MOVED_FROM | fsmonitor.IN_MOVED_TO
+                     | fsmonitor.IN_CREATE | fsmonitor.IN_DELETE | fsmonitor.IN_DELETE_SELF | fsmonitor.IN_MOVE_SELF
+                     | fsmonitor.IN_ONLYDIR | fsmonitor.IN_EXCL_UNLINK)
+        self.fd = None
+        self.roots = []           # repos in discovery order
+        self.reports = dict()     # root -> report lines, or None if there is nothing to show
+        self.watched = dict()     # wd -> (set of roots, path, recursive)
+        self.watch_paths = dict() # path -> wd
+        self.dirty = dict()       # root -> (first event, last event)
+        self.running = dict()     # root -> future
+        self.text = ""
+        self.last_rescan = 0
+
+    # --------------------------------------------------------------------------------------------
+    # Main loop
+    # --------------------------------------------------------------------------------------------
+
+    def run(self):
+        import concurrent.futures
+        import os
+        import os.path
+        import select
+        import signal
+        import socket
+        import sys
+        import time
+
+        import fsmonitor
+
+        # clean up the socket when we're told to stop
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        # Our own git status mustn't refresh the index, or writing it would wake us up again
+        os.environ["GIT_OPTIONAL_LOCKS"] = "0"
+
+        self.fd = fsmonitor.inotify_init()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.jobs))
+
+        # a socket nobody answers on is left over from a daemon that died
+        if read_status(self.socket_path) is not None:
+            raise RuntimeError(f"A status daemon is already listening on {self.socket_path}")
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(16)
+        print(f"Listening on {self.socket_path}", file=sys.stderr, flush=True)
+
+        try:
+            self.rescan()
+            self.write_snapshot()
+            while True:
+                now = time.time()
+                self.start_analyses(pool, now)
+
+                # wake up for events, clients, finished analyses and the next deadline
+                timeout = None
+                if len(self.running) > 0:
+                    timeout = 0.1
+                for first, last in self.dirty.values():
+                    wait = max(0, min(last + SETTLE_TIME, first + MAX_DELAY) - now)
+                    timeout = wait if timeout is None else min(timeout, wait)
+                if RESCAN_INTERVAL > 0:
+                    wait = max(0, self.last_rescan + RESCAN_INTERVAL - now)
+                    timeout = wait if timeout is None else min(timeout, wait)
+
+                ready, _, _ = select.select([self.fd, server], [], [], timeout)
+                if self.fd in ready:
+                    self.read_events()
+                if server in ready:
+                    self.serve(server)
+                if self.finish_analyses():
+                    self.write_snapshot()
+                if RESCAN_INTERVAL > 0 and time.time() - self.last_rescan >= RESCAN_INTERVAL:
+                    self.rescan()
+        finally:
+            server.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            # cancel_futures needs 3.9
+            for future in self.running.values():
+                future.cancel()
+            pool.shutdown(wait=False)
+            os.close(self.fd)
+
+    def rescan(self):
+        """Find the repos again, watch the new ones, forget the ones that are gone, and
+        queue everything for analysis"""
+        import time
+
+        import discovery
+
+        self.last_rescan = time.time()
+        roots = [root for root, kind in discovery.find_repos(self.base_path, self.exclude, self.max_depth,
+                                                             follow_symlinks=self.follow_symlinks,
+                                                             jobs=self.jobs, index=self.index)]
+        if self.index is not None:
+            self.index.save()
+
+        found = set(roots)
+        for root in self.roots:
+            if root not in found:
+                self.forget(root)
+        for root in roots:
+            if root not in self.reports:
+                self.reports[root] = None
+                self.watch_repo(root)
+            self.mark_dirty(root, self.last_rescan - MAX_DELAY)
+        self.roots = roots
+
+    def forget(self, root):
+        import fsmonitor
+
+        self.reports.pop(root, None)
+        self.dirty.pop(root, None)
+        for wd, (roots, path, recursive) in list(self.watched.items()):
+            roots.discard(root)
+            if len(roots) == 0:
+                fsmonitor.load_libc().inotify_rm_watch(self.fd, wd)
+                del self.watched[wd]
+                self.watch_paths.pop(path, None)
+
+    def mark_dirty(self, root, when):
+        first, last = self.dirty.get(root, (when, when))
+        self.dirty[root] = (min(first, when), when)
+
+    # --------------------------------------------------------------------------------------------
+    # Watches
+    # --------------------------------------------------------------------------------------------
+
+    def watch_repo(self, root):
+        """Watch the parts of root's gitdir that change when git does something"""
+        import os.path
+
+        import gitlib
+
+        try:
+            repo = gitlib.Git(root)
+            dirs = repo.git_dirs()
+        except RuntimeError:
+            dirs = None
+        if dirs is None:
+            return
+        gitdir, commondir = dirs
+
+        self.watch(root, gitdir, False)
+        self.watch(root, os.path.join(gitdir, "refs"), True)
+        self.watch(root, os.path.join(gitdir, "reftable"), False)
+        if commondir != gitdir:
+            self.watch(root, commondir, False)
+            self.watch(root, os.path.join(commondir, "refs"), True)
+            self.watch(root, os.path.join(commondir, "reftable"), False)
+        self.watch(root, os.path.join(commondir, "logs", "refs"), False)
+        self.watch(root, os.path.join(commondir, "worktrees"), False)
+
+    def watch(self, root, path, recursive):
+        """Add a watch on path for root (and, if recursive, on every directory below it)"""
+        import os
+        import os.path
+
+        import fsmonitor
+
+        stack = [os.path.abspath(path)]
+        while len(stack) > 0:
+            path = stack.pop()
+            wd = fsmonitor.add_watch(self.fd, path, self.mask)
+            if wd is None:
+                continue
+            if wd in self.watched:
+                self.watched[wd][0].add(root)
+            else:
+                self.watched[wd] = ({root}, path, recursive)
+            self.watch_paths[path] = wd
+            if recursive:
+                try:
+                    with os.scandir(path) as it:
+                        stack.extend(entry.path for entry in it if entry.is_dir(follow_symlinks=False))
+                except OSError:
+                    pass
+
+    def read_events(self):
+        import os.path
+        import time
+
+        import fsmonitor
+
+        now = time.time()
+        for wd, mask, name in fsmonitor.read_events(self.fd):
+            if mask & fsmonitor.IN_Q_OVERFLOW:
+                # we don't know who changed, so look at everyone
+                for root in self.roots:
+                    self.mark_dirty(root, now)
+                continue
+            entry = self.watched.get(wd)
+            if entry is None:
+                continue
+            roots, path, recursive = entry
+            if mask & fsmonitor.IN_IGNORED:
+                del self.watched[wd]
+                if self.watch_paths.get(path) == wd:
+                    del self.watch_paths[path]
+                continue
+
+            # lock files come and go around every write; the rename that follows is
+            # what matters
+            if name.endswith(b".lock"):
+                continue
+            if recursive and mask & fsmonitor.IN_ISDIR and mask & (fsmonitor.IN_CREATE | fsmonitor.IN_MOVED_TO):
+                for root in roots:
+                    self.watch(root, os.path.join(path, os.fsdecode(name)), True)
+            for root in roots:
+                self.mark_dirty(root, now)
+
+    # --------------------------------------------------------------------------------------------
+    # Analysis
+    # --------------------------------------------------------------------------------------------
+
+    def start_analyses(self, pool, now):
+        import analyze
+
+        for root, (first, last) in list(self.dirty.items()):
+            if root in self.running:
+                continue  # it stays dirty, and goes again once this run is done
+            if now - last < SETTLE_TIME and now - first < MAX_DELAY:
+                continue
+            del self.dirty[root]
+            self.running[root] = pool.submit(analyze.analyze_repo, root, self.verbose, self.dirty_only, False)
+
+    def finish_analyses(self):
+        """Collect finished analyses; returns True if any report changed"""
+        import os.path
+        import sys
+
+        import analyze
+
+        changed = False
+        for root, future in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[root]
+            if root not in self.reports:
+                continue  # forgotten while we were looking at it
+            if not os.path.isdir(root):
+                # the repo is gone
+                self.forget(root)
+                self.roots.remove(root)
+                changed = True
+                continue
+            # git errors and failures go into the repo's report, where --status shows them
+            try:
+                result = future.result()
+            except (RuntimeError, OSError) as e:
+                report = [f"repo = {root}", error_line([f"Failed to analyze {root}: {e}"])]
+            else:
+                report = None if result is None else analyze.report_lines(result[1])
+                if report is not None and len(result[1]["errors"]) > 0:
+                    report.append(error_line(result[1]["errors"]))
+            if self.verbose:
+                print(f"Analyzed {root}", file=sys.stderr, flush=True)
+            if report != self.reports[root]:
+                self.reports[root] = report
+                changed = True
+        return changed
+
+    # --------------------------------------------------------------------------------------------
+    # Serving the status
+    # --------------------------------------------------------------------------------------------
+
+    def status_text(self):
+        """The reports in discovery order, numbered the way analyze.py numbers them"""
+        lines = []
+        count = 0
+        for root in self.roots:
+            report = self.reports.get(root)
+            if report is None:
+                continue
+            count += 1
+            lines.extend([f"[repo-{count}]", *report, ""])
+        return "\n".join(lines) + ("\n" if len(lines) > 0 else "")
+
+    def write_snapshot(self):
+        import os
+        import os.path
+        import tempfile
+
+        self.text = self.status_text()
+        snapshot_dir = os.path.dirname(self.snapshot_path)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=snapshot_dir, prefix=".status-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.text)
+            os.replace(temp_path, self.snapshot_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def serve(self, server):
+        """Send the current status to one client"""
+        try:
+            conn, _ = server.accept()
+        except OSError:
+            return
+        with conn:
+            conn.settimeout(5)
+            try:
+                conn.sendall(self.text.encode("utf-8"))
+            except OSError:
+                pass